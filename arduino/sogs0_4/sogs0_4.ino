@@ -6,6 +6,16 @@
 
 String buffer;
 const String progID="LAir 0.1";//version information
+const String progCaps="bin,rtc";//optional features, listed after the version in the handshake
+byte binMode=false;//send measurements as binary frames
+//burst sampling. Readings are packed ten bytes apiece into a ring buffer.
+const int burstMax=48;
+byte burstRing[burstMax*10];
+int burstHead=0,burstCount=0;//oldest record and number of records held
+unsigned int burstFirst=0;//sample number of the oldest record
+unsigned int burstLeft=0,burstTaken=0,burstInterval=0;
+char burstBank='0';
+unsigned long burstLast;
 byte strobe=true;
 int fade=0,fadeT=10000;
 unsigned long oldMillis;
@@ -24,6 +34,35 @@ end of the serial line. Then it can send messages safely back and
 forth to the interface software. Don't send serial messages until
 a handshake is established!
 
+Binary frames:
+The handshake reply lists "bin" after the version, separated by a ;. If
+the computer sends BB1 the board answers BB1 and from then on sends
+measurements as binary frames instead of alphahex. BB0 switches back.
+A frame is the header, a two byte payload length, the payload and a two
+byte CRC-CCITT (initial value 0xffff) of all that, little endian. It is
+SLIP encoded and sent between two 0xc0 bytes, so it may contain 13s
+without ending a packet. A measurement payload is the eight 10 bit
+readings packed together, least significant bit first, in ten bytes.
+
+Bursts:
+N0ccciiii starts a burst of ccc (three alphahex digits) measurements of
+bank 0, one every iiii (four alphahex digits) milliseconds; N1 does bank
+1. The board answers N0ccc at once and samples into a ring buffer of
+burstMax records as it goes on with other commands. A new burst empties
+the buffer, and a full buffer loses its oldest record. D0 (or D1) sends
+and empties the buffer: the reply has the bank's header, D0 or D1, then
+the sample number of the first record in four alphahex digits and then
+the records, 24 alphahex digits each as measure() gives. In binary mode
+the reply is a frame whose payload is the sample number as a uint16
+followed by the records packed as for measurements.
+
+Clock:
+tG reads the M41T83 clock. The reply is tG and then the year, month, day,
+hour, minute, second and hundredth of a second, each two BCD digits sent as
+two alphahex digits, so 2014-01-31 14:51:00.87 is tGbeabdbbefbaaih.
+Boards that list "rtc" in the handshake answer this way; older ones sent
+the registers in decimal, which can't be read back reliably.
+
 */
 //SdFat sd; //file system object
 //ArduinoOutStream SPStream;
@@ -100,7 +139,12 @@ void processSerial(String s){
     char t1=s.charAt(1); //ie what information or request it contains
     if (t0=='V') {
       if (t1=='V') {
-        putSerial("VV"+progID);//the program returns a packet containing version information.
+        putSerial("VV"+progID+";"+progCaps);//the program returns a packet containing version information.
+      }
+    }else if (t0=='B') {
+      if (t1=='B') {//binary frames on or off
+        binMode=(s.length()>2&&s.charAt(2)=='1');
+        putSerial(binMode?"BB1":"BB0");
       }
     }else if (t0=='H') {
       if (t1=='T') {
@@ -118,13 +162,28 @@ void processSerial(String s){
     }else if (t0=='M') {
       if (t1=='0') {//measure bank zero
         pinConSet(LOW);
-        String out=measure();
-        putSerial("M0"+out);
+        if (binMode) {
+          putMeasureFrame('M','0');
+        } else {
+          String out=measure();
+          putSerial("M0"+out);
+        }
       }else if(t1=='1'){//measure bank one
         pinConSet(HIGH);
-        String out=measure();
-        putSerial("M1"+out);
+        if (binMode) {
+          putMeasureFrame('M','1');
+        } else {
+          String out=measure();
+          putSerial("M1"+out);
+        }
+      }
+    }else if (t0=='N') {//burst
+      if ((t1=='0'||t1=='1')&&s.length()>=9) {
+        burstStart(t1,alphahexToUnsigned(s,2,3),alphahexToUnsigned(s,5,4));
+        putSerial("N"+String(t1)+u12ToAlphahex(burstLeft));
       }
+    }else if (t0=='D') {//dump burst
+      putDump();
     }else if (t0=='R'){ //Radio
       if (t1=='r'){//recieve
       }else if (t1=='t'){//transmit
@@ -158,6 +217,16 @@ String byteToAlphahex(byte b){
   return out;
 }
 
+unsigned int alphahexToUnsigned(String s,int from,int n){
+  //reads n alphahex digits from s, most significant first as u12ToAlphahex
+  //writes them.
+  unsigned int out=0;
+  for (int i=from;i<from+n;i++){
+    out=(out<<4)+((s.charAt(i)-97)&0x0f);
+  }
+  return out;
+}
+
 String u12ToAlphahex(int i){
   //converts a 12 bit number to alphahex. a=0, p=f
   //to pass an array: fn(int array[]){};
@@ -243,7 +312,7 @@ void startupM41T83(){
 
 String getTimeM41T83(){
   //address 0xd0. Using the longer read sequence from page 13.
-  //delivers a string YMDHMSm
+  //delivers a string YMDHMSm, two alphahex digits apiece
   byte b[7];
   Wire.beginTransmission(0xd0);
   Wire.write(0x00);
@@ -252,18 +321,18 @@ String getTimeM41T83(){
   Wire.requestFrom(0xd0,8); //send data read request
   //delay(5); //a bit of a delay might be necessary, right?
   b[6]=Wire.read();
-  b[5]=Wire.read();
-  b[4]=Wire.read();
-  b[3]=Wire.read();
+  b[5]=Wire.read()&0x7f;//without the stop bit
+  b[4]=Wire.read()&0x7f;
+  b[3]=Wire.read()&0x3f;//without the century bits
   b[2]=Wire.read();//day of week, which is discarded.
-  b[2]=Wire.read();
-  b[1]=Wire.read();
+  b[2]=Wire.read()&0x3f;
+  b[1]=Wire.read()&0x1f;
   b[0]=Wire.read();
   //we now have a char array. We must convert this to alphahex.
-  //not using strings might save memory space
   String out="";
   for(int i=0;i<7;i++){
-    out+=b[i];
+    out+=(char)(((b[i]>>4)&0x0f)+97);
+    out+=(char)((b[i]&0x0f)+97);
   }
   return out;
   //return String(b[0]); //hopefully a simple operation!
@@ -276,6 +345,7 @@ String getTimeM41T83(){
 String setTimeM41T83(String s){
   //python cannot recieve bytes properly, but it can transmit them.
   //the string will be sent in form tSxxxxxxx\n where x=YMDHMSm
+  Wire.beginTransmission(0xd0);
   Wire.write(0x00);//initial address
   Wire.write(s[6]-20);
   Wire.write(s[5]-20);//watch that you don't set the stop bit (0x80) to 1.
@@ -303,6 +373,145 @@ String measure(){
   return out;
 }
 
+unsigned int crcCCITT(unsigned int crc,byte b){
+  //one byte's worth of CRC-CCITT, polynomial 0x1021.
+  crc^=((unsigned int)b)<<8;
+  for (int i=0;i<8;i++){
+    if (crc&0x8000){
+      crc=(crc<<1)^0x1021;
+    } else {
+      crc=crc<<1;
+    }
+  }
+  return crc;
+}
+
+void putSlipByte(byte b){
+  //sends a byte inside a SLIP frame, escaping END and ESC.
+  if (b==0xc0){
+    Serial.write(0xdb);
+    Serial.write(0xdc);
+  }else if (b==0xdb){
+    Serial.write(0xdb);
+    Serial.write(0xdd);
+  }else{
+    Serial.write(b);
+  }
+}
+
+void putFrame(byte* raw,int n){
+  //sends raw, which has room for the crc in its last two bytes, as a frame.
+  unsigned int crc=0xffff;
+  for (int i=0;i<n-2;i++){
+    crc=crcCCITT(crc,raw[i]);
+  }
+  raw[n-2]=crc&0xff;
+  raw[n-1]=crc>>8;
+  Serial.write(0xc0);
+  for (int i=0;i<n;i++){
+    putSlipByte(raw[i]);
+  }
+  Serial.write(0xc0);
+}
+
+void putMeasureFrame(char h0,char h1){
+  //reads the eight analog pins and sends them as a binary frame.
+  byte raw[16]={0};//header 2, length 2, samples 10, crc 2
+  raw[0]=h0;
+  raw[1]=h1;
+  raw[2]=10;
+  raw[3]=0;
+  for (int i=0;i<8;i++){
+    packSample(raw+4,i*10,analogRead(A0+i)&0x3ff);
+  }
+  putFrame(raw,16);
+}
+
+void packSample(byte* raw,unsigned int bit,unsigned int v){
+  //ors the 10 bit value v into raw starting bit bits in.
+  for (int j=0;j<10;j++,bit++){
+    if (v&(1<<j)){
+      raw[bit/8]|=1<<(bit%8);
+    }
+  }
+}
+
+void burstStart(char bank,unsigned int count,unsigned int interval){
+  burstBank=bank;
+  burstLeft=count;
+  burstInterval=interval;
+  burstHead=0;
+  burstCount=0;
+  burstFirst=0;
+  burstTaken=0;
+  burstLast=millis()-interval;//the first reading is taken straight away
+}
+
+void burstRun(){
+  //called from loop(), takes the next burst reading when it is due.
+  if (burstLeft==0||millis()-burstLast<burstInterval){return;}
+  burstLast+=burstInterval;
+  pinConSet(burstBank=='1'?HIGH:LOW);
+  if (burstCount==burstMax){//full, drop the oldest
+    burstHead=(burstHead+1)%burstMax;
+    burstCount--;
+    burstFirst++;
+  }
+  byte* raw=burstRing+((burstHead+burstCount)%burstMax)*10;
+  for (int i=0;i<10;i++){raw[i]=0;}
+  for (int i=0;i<8;i++){
+    packSample(raw,i*10,analogRead(A0+i)&0x3ff);
+  }
+  burstCount++;
+  burstTaken++;
+  burstLeft--;
+}
+
+void putDump(){
+  //sends and empties the burst buffer. The records are written straight
+  //out rather than built into a string, which wouldn't fit in RAM.
+  if (binMode){
+    unsigned int n=burstCount*10+2;
+    unsigned int crc=0xffff;
+    byte head[6]={'D',(byte)burstBank,(byte)(n&0xff),(byte)(n>>8),(byte)(burstFirst&0xff),(byte)(burstFirst>>8)};
+    Serial.write(0xc0);
+    for (int i=0;i<6;i++){
+      crc=crcCCITT(crc,head[i]);
+      putSlipByte(head[i]);
+    }
+    for (int r=0;r<burstCount;r++){
+      byte* raw=burstRing+((burstHead+r)%burstMax)*10;
+      for (int i=0;i<10;i++){
+        crc=crcCCITT(crc,raw[i]);
+        putSlipByte(raw[i]);
+      }
+    }
+    putSlipByte(crc&0xff);
+    putSlipByte(crc>>8);
+    Serial.write(0xc0);
+  } else {
+    Serial.print("D");
+    Serial.print(burstBank);
+    Serial.print(u12ToAlphahex(burstFirst>>4));//four digits
+    Serial.write((burstFirst&0x0f)+97);
+    for (int r=0;r<burstCount;r++){
+      byte* raw=burstRing+((burstHead+r)%burstMax)*10;
+      unsigned int bit=0;
+      for (int i=0;i<8;i++){
+        unsigned int v=0;
+        for (int j=0;j<10;j++,bit++){
+          if (raw[bit/8]&(1<<(bit%8))){v|=1<<j;}
+        }
+        Serial.print(u12ToAlphahex(v));
+      }
+    }
+    Serial.write(13);
+  }
+  burstFirst+=burstCount;
+  burstHead=0;
+  burstCount=0;
+}
+
 void doStrobe(){
   if (fade<fadeT){fade++;} else {fade=0;}
   if (strobe==false&&fade==0){
@@ -319,6 +528,7 @@ void loop(){
   //waitUntilMillis(1000);
   doStrobe();
   getSerial();
+  burstRun();
   //putAlphahexByte(1);
   //Serial.write(13);
 }
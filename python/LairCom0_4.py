@@ -6,14 +6,40 @@
 #0_2 display version
 #0_3 Accessable version
 #0_4 Modified for multiple measurements per file
+#   Binary measurement frames, when the board offers them
+#   Burst sampling on the board, see burst() and dump()
+#   Counters and histograms, see stats() and SOGSMetrics
+#   Packets timed on arrival, and the board's clock tracked, see ClockSync
 
 import tkinter as tk
 import os
 import serial
+import serial.tools.list_ports
+import glob
 from psigraph import barGraph
+from psigraph import stripChart
+import SOGSStorage
+import SOGSMetrics
 import datetime
 import time
 import math
+import collections
+import heapq
+import bisect
+import tempfile
+import selectors
+import operator
+import concurrent.futures
+import struct
+import binascii
+import array
+import threading
+import queue
+import socket
+try:
+    import numpy as np
+except ImportError:
+    np=None #the batch parsers fall back to plain python without numpy
 
 def alphahexToByte(s):
     #returns an integer equal to the 2-digit alphahex string (a=0, p=f)
@@ -29,6 +55,207 @@ def alphahexToNumber(s,n):
         out+=(ord(s[i])-97)*16**(n-i-1)
     return out
 
+#Every three digit alphahex string, mapped to the number it holds with every
+#digit counted, as alphahexToUnsigned and the binary frames do. (Measurements
+#were once decoded with alphahexToNumber, which leaves out the last digit.)
+#Looking a packet up here is much quicker than doing the arithmetic.
+alphahexTable={}
+for _i in range(0,4096):
+    _s=chr((_i>>8)+97)+chr(((_i>>4)&15)+97)+chr((_i&15)+97)
+    alphahexTable[_s]=_i
+alphahexWeights=[256,16,1]
+
+def alphahexToCounts(packet,n=8):
+    #returns a list of the first n three digit alphahex numbers in packet.
+    out=[]
+    for i in range(0,n*3,3):
+        s=packet[i:i+3]
+        v=alphahexTable.get(s)
+        if v is None:
+            v=alphahexToUnsigned(s) #not alphahex, but as a burst dump would be.
+        out.append(v)
+    return out
+
+def alphahexPacketsToCounts(packets,n=8):
+    #decodes a list of packets at once into an (N,n) numpy array of the first
+    #n three digit alphahex numbers in each. Every packet must be long enough.
+    w=n*3
+    raw=np.frombuffer("".join([p[:w] for p in packets]).encode("ascii","replace"),dtype=np.uint8)
+    digits=(raw.reshape(len(packets),n,3).astype(np.int32)-97)&15
+    return digits.dot(np.array(alphahexWeights,dtype=np.int32))
+
+#Boards whose handshake offers "bin" can send measurements as binary frames,
+#which take about half the bytes. A frame is
+#  header (2 ascii bytes) | payload length (uint16) | payload | crc (uint16)
+#little endian, where crc is CRC-CCITT (initial value 0xffff) of everything
+#before it. The frame is SLIP encoded and sent between two 0xc0 bytes, so the
+#carriage returns ending text packets can't be confused with the data. The
+#payload of a measurement is its 10 bit ADC samples packed least significant
+#bit first.
+slipEnd=b"\xc0"
+slipEsc=b"\xdb"
+
+def slip(raw):
+    #returns raw SLIP encoded, with an END byte at each end.
+    return slipEnd+raw.replace(slipEsc,b"\xdb\xdd").replace(slipEnd,b"\xdb\xdc")+slipEnd
+
+def unslip(frame):
+    #undoes slip for the bytes between two END bytes.
+    return frame.replace(b"\xdb\xdc",slipEnd).replace(b"\xdb\xdd",slipEsc)
+
+def makeFrame(header,payload):
+    #returns the SLIP encoded frame carrying payload, as the board sends it.
+    raw=header.encode("ascii")+struct.pack("<H",len(payload))+payload
+    return slip(raw+struct.pack("<H",binascii.crc_hqx(raw,0xffff)))
+
+def parseFrame(frame):
+    #returns (header,payload) from the bytes between two END bytes, or None
+    #if the frame is damaged.
+    raw=unslip(frame)
+    if len(raw)<6:
+        return None
+    n=struct.unpack_from("<H",raw,2)[0]
+    if len(raw)!=n+6 or struct.unpack_from("<H",raw,n+4)[0]!=binascii.crc_hqx(raw[:n+4],0xffff):
+        return None
+    return raw[0:2].decode("ascii","replace"),bytes(raw[4:n+4])
+
+def packSamples(counts):
+    #packs a list of 10 bit numbers the way the board does.
+    v=0
+    for i in range(0,len(counts)):
+        v|=(counts[i]&1023)<<(10*i)
+    return v.to_bytes((len(counts)*10+7)//8,"little")
+
+def unpackSamples(payload,n=8):
+    #returns the first n 10 bit samples in payload as a list.
+    v=int.from_bytes(payload[0:(n*10+7)//8],"little")
+    return [(v>>(10*i))&1023 for i in range(0,n)]
+
+def unpackSamplesArray(payloads,n=8):
+    #decodes a list of payloads at once into an (N,n) numpy array of samples.
+    w=(n*10+7)//8
+    return unpackSamplesBlock(b"".join([p[0:w] for p in payloads]),n)
+
+class Packet(str):
+    #A received packet, which is its text, timed by the read it came in on:
+    #arrived is time.time_ns(), nanoseconds since 1970 UTC, and mono
+    #time.monotonic_ns().
+    def __new__(cls,text,arrived=None,mono=None):
+        self=str.__new__(cls,text)
+        self.arrived=arrived
+        self.mono=mono
+        return self
+
+class BinaryPacket(Packet):
+    #A packet that came as a binary frame. It passes for a text packet made
+    #of the header and the payload in hex, which is what shows up in logs;
+    #the payload itself is in data.
+    def __new__(cls,header,data,arrived=None,mono=None):
+        self=str.__new__(cls,header+data.hex())
+        self.data=data
+        self.arrived=arrived
+        self.mono=mono
+        return self
+
+def localDatetime(ns):
+    #the naive local datetime of ns since 1970 UTC, as from time.time_ns().
+    #The saved files go by local time, so times are only turned into it there
+    #and for showing.
+    return datetime.datetime.fromtimestamp(ns//1000000000)+datetime.timedelta(microseconds=ns%1000000000//1000)
+
+def rtcToNs(s):
+    #reads the fourteen alphahex digits of a tG reply, BCD year, month, day,
+    #hour, minute, second and hundredth, into nanoseconds since 1970 as if
+    #the clock kept UTC. A board set to local time is then out by the time
+    #zone, which is steady and so taken up by ClockSync's offset. None if
+    #they aren't a time, as from firmware without "rtc" in its handshake.
+    if len(s)<14:
+        return None
+    try:
+        b=[alphahexToUnsigned(s[i:i+2]) for i in range(0,14,2)]
+        v=[(n>>4)*10+(n&15) for n in b]
+        return SOGSStorage.datetimeToNs(datetime.datetime(2000+v[0],v[1],v[2],v[3],v[4],v[5],v[6]*10000))
+    except ValueError:
+        return None
+
+class ClockSync:
+    #Works out how far a board's clock is from the computer's and how fast
+    #it drifts, from round trips that read the board's clock. The board is
+    #taken to have read its clock halfway through the round trip, and as it
+    #only counts hundredths, halfway through that hundredth. Samples whose
+    #round trip took over twice the quickest are left out, and a least
+    #squares line through the rest gives the offset at any time and the
+    #drift. The computer's side is time.monotonic_ns(), which unlike the
+    #wall clock isn't stepped by NTP or summer time, so the offset is from
+    #that; wallOffset gives it from time.time_ns().
+    def __init__(self,window=32):
+        self.samples=collections.deque(maxlen=window) #(monotonic time, board-monotonic, round trip)
+        self.line=None #(monotonic time, offset at it, drift), see fit
+    def add(self,monoNs,boardNs,rttNs):
+        #monoNs is when the board read its clock, by time.monotonic_ns().
+        self.samples.append((monoNs,boardNs+5000000-monoNs,rttNs))
+        self.line=self.fit()
+    def fit(self):
+        best=min([r[2] for r in self.samples])
+        use=[r for r in self.samples if r[2]<=2*best]
+        t0=use[0][0]
+        n=len(use)
+        mt=sum([r[0]-t0 for r in use])/n
+        mo=sum([r[1] for r in use])/n
+        var=sum([(r[0]-t0-mt)**2 for r in use])
+        drift=0.0 if var==0 else sum([(r[0]-t0-mt)*(r[1]-mo) for r in use])/var
+        return (t0+int(mt),mo,drift)
+    def offset(self,monoNs):
+        #board time less monotonic time in ns at monoNs, or None if unknown.
+        if self.line==None:
+            return None
+        (t,o,d)=self.line
+        return int(o+d*(monoNs-t))
+    def boardTime(self,monoNs):
+        #what the board's clock read, or will read, at monoNs.
+        o=self.offset(monoNs)
+        return None if o==None else monoNs+o
+    def wallOffset(self):
+        #board time less time.time_ns() now, in ns, or None if unknown.
+        b=self.boardTime(time.monotonic_ns())
+        return None if b==None else b-time.time_ns()
+    def driftPpm(self):
+        return None if self.line==None else self.line[2]*1e6
+
+def numberToAlphahex(v,n):
+    #returns the unsigned integer v as n alphahex digits, most significant first.
+    return "".join([chr(((v>>(4*(n-i-1)))&15)+97) for i in range(0,n)])
+
+def alphahexToUnsigned(s):
+    #the inverse of numberToAlphahex. Unlike alphahexToNumber every digit counts.
+    out=0
+    for c in s:
+        out=(out<<4)+((ord(c)-97)&15)
+    return out
+
+def alphahexBlockToCounts(block,n=8):
+    #decodes a string of records of n three digit alphahex numbers, such as a
+    #burst dump, in one go. Every digit counts, as in alphahexToUnsigned.
+    #Returns an (N,n) numpy array, or a list of lists without numpy.
+    w=n*3
+    rows=len(block)//w
+    if np is None:
+        return [[alphahexToUnsigned(block[i:i+3]) for i in range(r*w,(r+1)*w,3)] for r in range(0,rows)]
+    raw=np.frombuffer(block[0:rows*w].encode("ascii","replace"),dtype=np.uint8)
+    digits=(raw.reshape(rows,n,3).astype(np.int32)-97)&15
+    return digits.dot(np.array([256,16,1],dtype=np.int32))
+
+def unpackSamplesBlock(block,n=8):
+    #decodes back to back records of n packed 10 bit samples in one go.
+    #Returns an (N,n) numpy array, or a list of lists without numpy.
+    w=(n*10+7)//8
+    rows=len(block)//w
+    if np is None:
+        return [unpackSamples(block[r*w:(r+1)*w],n) for r in range(0,rows)]
+    raw=np.frombuffer(block,dtype=np.uint8,count=rows*w).reshape(rows,w)
+    bits=np.unpackbits(raw,axis=1,bitorder="little")[:,0:n*10].reshape(rows,n,10)
+    return bits.dot(1<<np.arange(10))
+
 def floatToAlphahex(f):
     #returns a sixteen digit alphahex string representing double precision floating point.
     #unfinished.
@@ -85,31 +312,105 @@ class LairCom:
     no measurements have been recieved in the meantime. Beware, you MUST have
     called tick inbetween calling the Req and Get functions in order for the
     LairCom object to monitor and retrieve your values.
+    To keep several measurements on the go at once, use submit instead:
+    >>> r=lc.submit("gas",callback=f)
+    Up to window requests are sent to the board at a time and the rest wait
+    their turn. The board answers in the order it was asked, so each reply
+    goes to the oldest outstanding request with the same header. The reply is
+    parsed into r.result and f(r) is called from within tick(). r.latency()
+    gives the round trip time, and lc.rtt holds the latest one for each
+    controller name. A request that isn't answered within timeout seconds is
+    given up on with r.state set to 3; if its reply turns up later after all,
+    it is thrown away instead of being taken for the next request's.
+    If the board offers binary frames in its handshake they are switched on,
+    unless useBinary is False. Controllers parse them with parseFrameToData,
+    so get() and submit() work the same either way.
+    For sampling faster than a round trip allows, the board can take a burst
+    of measurements by itself and send them all at once:
+    >>> lc.burst("gas",40,0.05)
+    starts 40 measurements 50 ms apart, and
+    >>> r=lc.dump("gas")
+    fetches whatever has been taken so far. Once r is done, r.result is
+    (first,rows), where first is the number of the first measurement in the
+    burst and rows has one parsed measurement per row.
+    stats() returns counts of bytes, packets, handshakes and so on, and the
+    round trip times per controller; lc.metrics.serve(port) publishes them
+    over HTTP for Prometheus. messageBuffer keeps the last
+    messageBufferLength packets in and out.
     '''
     def __init__(self,port=False,verbose=False):
         if str(type(port))=="<class 'str'>":
             self.arduinoPort=port
         else:
             self.arduinoPort=""
-        self.messageBuffer=[] #log of input/output
-        self.received=[] #array of received serial packets
-        self.buffer="" #preencapsulated serial string
-        self.controllers=[]
-        self.bufferLength=256
         self.messageBufferLength=1000 #maximum number of messages to save
+        self.messageBuffer=collections.deque(maxlen=self.messageBufferLength) #log of input/output, oldest dropped first
+        self.received=collections.deque() #received serial packets no controller has claimed
+        self.queues={} #header -> deque of received packets for the controllers using that header
+        self.nameIndex={} #controller name -> controller
+        self.buffer=bytearray() #preencapsulated serial bytes, reused between reads
+        self.arrivedAt=None #time.time_ns() of the latest read that got anything
+        self.arrivedMono=None #and its time.monotonic_ns()
+        self.clock=ClockSync() #how the board's clock runs against ours, see syncClock
+        self.clockSyncSeconds=60 #how often to read the board's clock, if it has "rtc"; 0 for never
+        self.nextClockSync=0
+        self.clockController=MCClock()
+        self.controllers=[]
+        self.bufferLength=4096 #longest unterminated packet kept before it is discarded; burst dumps run past 1000 bytes
         self.firstFlag=1
         self.updateSec=1 #affects serial timeout
         self.mode=0
         self.verbose=verbose
         self.instrumentVersion=""
+        self.capabilities=[] #optional features the board listed in its handshake
+        self.useBinary=True #ask for binary frames if the board can send them
+        self.binary=False #True once the board has agreed to binary frames
+        self.window=4 #most requests outstanding at the board at once
+        self.requestTimeout=1.0 #seconds before an outstanding request is given up on
+        self.inflight=collections.deque() #requests sent, oldest first
+        self.backlog=collections.deque() #requests waiting for room in the window
+        self.rtt={} #controller name -> latest round trip time in seconds
+        self.port="" #the port currently open
+        self.lastPort="" #the last port a handshake came from
+        self.portGlobs=[] #extra places to look for ports, such as "/dev/serial/by-id/*"
+        self.portCache=[]
+        self.portCacheTime=-1e9
+        self.portCacheSeconds=1
+        self.knownPorts=set()
+        self.silentPorts=set() #ports that were opened but never gave a handshake
+        self.handshakeTimeout=3 #seconds to wait for a handshake before trying elsewhere
+        self.handshakeRetry=0.5 #seconds between handshake attempts, when tick is left to nextDeadline
+        self.hotplugSeconds=2 #how often to look for new ports when there is no connection, likewise
+        self.idleSeconds=60 #longest nextDeadline will put things off when nothing is due
+        self.openedAt=0
+        self.retryDelayMin=0.5 #seconds between rounds of failed connection attempts, to begin with
+        self.retryDelayMax=30
+        self.retryDelay=self.retryDelayMin
+        self.nextAttempt=0
+        self.metrics=SOGSMetrics.Metrics()
+        self.metrics.gauge("mode",lambda:self.mode)
+        self.metrics.gauge("requests_inflight",lambda:len(self.inflight))
+        self.metrics.gauge("requests_waiting",lambda:len(self.backlog))
+        self.metrics.gauge("packets_unclaimed",lambda:len(self.received))
+        self.metrics.gauge("clock_offset_seconds",lambda:(self.clock.wallOffset() or 0)/1e9)
+        self.metrics.gauge("clock_drift_ppm",lambda:self.clock.driftPpm() or 0)
         self.loadControllers()
     def loadControllers(self):
         for c in controllerList:
-            self.controllers.append(c)
+            self.loadController(c)
     def loadController(self,c):
         self.controllers.append(c)
+        #the first controller loaded under a name wins, as the scan used to.
+        self.nameIndex.setdefault(c.name,c)
+        if c.header not in self.queues:
+            self.queues[c.header]=collections.deque()
     def clearControllers(self):
         self.controllers=[]
+        self.nameIndex={}
+        #packets that were already sorted are handed back to the unclaimed queue.
+        for q in self.queues.values():
+            self.received.extend(q)
+        self.queues={}
     def listControllers(self):
         for c in self.controllers:
             print(c.name+":")
@@ -124,132 +425,420 @@ class LairCom:
             #is not established. if it stays in this state indefinitely then
             #possibly the arduino isn't responding correctly.
             self.serialFeel()
+            if self.mode==1 and self.portsAdded()==True:
+                #a board may just have been plugged in, go and look.
+                self.ch.close()
+                self.mode=0
+            elif self.mode==1 and time.monotonic()-self.openedAt>self.handshakeTimeout:
+                #probably not a board at all, try the next port.
+                print("No handshake on "+self.port)
+                self.metrics.count("handshake_timeouts")
+                self.silentPorts.add(self.port)
+                self.ch.close()
+                self.mode=0
+                self.nextAttempt=time.monotonic()+self.retryDelay
+                self.retryDelay=min(self.retryDelay*2,self.retryDelayMax)
         if self.mode==2:
             #mode 2 is the main mode for communication back and forth.
             self.main()
-        if len(self.messageBuffer)>self.messageBufferLength:
-            #snip off the oldest message to save memory.
-            self.messageBuffer=self.messageBuffer[1:]
+    def stats(self):
+        #a snapshot of the counters, gauges and histograms in self.metrics.
+        return self.metrics.stats()
+    def nextDeadline(self):
+        #returns the time.monotonic() by which tick must next be called, if
+        #it is also called whenever data arrives on the port. A loop can
+        #sleep until then instead of ticking all the time.
+        now=time.monotonic()
+        if self.mode==0:
+            return min(max(self.nextAttempt,now),now+self.hotplugSeconds)
+        if self.mode==1:
+            return min(now+self.handshakeRetry,self.openedAt+self.handshakeTimeout+0.001)
+        if len(self.backlog)>0 and len(self.inflight)<self.window:
+            return now
+        deadline=now+self.idleSeconds
+        if self.clockSyncSeconds>0 and "rtc" in self.capabilities:
+            deadline=min(deadline,max(now,self.nextClockSync))
+        for r in self.inflight:
+            if r.state==1:
+                deadline=min(deadline,r.sent+r.timeout)
+            else:
+                deadline=min(deadline,r.sent+2*r.timeout)
+        return deadline
     def main(self):
         self.serialGet()
+        self.expireRequests()
+        self.sendRequests()
+        if self.clockSyncSeconds>0 and "rtc" in self.capabilities and time.monotonic()>=self.nextClockSync:
+            self.syncClock()
+    def syncClock(self):
+        #reads the board's clock, adding a sample to self.clock when the
+        #reply comes. main() does this every clockSyncSeconds.
+        self.nextClockSync=time.monotonic()+self.clockSyncSeconds
+        return self.submitRequest(PendingRequest(self.clockController,self.clockSample,self.requestTimeout))
+    def clockSample(self,r):
+        p=r.packet
+        if r.state!=2 or r.result==None or getattr(p,"mono",None)==None:
+            return
+        rtt=p.mono-int(r.sent*1e9)
+        self.clock.add(p.mono-rtt//2,r.result,rtt)
+        self.metrics.observe("clock_rtt_seconds",rtt/1e9)
     def get(self,name):
         #checks the recieved buffer, if controller name can be used on a packet
         #it is summoned and the processed packet is returned as some kind of object.
-        out=""
-        if len(self.received)>0:
-            c=self.scanControllers(name)
-            if c==False:
-                print("Name "+name+" does not belong to any installed controller")
-                return False
-            for r in self.received:
-                if r[0:2]==c.header:
-                    #the packet is destined for controller c.
-                    out=c.parsePacketToData(r[2:])
-                    self.received.remove(r) #snip this out of the list
-                    break
-            if out==False:
-                print("Packet "+r+" was parsed and evaluated false.")
-                return False
-        else:
+        return self.getStamped(name)[0]
+    def getStamped(self,name):
+        #as get, but returns (data, arrived, mono): when the packet was read
+        #off the port by time.time_ns() and time.monotonic_ns() (see Packet),
+        #or None if that isn't known. data is False, as from get, if there
+        #is nothing.
+        c=self.scanControllers(name)
+        if c==False:
+            print("Name "+name+" does not belong to any installed controller")
+            return (False,None,None)
+        q=self.queues[c.header]
+        if len(q)==0:
             if self.verbose==True:
                 print("No packets available")
-            return False
-        if out=="":
-            return False
-        return out
+            return (False,None,None)
+        r=q.popleft()
+        out=self.parsePacket(c,r)
+        if out==False:
+            print("Packet "+r+" was parsed and evaluated false.")
+            return (False,None,None)
+        return (out,getattr(r,"arrived",None),getattr(r,"mono",None))
     def req(self,name):
+        #asks for a measurement whose reply is collected with get(name).
         if self.mode>=1:
-            for c in self.controllers:
-                if c.checkName(name):
-                    out=self.serialPut(c.req())
-                    return out
+            r=self.submit(name,queued=True)
+            if r!=False:
+                return r.state!=4
+            return False
+    def submit(self,name,callback=None,timeout=None,queued=False):
+        #asks for a measurement, returning a PendingRequest that is completed
+        #when the reply arrives. If queued is True the reply is left for
+        #get(name) instead of being parsed into the request.
+        c=self.scanControllers(name)
+        if c==False:
             print("argument was not recognized as a valid command.")
             return False
+        if timeout==None:
+            timeout=self.requestTimeout
+        return self.submitRequest(PendingRequest(c,callback,timeout,queued))
+    def submitRequest(self,r):
+        #queues a PendingRequest made elsewhere, see burst and dump.
+        self.backlog.append(r)
+        self.sendRequests()
+        return r
+    def burstController(self,name):
+        c=self.scanControllers(name)
+        if c==False or c.header not in ["M0","M1"]:
+            print(name+" can't be sampled in bursts.")
+            return False
+        return c
+    def burst(self,name,count,interval,callback=None,timeout=None):
+        #has the board take count measurements with controller name, interval
+        #seconds apart, and keep them until dump(name) is called. Up to 4095
+        #measurements and 65 seconds. The PendingRequest returned is finished
+        #when the board confirms, with result set to the count it will take.
+        c=self.burstController(name)
+        if c==False:
+            return False
+        if timeout==None:
+            timeout=self.requestTimeout
+        bank=c.header[1]
+        command="N"+bank+numberToAlphahex(min(count,4095),3)+numberToAlphahex(min(int(round(interval*1000)),65535),4)
+        return self.submitRequest(PendingRequest(c,callback,timeout,command=command,header="N"+bank,parser=lambda c,p:alphahexToUnsigned(p[2:5])))
+    def dump(self,name,callback=None,timeout=None):
+        #fetches and clears the burst measurements the board has taken so
+        #far. The result is (first,rows) as parseDump gives.
+        c=self.burstController(name)
+        if c==False:
+            return False
+        if timeout==None:
+            timeout=self.requestTimeout
+        bank=c.header[1]
+        return self.submitRequest(PendingRequest(c,callback,timeout,command="D"+bank,header="D"+bank,parser=self.parseDump))
+    def parseDump(self,c,packet):
+        #decodes a whole burst dump in one pass. Returns (first,rows): the
+        #number of the first measurement in the burst, and the measurements
+        #parsed by c as an array with parseCountsToArray, or a list of
+        #parseCountsToData results without numpy.
+        if isinstance(packet,BinaryPacket):
+            first=struct.unpack_from("<H",packet.data)[0]
+            counts=unpackSamplesBlock(packet.data[2:])
+        else:
+            first=alphahexToUnsigned(packet[2:6])
+            counts=alphahexBlockToCounts(packet[6:])
+        if np is None:
+            return first,[c.parseCountsToData(n) for n in counts]
+        if len(counts)==0:
+            return first,np.empty((0,len(c.nullData())))
+        return first,c.parseCountsToArray(counts)
+    def sendRequests(self):
+        #sends waiting requests while there is room in the window.
+        while len(self.backlog)>0 and len(self.inflight)<self.window and self.mode>=1:
+            r=self.backlog.popleft()
+            r.sent=time.monotonic()
+            r.state=1
+            self.inflight.append(r)
+            if self.serialPut(r.command)==False:
+                return
+    def expireRequests(self):
+        #gives up on requests that have waited too long. They stay in
+        #inflight for as long again to catch a late reply, then go for good.
+        now=time.monotonic()
+        for r in list(self.inflight):
+            if now-r.sent>r.timeout:
+                if r.state==1:
+                    self.metrics.count("request_timeouts")
+                    r.finish(3,now)
+                if now-r.sent>2*r.timeout:
+                    self.inflight.remove(r)
+    def failRequests(self):
+        #called when the connection goes; nothing outstanding will be answered.
+        now=time.monotonic()
+        for r in list(self.inflight)+list(self.backlog):
+            if r.state<2:
+                self.metrics.count("request_failures")
+                r.finish(4,now)
+        self.inflight.clear()
+        self.backlog.clear()
+    def matchRequest(self,packet):
+        #Returns True if packet answers an outstanding request and has been
+        #dealt with. The request is the oldest one with the packet's header.
+        header=packet[0:2]
+        for r in self.inflight:
+            if r.header==header:
+                self.inflight.remove(r)
+                now=time.monotonic()
+                if r.state==3:
+                    if self.verbose==True:
+                        print("late reply thrown away >"+packet)
+                    self.metrics.count("late_replies")
+                    return True
+                self.rtt[r.controller.name]=now-r.sent
+                self.metrics.histogram("request_latency_seconds",(("controller",r.controller.name),)).observe(now-r.sent)
+                if r.queued==True:
+                    r.finish(2,now)
+                    return False
+                r.packet=packet
+                if r.parser!=None:
+                    r.result=r.parser(r.controller,packet)
+                else:
+                    r.result=self.parsePacket(r.controller,packet)
+                r.finish(2,now)
+                return True
+        return False
+    def parsePacket(self,c,packet):
+        #parses a packet with controller c, whichever way it was sent.
+        if isinstance(packet,BinaryPacket):
+            return c.parseFrameToData(packet.data)
+        return c.parsePacketToData(packet[2:])
     def scanControllers(self,name):
         #returns a measurecontroller with that name, or False if none are found.
-        out=False
-        for c in self.controllers:
-            if c.checkName(name):
-                out=c
-                break
-        return out
+        return self.nameIndex.get(name,False)
     def serialOpen(self):
-        #This code scans com ports and opens serial connections. If you
+        #This code looks for serial ports and opens a connection. If you
         #are planning on multiple serial objects, this code will need revising
         #as it assumes there is only an arduino attached to the computer, an
         #assumption that will have to be fixed.
-        
-        #if you know the specific port of the arduino, set it here first.
-        try:
-            self.ch=serial.Serial(self.arduinoPort,9600,timeout=(self.updateSec)/100) #serial channel
-            self.mode=1
-            print("Opened connection to "+self.arduinoPort)
+        #Only ports that actually exist are tried, see listPorts. After a round
+        #of failures the next round is put off, twice as long each time up to
+        #retryDelayMax seconds, unless a new port turns up in the meantime.
+        now=time.monotonic()
+        ports=self.listPorts()
+        self.portsAdded()
+        if now<self.nextAttempt:
             return
-        except serial.serialutil.SerialException as err:
-            self.mode=0
-        i=0
-        #windows code
-        for i in range(0,256):
-            try:
-                self.ch=serial.Serial("COM"+str(i),9600,timeout=(self.updateSec)) #serial channel
-                self.mode=1
-                print("Opened connection to COM"+str(i))
-                #self.feelSerial()
-                return
-            except serial.serialutil.SerialException as err:
-                self.mode=0
-        #linux code
-        for i in range(0,255):
+        #if you know the specific port of the arduino, set it here first.
+        #After that, the port that worked last time. Ports that didn't answer
+        #the handshake last time go to the back of the queue.
+        candidates=[]
+        for port in [self.arduinoPort,self.lastPort]+ports:
+            if port!="" and port not in candidates and port not in self.silentPorts:
+                candidates.append(port)
+        for port in self.silentPorts:
+            if port not in candidates:
+                candidates.append(port)
+        for port in candidates:
             try:
-                self.ch=serial.Serial("/dev/ttyUSB"+str(i),9600,timeout=(self.updateSec)) #serial channel
+                if port==self.arduinoPort:
+                    self.ch=serial.Serial(port,9600,timeout=(self.updateSec)/100) #serial channel
+                else:
+                    self.ch=serial.Serial(port,9600,timeout=(self.updateSec)) #serial channel
                 self.mode=1
-                print("Opened connection to /dev/ttyUSB"+str(i))
-                #self.feelSerial()
+                self.port=port
+                self.openedAt=now
+                #leftovers from the last port mustn't pass for a handshake.
+                del self.buffer[:]
+                self.received.clear()
+                self.binary=False
+                self.retryDelay=self.retryDelayMin
+                print("Opened connection to "+port)
+                self.metrics.count("port_opens")
                 return
             except serial.serialutil.SerialException as err:
                 self.mode=0
+        self.metrics.count("open_failures")
+        self.nextAttempt=now+self.retryDelay
+        self.retryDelay=min(self.retryDelay*2,self.retryDelayMax)
+    def listPorts(self):
+        #returns the names of the serial ports on this computer, plus any
+        #files matching self.portGlobs. USB adapters come first and built in
+        #ports last. The list is only refreshed every portCacheSeconds.
+        now=time.monotonic()
+        if now-self.portCacheTime<self.portCacheSeconds:
+            return self.portCache
+        ports=[]
+        others=[]
+        try:
+            for p in serial.tools.list_ports.comports():
+                if p.vid!=None:
+                    ports.append(p.device)
+                else:
+                    others.append(p.device)
+        except OSError:
+            pass
+        for g in self.portGlobs:
+            ports+=sorted(glob.glob(g))
+        ports+=others
+        self.portCache=ports
+        self.portCacheTime=now
+        return ports
+    def portsAdded(self):
+        #returns True if a port has turned up since the last call, in which
+        #case the next serialOpen happens straight away and tries every port.
+        ports=set(self.listPorts())
+        added=len(ports-self.knownPorts)>0
+        self.knownPorts=ports
+        if added==True:
+            self.nextAttempt=0
+            self.silentPorts=set()
+        return added
+    def serialClose(self):
+        #lets go of a port that has stopped working, and makes the next
+        #serialOpen happen straight away.
+        try:
+            self.ch.close()
+        except (AttributeError,OSError):
+            pass
+        self.portCacheTime=0
+        self.retryDelay=self.retryDelayMin
+        self.nextAttempt=0
     def serialFeel(self):
         #This code feels for a handshake.
+        self.metrics.count("handshake_attempts")
         self.serialPut('VV')
         self.serialGet()
-        out=self.getReceived()
+        q=self.queues.get('VV')
+        if q:
+            #an MCVersion controller has been loaded and claims the reply.
+            out=q.popleft()
+        else:
+            out=self.getReceived()
         if out[0:2]=='VV':
-            #retrieve board version
-            self.instrumentVersion=out[2:]
+            #retrieve board version, followed by any capabilities after a ;
+            tags=out[2:].split(";")
+            self.instrumentVersion=tags[0]
+            self.capabilities=tags[1].split(",") if len(tags)>1 else []
+            self.clock=ClockSync() #it may be another board
+            self.nextClockSync=0
+            self.lastPort=self.port
             print("Handshake received from board "+self.instrumentVersion)
+            if self.metrics.counters.get("handshakes",0)>0:
+                self.metrics.count("reconnects")
+            self.metrics.count("handshakes")
             self.mode=2
+            if self.useBinary==True and "bin" in self.capabilities:
+                #the board answers BB1 and sends binary frames from then on.
+                self.serialPut("BB1")
     def serialGet(self):
-        #waits for a packeted (ends with chr(13)) string to be
-        #sent over serial. unpacketed data is added to self.buffer, completed
-        #packets are added to the list self.received.
-        snag=0
-        begun=0
+        #reads everything waiting on the serial port in one go. Unpacketed
+        #data stays in self.buffer, completed packets (ending with chr(13))
+        #are decoded once each and sorted by header into self.queues, or
+        #self.received if no loaded controller uses that header.
+        got=0
         try:
-            while(snag==0):# and len(buffer)<self.bufferLength):
-                if self.ch.inWaiting()>0:
-                    #the way python handles strings and characters is flat-out
-                    #fucking insane. Just so you know.
-                    c_buffer=self.ch.read(1)
-                    s_buffer=str(c_buffer)
-                    #if s_buffer[2:6]=="\\x02":
-                    begun=1
-                    if begun==1:
-                        if s_buffer[2:4]=="\\r":
-                            #self.buffer=self.buffer[1:]#snip
-                            if self.verbose==True:
-                                print("packet received >"+self.buffer)
-                            self.received.append(self.buffer)
-                            self.messageBuffer.append((self.buffer,1))
-                            self.buffer=""
-                            self.begun=0
-                        else:
-                            self.buffer=self.buffer+s_buffer[2:3]
-                            #if there's a char error (ie a non printed character), you'll just get a slash.
-                else:
-                    snag=1
+            waiting=self.ch.in_waiting
+            while waiting>0:
+                self.buffer+=self.ch.read(waiting)
+                got+=waiting
+                waiting=self.ch.in_waiting
         except IOError:
             print("Connection lost",2)
-            mode=0
+            self.metrics.count("disconnects")
+            self.mode=0
+            self.serialClose()
+            self.failRequests()
+            return
+        if got==0:
+            return
+        self.arrivedMono=time.monotonic_ns()
+        self.arrivedAt=time.time_ns()
+        self.metrics.count("bytes_in",got)
+        packets=0
+        start=0
+        end=self.buffer.find(b"\r")
+        while end>-1 or self.binary:
+            if self.binary:
+                #text packets and binary frames are mixed; take whichever
+                #comes first.
+                frame=self.buffer.find(slipEnd,start)
+                if frame>-1 and (end==-1 or frame<end):
+                    stop=self.buffer.find(slipEnd,frame+1)
+                    if stop==-1:
+                        start=frame #the rest of the frame is still to come.
+                        break
+                    if stop==frame+1:
+                        #two END bytes in a row, the second may start a frame.
+                        start=stop
+                    else:
+                        self.frameGet(self.buffer[frame+1:stop])
+                        packets+=1
+                        start=stop+1
+                    end=self.buffer.find(b"\r",start)
+                    continue
+                if end==-1:
+                    break
+            #non-ascii characters come out as the unicode replacement character.
+            packet=Packet(self.buffer[start:end].decode("ascii","replace"),self.arrivedAt,self.arrivedMono)
+            if packet[0:2]=="BB":
+                self.binary=packet[2:3]=="1"
+            self.packetGet(packet)
+            packets+=1
+            start=end+1
+            end=self.buffer.find(b"\r",start)
+        self.metrics.count("packets_in",packets)
+        if start>0:
+            del self.buffer[:start]
+        if len(self.buffer)>self.bufferLength:
+            #no terminator in sight, this is line noise rather than a packet.
+            if self.verbose==True:
+                print("discarding "+str(len(self.buffer))+" unterminated bytes")
+            self.metrics.count("bytes_discarded",len(self.buffer))
+            del self.buffer[:]
+    def frameGet(self,frame):
+        #handles the bytes between two END bytes.
+        f=parseFrame(frame)
+        if f==None:
+            self.metrics.count("frames_malformed")
+            if self.verbose==True:
+                print("damaged frame thrown away")
+            return
+        self.packetGet(BinaryPacket(f[0],f[1],self.arrivedAt,self.arrivedMono))
+    def packetGet(self,packet):
+        #logs a received packet and passes it to whatever is waiting for it.
+        if self.verbose==True:
+            print("packet received >"+packet)
+        self.messageBuffer.append((packet,1))
+        if len(self.inflight)>0 and self.matchRequest(packet):
+            pass
+        else:
+            q=self.queues.get(packet[0:2])
+            if q is None:
+                self.received.append(packet)
+            else:
+                q.append(packet)
     def serialPut(self,s):
         #This function should be called when sending serial commands!
         #it encapsulates the packets properly.
@@ -257,23 +846,24 @@ class LairCom:
         out=s+str(chr(13))
         #s#=str(chr(2))+s+str(chr(13))
         try:
-            self.ch.write(out.encode())
+            b=out.encode()
+            self.ch.write(b)
             self.messageBuffer.append((s,0))
+            self.metrics.count("bytes_out",len(b))
+            self.metrics.count("packets_out")
             return True
         except serial.serialutil.SerialException as err:
             self.mode=0
             print('connection terminated')
+            self.metrics.count("disconnects")
+            self.serialClose()
+            self.failRequests()
             return False
     def getReceived(self):
         #does not scan the messageBuffer.
-        #Returns the oldest received packet, and erases it from the queue.
+        #Returns the oldest unclaimed packet, and erases it from the queue.
         if len(self.received)>0:
-            s=self.received[0]
-            if len(self.received)>1:
-                self.received=self.received[1:]
-            else:
-                self.received=[]
-            return s
+            return self.received.popleft()
         else:
             return ""
     def stampID(self,s):
@@ -288,6 +878,38 @@ class LairCom:
             pass
             
 
+class PendingRequest:
+    #A measurement request made with LairCom.submit. state is 0 while it
+    #waits to be sent, 1 once sent, 2 when answered, 3 if it timed out and
+    #4 if the connection went first. command is what is sent to the board
+    #and header is that of the reply, both the controller's own by default;
+    #parser(controller,packet) parses the reply instead of the controller.
+    def __init__(self,controller,callback=None,timeout=1.0,queued=False,command=None,header=None,parser=None):
+        self.controller=controller
+        self.command=controller.req() if command==None else command
+        self.header=controller.header if header==None else header
+        self.parser=parser
+        self.callback=callback
+        self.timeout=timeout
+        self.queued=queued
+        self.state=0
+        self.sent=None #time.monotonic() when it went to the board
+        self.arrived=None #time.monotonic() when it was finished with
+        self.packet=""
+        self.result=None
+    def done(self):
+        return self.state>=2
+    def latency(self):
+        #round trip time in seconds, or None if it hasn't been answered.
+        if self.state!=2:
+            return None
+        return self.arrived-self.sent
+    def finish(self,state,now):
+        self.state=state
+        self.arrived=now
+        if self.callback!=None:
+            self.callback(self)
+
 class MeasureController:
     #A controller
     def __init__(self):
@@ -314,12 +936,32 @@ class MeasureController:
     def parsePacketToData(self,packet):
         #parse the contents of a packet and return it to the calling function in whatever format
         return 0
+    def parseFrameToData(self,payload):
+        #parse the payload of a binary frame, as parsePacketToData does
+        #the text of a packet.
+        return 0
+    def parsePacketsToArray(self,packets):
+        #parses a list of packets in one go, for example when backfilling
+        #logged raw packets. Returns a numpy array with a row per packet, or a
+        #list of parsePacketToData results when numpy isn't installed.
+        out=[self.parsePacketToData(p) for p in packets]
+        if np is None:
+            return out
+        return np.array(out,dtype=float)
     def parseDataToString(self,data,delin):
         #converts measurement data made with this controller into a string.
         return ""
     def parseStringToData(self,s,delin):
         #converts a string s into data
         return 0
+    def parseTagsToData(self,tags):
+        #converts the data tags of a saved m line, already split up, into
+        #data. Controllers that can should do this without rejoining them.
+        return self.parseStringToData("/".join(tags),"/")
+    def dataWidth(self):
+        #how many floats this controller's data holds, or 0 if it isn't a
+        #list of floats. RecordParser only takes controllers with a width.
+        return 0
     def nullData(self):
         #returns null data
         return 0
@@ -333,20 +975,39 @@ class MCV0(MeasureController):
         self.desc="Returns a list of eight voltages from bank 0"
     def parsePacketToData(self,packet):
     #returns voltages for now.
+        return self.parseCountsToData(alphahexToCounts(packet))
+    def parseFrameToData(self,payload):
+        return self.parseCountsToData(unpackSamples(payload))
+    def parsePacketsToArray(self,packets):
+        if np is None or len(packets)==0:
+            return [self.parsePacketToData(p) for p in packets]
+        return self.parseCountsToArray(alphahexPacketsToCounts(packets))
+    def parseFramesToArray(self,payloads):
+        #the same as parsePacketsToArray for a list of binary frame payloads.
+        if np is None or len(payloads)==0:
+            return [self.parseFrameToData(p) for p in payloads]
+        return self.parseCountsToArray(unpackSamplesArray(payloads))
+    def parseCountsToData(self,counts):
+        #converts the eight ADC counts of a packet into data.
         v=[]
-        for i in range(0,8):
-            v.append(alphahexToNumber(packet[i*3:(i*3+3)],3)/204.8)
+        for n in counts:
+            v.append(n/204.8)
         return v
+    def parseCountsToArray(self,counts):
+        #the same as parseCountsToData for an (N,8) array of counts.
+        return counts/204.8
     def parseDataToString(self,data,delin):
         #The data argument should be from the data field of a Measurement object
         out=str(data[0])+delin+str(data[1])+delin+str(data[2])+delin+str(data[3])+delin+str(data[4])+delin+str(data[5])+delin+str(data[6])+delin+str(data[7])
         return out
     def parseStringToData(self,s,delin):
-        tags=chopString(s,delin,"")
-        out=[]
-        for t in tags:
-            out.append(float(t))
-        return out
+        if s=="":
+            return []
+        return [float(t) for t in s.split(delin)]
+    def parseTagsToData(self,tags):
+        return [float(t) for t in tags]
+    def dataWidth(self):
+        return len(self.nullData())
     def nullData(self):
         return [0,0,0,0,0,0,0,0]
     def dataID(self,delin):
@@ -367,28 +1028,40 @@ class MCGas(MCV1):
         return "Battery"+delin+"Pressure"+delin+"LDR"+delin+"CH(5524)"+delin+"NH3(5914)"+delin+"NO2(2714)"+delin+"CO(5525)"+delin+"O3(2610)"
 
 class MCTHB(MCV1):
+    #thermistor and humidity sensor calibration
+    T_Rinert=10000
+    T_R25=10000
+    T_a=-4.7
+    H_offset=0.826
+    H_slope=0.0315
     def __init__(self):
         self.header="M1"
         self.name="THB"
         self.desc="Returns approximate temperature, humidity and bus voltage ratings"
-    def parsePacketToData(self,packet):
+    def parseCountsToData(self,n):
     #returns voltages for now.
         v=[]
-        v.append((alphahexToNumber(packet[15:18],3)+(alphahexToNumber(packet[18:21],3)))/409.6)#temperature
-        v.append((alphahexToNumber(packet[3:6],3)+(alphahexToNumber(packet[6:9],3)))/409.6)#humidity
-        v.append((alphahexToNumber(packet[9:12],3)+(alphahexToNumber(packet[12:15],3)))/409.6)#bus
+        v.append((n[5]+n[6])/409.6)#temperature
+        v.append((n[1]+n[2])/409.6)#humidity
+        v.append((n[3]+n[4])/409.6)#bus
         #now v has voltages.
         #Let's convert this to calibrated values.
         out=[0,0,0]
         out[2]=v[2]#direct voltage reading
-        T_Rinert=10000
-        T_R25=10000
-        T_a=-4.7
         T_V=out[2]
-        out[0]=math.log(T_Rinert/T_R25*(T_V/v[1]-1))/math.log((100+T_a)/100)+298
-        H_offset=0.826
-        H_slope=0.0315
-        out[1]=(v[1]-H_offset)/H_slope
+        out[0]=math.log(self.T_Rinert/self.T_R25*(T_V/v[1]-1))/math.log((100+self.T_a)/100)+298
+        out[1]=(v[1]-self.H_offset)/self.H_slope
+        return out
+    def parseCountsToArray(self,n):
+        #Where the scalar version would raise on a log of a non-positive
+        #number, this gives nan or inf in that row instead.
+        humidity=(n[:,1]+n[:,2])/409.6
+        bus=(n[:,3]+n[:,4])/409.6
+        out=np.empty((len(n),3))
+        with np.errstate(divide="ignore",invalid="ignore"):
+            out[:,0]=np.log(self.T_Rinert/self.T_R25*(bus/humidity-1))/math.log((100+self.T_a)/100)+298
+        out[:,1]=(humidity-self.H_offset)/self.H_slope
+        out[:,2]=bus
         return out
     def parseDataToString(self,data,delin):
         #The data argument should be from the data field of a Measurement object
@@ -409,22 +1082,38 @@ class MCVersion(MeasureController):
         #This controller is particular to LAir; SOGS and Tinnitus will not be
         #recognized
         if packet[0:4]=="LAir":
-            out=packet[4:]
+            out=packet[4:].split(";")[0]
             out=out.strip()
             return out
         return False
     def nullData(self):
         return ""
 
+class MCClock(MeasureController):
+    #reads the board's clock, see LairCom.syncClock. Not loaded by default.
+    def __init__(self):
+        self.header="tG"
+        self.name="clock"
+        self.desc="Returns the board's clock in nanoseconds since 1970, see rtcToNs"
+    def parsePacketToData(self,packet):
+        return rtcToNs(packet)
+    def nullData(self):
+        return None
+
 class LairUI:
     #normal mode: runs a full ui, saves to file every two seconds,
-    def __init__(self,mode="normal",delay=2,ui="graph",saveDir="SOGSMeasurements",aggFile="SOGSAggregated",addAggDate=True,MCs=[]):
-        self.com=LairCom()
+    def __init__(self,mode="normal",delay=2,ui="graph",saveDir="SOGSMeasurements",aggFile="SOGSAggregated",addAggDate=True,MCs=[],incremental=False,runLength=10000,storage="files",storageOptions={},archive="",archiveType="f4",port=False,metricsPort=0,workers=1,align=None,gap="",threaded=True):
+        self.com=LairCom(port) #port, if given, is tried before any other
         self.updatems=30 #time between each tick function cal and ui update in milliseconds
         self.aggFile=aggFile #custom aggregation filename
         self.beginDate=datetime.datetime.now()
-        self.lastMeasureDate=self.beginDate
         self.addAggDate=addAggDate #boolean whether to add aggregation date onto the end of aggregate file.
+        self.incremental=incremental #only aggregate files that are new since the last run, see aggregateIncremental.
+        self.runLength=runLength #rows held in memory at once by an incremental aggregation
+        self.workers=workers #processes a full aggregation is shared among, None for one per core. See aggregateParallel.
+        self.align=align #seconds apart measurements may be and still share an aggregate row, see aggregateAligned. None to not align.
+        self.gap=gap #what an aligned aggregate file has in the fields of a missing measurement
+        self.aggDel=",\t" #aggregate file delineator
         if MCs==[]:
             self.MCs=[]
             for c in self.com.controllers:
@@ -433,6 +1122,9 @@ class LairUI:
             self.MCs=MCs
         self.measList=[False]*len(self.MCs) #measurement list, false when not filled with a Measurement object
         self.measureDelay=delay #time between measurements in seconds
+        self.nextMeasure=time.monotonic()+delay #when the next one is due, by time.monotonic()
+        self.measCount=0 #how many of measList are filled
+        self.shownMode=None #the connection mode last shown in the ui
         if ui=="graph":
             self.uid=0
             self.gui=GraphGUI()
@@ -448,18 +1140,51 @@ class LairUI:
         else:
             self.save=True
             self.dir=saveDir
+        #storage="files" saves a new file per measurement cycle, "segments"
+        #appends them to rolling segment files. storageOptions are passed on to
+        #SOGSStorage.SegmentWriter.
+        self.writer=None
+        if storage=="segments" and self.dir!="":
+            self.writer=SOGSStorage.SegmentWriter(self.dir,**storageOptions)
+        #archive names a directory for binary archives, one per controller,
+        #written alongside the text files. "" for none.
+        self.archive=archive
+        self.archiveType=archiveType #f4 or f8
+        self.archives={}
+        #LairUI's own figures go in with LairCom's. Give metricsPort to
+        #serve them all for Prometheus at http://127.0.0.1:metricsPort/metrics
+        self.metrics=self.com.metrics
+        if metricsPort!=0:
+            self.metrics.serve(metricsPort)
+        #With a ui and threaded, the board is looked after by a thread of its
+        #own running headlessMain, which owns self.com and the storage. It
+        #hands the ui what to show through self.events, and the tk thread
+        #only ever takes from there, see uiMain. Otherwise tk calls
+        #normalMain itself, as it used to.
+        self.threaded=threaded and self.uid!=-1
+        self.events=queue.Queue() #(gui method name, arguments) for the tk thread
+        self.acquisition=None #the thread, while it runs
+        self.stopping=threading.Event()
+        self.wake=None #a socketpair written to to wake headlessMain early, while it runs
+        self.metrics.gauge("ui_events_waiting",self.events.qsize)
         if mode=="normal":
-            if self.uid!=-1:
+            if self.threaded:
+                self.startAcquisition()
+                self.uiMain()
+                self.gui.master.mainloop()
+                self.stopAcquisition()
+            elif self.uid!=-1:
                 self.normalMain()
                 self.gui.master.mainloop()
             else:
                 try:
-                    while True:
-                        self.normalMain()
+                    self.headlessMain()
                 except KeyboardInterrupt:
                     print("beendet")
+            self.closeStorage()
             if aggFile!="" and saveDir!="":
                 self.aggregate()
+            self.metrics.close()
         if mode=="null":
             print("Null mode: no loop engaged")
         if mode=="aggregate":
@@ -468,225 +1193,791 @@ class LairUI:
                 self.aggregate()
             else:
                 print("The aggFile and saveDir arguments must not be an empty string for this mode to work")
+        if mode=="archive":
+            if archive!="" and saveDir!="":
+                print("Converting files to binary archives")
+                self.archiveConvert()
+            else:
+                print("The archive and saveDir arguments must not be an empty string for this mode to work")
     def normalMain(self):
-        if self.uid==-1:
-            time.sleep(self.updatems/1000)
+        #one pass of the main loop. The graphical interfaces have tk call it
+        #again every updatems milliseconds.
         self.com.tick()
-        if self.com.mode==0:
-            self.gui.log("No connection",2)
-        if self.com.mode==1:
-            self.gui.log("Serial open, awaiting handshake",2)
-        if self.com.mode==2:
-            self.gui.log("Connected to board ID "+self.com.instrumentVersion,2)
+        mode=self.com.mode
+        if mode!=self.shownMode:
+            self.shownMode=mode
+            if mode==0:
+                self.show("log","No connection",2)
+            if mode==1:
+                self.show("log","Serial open, awaiting handshake",2)
+            if mode==2:
+                self.show("log","Connected to board ID "+self.com.instrumentVersion,2)
+        if mode==2:
             #check measurement interval
-            if (self.lastMeasureDate+datetime.timedelta(seconds=self.measureDelay))<datetime.datetime.now():
+            now=time.monotonic()
+            if now>=self.nextMeasure:
                 #If there are any unrecorded measurements, save them now.
-                #print("New measurement")
-                snag=False
-                okay=False
-                for mci in self.measList:
-                    if mci==False:
-                        snag=True
-                    else:
-                        okay=True
-                #if there are some unrecorded, save.
-                if snag==True and okay==True:
-                    #print("Saving partial data file; maybe measurement delay is too low?")
-                    for mci in range(len(self.MCs)):
-                        if self.measList[mci]==False:
-                            self.gui.log("<"+self.MCs[mci]+"> no data found")
-                        else:
-                            self.gui.log("<"+self.MCs[mci]+"> "+str(self.measList[mci].MC)+" SAVING: "+self.com.scanControllers(self.measList[mci].MC).parseDataToString(self.measList[mci].data,", "))
-                            #update the graph ui, if using gas< A DIRTY HACK
-                            if self.uid==0 and self.MCs[mci]=="gas":
-                                self.gui.bars.set_values(self.measList[mci].data)
-                    if self.dir!="":
-                        self.saveMeasurements()
-                    #empty the measurement array, ready for the next time.
-                    for mci in range(len(self.measList)):
-                        self.measList[mci]=False
+                if self.measCount>0:
+                    self.recordMeasurements()
                 #prepare to take a new measurement, send requests.
                 for mc in self.MCs:
                     h=self.com.req(mc)
-                self.lastMeasureDate=datetime.datetime.now()
-            #load any measurements received from the board
+                #keep to the schedule, unless it has fallen a whole interval behind.
+                self.nextMeasure+=self.measureDelay
+                if self.nextMeasure<now:
+                    self.nextMeasure=now+self.measureDelay
+            #load any measurements received from the board, timed by when
+            #they were read off the port.
             for mci in range(len(self.MCs)):
-                tmv=self.com.get(self.MCs[mci])
+                (tmv,stamp,mono)=self.com.getStamped(self.MCs[mci])
                 if tmv!=False and tmv!="":
-                    self.measList[mci]=Measurement(tmv,self.MCs[mci],datetime.datetime.now())
-            #check to see if the whole measurement array is populated
-            snag=False
-            for mci in self.measList:
-                if mci==False:
-                    snag=True
-            if snag!=True:
-                #if the measure array is populated, display/save all measurements.
-                for mci in range(len(self.MCs)):
-                    #print(mci)
-                    self.gui.log("<"+self.MCs[mci]+"> "+str(self.measList[mci].MC)+" SAVING: "+self.com.scanControllers(self.measList[mci].MC).parseDataToString(self.measList[mci].data,", "))
-                    #update the graph ui, if using gas< A DIRTY HACK
-                    if self.uid==0 and self.MCs[mci]=="gas":
-                        self.gui.bars.set_values(self.measList[mci].data)
-                if self.dir!="":
-                    self.saveMeasurements()
-                #empty the measurement array, ready for the next time.
-                for mci in range(len(self.measList)):
-                    self.measList[mci]=False
+                    if stamp==None:
+                        stamp=time.time_ns()
+                        mono=time.monotonic_ns()
+                    if self.measList[mci]==False:
+                        self.measCount+=1
+                    self.measList[mci]=Measurement(tmv,self.MCs[mci],localDatetime(stamp),self.com.clock.boardTime(mono),stamp)
+            #if the measure array is populated, display/save all measurements.
+            if self.measCount==len(self.MCs):
+                self.recordMeasurements()
         #Engage the tk.
-        if self.uid!=-1:
+        if self.uid!=-1 and self.threaded==False:
             self.gui.master.after(self.updatems,self.normalMain)
+    def recordMeasurements(self):
+        #displays and saves whatever is in measList, then empties it ready
+        #for the next time.
+        for mci in range(len(self.MCs)):
+            if self.measList[mci]==False:
+                self.show("log","<"+self.MCs[mci]+"> no data found")
+            else:
+                self.show("log","<"+self.MCs[mci]+"> "+str(self.measList[mci].MC)+" SAVING: "+self.com.scanControllers(self.measList[mci].MC).parseDataToString(self.measList[mci].data,", "))
+                #update the graph ui. It is drawn on the graph's next frame, not here.
+                if self.uid==0:
+                    self.show("plot",self.MCs[mci],self.measList[mci].data)
+        if self.dir!="":
+            self.saveMeasurements()
+        for mci in range(len(self.measList)):
+            self.measList[mci]=False
+        self.measCount=0
+    def headlessMain(self,seconds=None):
+        #runs normalMain without a ui, for seconds or until interrupted.
+        #Between passes it sleeps until the next thing is due: a measurement,
+        #a request timing out or a connection attempt, see
+        #LairCom.nextDeadline. Data arriving on the serial port wakes it early.
+        #Where the port can't be watched, as on windows, it looks every
+        #updatems milliseconds as well.
+        #stopAcquisition wakes it through self.wake.
+        own=self.wake==None #else startAcquisition made it and closes it
+        if own:
+            self.wakeOpen()
+        sel=selectors.DefaultSelector()
+        sel.register(self.wake[0],selectors.EVENT_READ)
+        watched=None
+        watchedFd=None #the port is registered by its fd, which a closed port can't give
+        stop=None if seconds==None else time.monotonic()+seconds
+        try:
+            while (stop==None or time.monotonic()<stop) and not self.stopping.is_set():
+                self.normalMain()
+                ch=self.com.ch if self.com.mode>=1 else None
+                if ch is not watched:
+                    if watched!=None:
+                        self.unwatch(sel,watchedFd)
+                        watched=None
+                    if ch!=None:
+                        try:
+                            watchedFd=ch.fileno()
+                            sel.register(watchedFd,selectors.EVENT_READ)
+                            watched=ch
+                        except (OSError,ValueError,AttributeError,KeyError):
+                            pass
+                deadline=self.com.nextDeadline()
+                if self.com.mode==2:
+                    deadline=min(deadline,self.nextMeasure)
+                if stop!=None:
+                    deadline=min(deadline,stop)
+                wait=deadline-time.monotonic()
+                if ch!=None and watched==None:
+                    wait=min(wait,self.updatems/1000)
+                if wait<=0:
+                    continue
+                try:
+                    sel.select(wait)
+                except (OSError,ValueError):
+                    #the port went away under us; tick will notice.
+                    if watched!=None:
+                        self.unwatch(sel,watchedFd)
+                        watched=None
+                try:
+                    self.wake[0].recv(64)
+                except (BlockingIOError,InterruptedError):
+                    pass
+        finally:
+            sel.close()
+            if own:
+                self.wakeClose()
+    def wakeOpen(self):
+        self.wake=socket.socketpair()
+        self.wake[0].setblocking(False)
+    def wakeClose(self):
+        for s in self.wake:
+            s.close()
+        self.wake=None
+    def unwatch(self,sel,fd):
+        #stops headlessMain watching a port's fd. The port may be closed by
+        #now and the fd gone or even reused, none of which matters here.
+        try:
+            sel.unregister(fd)
+        except (OSError,ValueError,KeyError):
+            pass
+    def startAcquisition(self):
+        #starts headlessMain on a thread of its own; see threaded in __init__.
+        self.stopping.clear()
+        self.wakeOpen()
+        self.acquisition=threading.Thread(target=self.acquireMain,name="LairUI acquisition",daemon=True)
+        self.acquisition.start()
+    def acquireMain(self):
+        try:
+            self.headlessMain()
+        except Exception as err:
+            self.show("log","Acquisition stopped: "+repr(err),2)
+            raise
+    def stopAcquisition(self):
+        #stops the acquisition thread and waits for it to finish what it is doing.
+        if self.acquisition!=None:
+            self.stopping.set()
+            self.wake[1].send(b"x")
+            self.acquisition.join()
+            self.acquisition=None
+            self.wakeClose()
+    def show(self,method,*args):
+        #calls a gui method, such as log or plot, on the tk thread. From the
+        #acquisition thread it is queued for uiMain.
+        if self.threaded:
+            self.events.put((method,args))
+        else:
+            getattr(self.gui,method)(*args)
+    def uiMain(self):
+        #hands the gui everything the acquisition thread has queued, then
+        #has tk call it again in updatems milliseconds.
+        while True:
+            try:
+                (method,args)=self.events.get_nowait()
+            except queue.Empty:
+                break
+            getattr(self.gui,method)(*args)
+        self.gui.master.after(self.updatems,self.uiMain)
+    def stats(self):
+        #a snapshot of the metrics, see LairCom.stats.
+        return self.metrics.stats()
     def saveMeasurements(self):
-        #Saves everything from the self.measList array into a new file.
+        #Saves everything from the self.measList array into a new file, or
+        #onto the end of the current segment.
+        started=time.perf_counter()
         dt=datetime.datetime.now()
-        if not os.path.exists(self.dir+'/'+dt.date().isoformat()):
-            os.makedirs(self.dir+"/"+dt.date().isoformat())
-        s=dt.time().isoformat().replace(":","-")
-        s=s.replace(".","_")
-        file=open(self.dir+"/"+dt.date().isoformat()+"/"+s+".txt","a+")
-        file.write("comment#\n")
-        file.write("delineator/\n")
-        file.write("#This is a data file for SOGS saved at date/time\n")
-        file.write("epoch/"+dt.date().isoformat()+"/"+dt.time().isoformat()+"\n")
-        file.write("kind/"+"SOGSdata"+"\n")
+        lines=[]
         for meas in self.measList:
             if meas!=False:
-                file.write("m/"+meas.MC+"/"+meas.dtToD()+"/"+meas.dtToT()+"/"+self.com.scanControllers(meas.MC).parseDataToString(meas.data,"/")+"\n")
-        file.close()
+                lines.append("m/"+meas.MC+"/"+meas.dtToD()+"/"+meas.dtToT()+"/"+self.com.scanControllers(meas.MC).parseDataToString(meas.data,"/"))
+                if meas.board!=None and meas.utc!=None:
+                    lines.append("rtc/"+meas.MC+"/"+str(meas.utc)+"/"+str(meas.board))
+        if self.archive!="":
+            for meas in self.measList:
+                if meas!=False:
+                    self.archiveWriter(meas.MC).write(meas.dt,meas.data)
+        if self.writer!=None:
+            self.writer.write(dt,lines)
+        else:
+            s=SOGSStorage.timeFileName(dt)
+            file=open(SOGSStorage.dayDirectory(self.dir,dt)+"/"+s+".txt","a+")
+            file.write("comment#\n")
+            file.write("delineator/\n")
+            file.write("#This is a data file for SOGS saved at date/time\n")
+            file.write("epoch/"+dt.date().isoformat()+"/"+dt.time().isoformat()+"\n")
+            file.write("kind/"+"SOGSdata"+"\n")
+            for line in lines:
+                file.write(line+"\n")
+            file.close()
+        self.metrics.count("saves")
+        self.metrics.observe("save_seconds",time.perf_counter()-started)
+    def archiveWriter(self,name,append=True):
+        #returns the binary archive writer for a controller, opening it on first use.
+        w=self.archives.get(name)
+        if w==None:
+            if not os.path.isdir(self.archive):
+                os.makedirs(self.archive)
+            c=self.com.scanControllers(name)
+            w=SOGSStorage.ArchiveWriter(self.archive+"/"+name+".sarc",name,c.dataID("/").split("/"),self.archiveType,append)
+            self.archives[name]=w
+        return w
+    def archiveConvert(self):
+        #Writes everything under the save directory into fresh binary
+        #archives, replacing any that are already there.
+        for path in SOGSStorage.measurementFiles(self.dir):
+            print("archiving "+path)
+            for (outdate,outtime,mtags) in SOGSStorage.readRecords(path):
+                for tags in mtags:
+                    c=self.com.scanControllers(tags[1])
+                    if c!=False:
+                        self.archiveWriter(c.name,False).write(tags[2]+"T"+tags[3],c.parseTagsToData(tags[4:]))
+        self.closeStorage()
+    def closeStorage(self):
+        #flushes and closes the segment writer and archives, if there are any.
+        if self.writer!=None:
+            self.writer.close()
+        for w in self.archives.values():
+            w.close()
+        self.archives={}
     def aggregate(self):
-        dirlist=os.walk(self.dir)
-        measurements=[[]] #A list of measurement lists!
-        outmeasurements=[[]] #A list of measurement lists!
-        for i in range(len(self.com.controllers)-1):
-            measurements.append([])
-            outmeasurements.append([])
-        for (aggpath1,scrap,aggpath2) in dirlist:
-            for aggpathc in aggpath2:
-                if aggpathc[-3:]=="txt":
-                    print("opening "+aggpath1+"/"+aggpathc)
-                    try:
-                        aggfile=open(aggpath1+"/"+aggpathc,"r")
-                        snag=0
-                        comment=""
-                        delin=""
-                        outkind=""
-                        outdate=""
-                        outtime=""
-                        out=[]#an array of measurements read from file
-                        tags=[]
-                        while snag==0:
-                            line=aggfile.readline()
-                            if line[-1:]=="\n":
-                                line=line[:-1] #strip off the newline character if there is one.
-                            if line=="":
-                                snag=1#exit file on empty line
-                            else:
-                                if comment=="" or delin=="":
-                                    if line[:-1]=="comment":
-                                        comment=line[-1:]
-                                    if line[:-1]=="delineator":
-                                        delin=line[-1:]
-                                else:
-                                    tags=chopString(line,delin,comment)
-                                    if len(tags)>0:
-                                        if tags[0]=="epoch":
-                                            outdate=str(tags[1])#default date and time
-                                            outtime=str(tags[2])
-                                            if len(out)==0:#don't fill this twice if you see two epochs for some reason.
-                                                for c in self.com.controllers:
-                                                    #fill the measurement array with null data
-                                                    out.append(Measurement(c.nullData(),c.name,outdate+"T"+outtime))
-                                        if tags[0]=="kind":
-                                            outkind=str(tags[1])
-                                        if tags[0]=="m":
-                                            #This is going to be somewhat complicated.
-                                            mc=-1
-                                            for c in range(len(self.com.controllers)):#Identify the controller being used
-                                                if self.com.controllers[c].checkName(tags[1]):
-                                                    mc=c
-                                            if mc!=-1: #Make a measurement from the file's data and add it to the out array.
-                                                ttags=tags[4:] #construct a temporary string containing all remaining tags
-                                                tstring=""
-                                                for t in range(len(ttags)):
-                                                    tstring+=ttags[t]+delin
-                                                tstring=tstring[:-1]
-                                                out[mc]=Measurement(self.com.controllers[mc].parseStringToData(tstring,delin),self.com.controllers[mc].name,tags[2]+"T"+tags[3])
-                                            else:
-                                                #your stuff wasn't recognized.
-                                                pass
-                        aggfile.close()
-                        if comment!='' and delin!='' and outkind=="SOGSdata":
-                            for c in range(len(out)):
-                                measurements[c].append(out[c])
-                        else:
-                            print("Unrecognized file: "+aggpath1+"/"+aggpathc)
-                    except UnicodeDecodeError:
-                        print("Unparseable character in file: "+aggpath1+"/"+aggpathc)
-                else:
-                    print("Skipped non-text file"+aggpath1+"/"+aggpathc)
-        #looks like I'm going to have to run sorted multiple times.
-        for c in range(len(self.com.controllers)):
-            outmeasurements[c]=sorted(measurements[c],key=lambda Measurement:Measurement.datetime())
+        #incremental, align and workers each choose a different way of
+        #aggregating, so only one of them may be given.
+        chosen=[name for (name,given) in [("incremental",self.incremental==True),("align",self.align!=None),("workers",self.workers!=1)] if given]
+        if len(chosen)>1:
+            raise ValueError("aggregate with one of "+", ".join(chosen)+", not all of them")
+        started=time.perf_counter()
+        if self.incremental==True:
+            self.aggregateIncremental()
+        elif self.align!=None:
+            self.aggregateAligned()
+        elif self.workers!=1:
+            self.aggregateParallel()
+        else:
+            self.aggregateFull()
+        self.metrics.observe("aggregate_seconds",time.perf_counter()-started)
+    def aggregateFull(self):
+        #A list of measurement lists! Each controller's is a column of
+        #(time,field) from aggregateShard, formatted from the saved text as
+        #it is read, so the file comes out the same as from
+        #aggregateParallel and aggregateIncremental, and no Measurements are
+        #kept.
+        paths=list(SOGSStorage.measurementFiles(self.dir))
+        print("aggregating "+str(len(paths))+" files")
+        outdel=self.aggDel
+        columns=aggregateShard(paths,self.com.controllers,outdel)
+        outfile=open(self.aggregateFileName(),'w')
+        self.writeAggregateHeader(outfile)
+        #aggregateShard fills in a controller missing from a cycle, so the
+        #columns are all as long as each other.
+        for row in zip(*columns):
+            outfile.write(outdel.join([m[1] for m in row])+"\n")
+        outfile.close()
+    def aggregateFileName(self):
         if self.addAggDate==True:
             s=datetime.datetime.now().isoformat().replace(":","-")
             s=s.replace(".","_")
-            outfile=open(self.aggFile+s+".csv",'w')
-        else:
-            outfile=open(self.aggFile+".csv",'w')
-        outdel=",\t"
+            return self.aggFile+s+".csv"
+        return self.aggFile+".csv"
+    def aggregateParallel(self,output="csv"):
+        #The same as aggregateFull, but each day directory is read by one of
+        #self.workers processes. A worker hands back every controller's
+        #measurements for its days as a column sorted by time, see
+        #aggregateShard, and the columns from all the days are merged with
+        #heapq.merge. Days are merged in order, so measurements taken at the
+        #same time come out as they would from aggregateFull. output="archive"
+        #writes the merged columns into fresh binary archives under
+        #self.archive instead of a csv file.
+        days=collections.OrderedDict()
+        for path in SOGSStorage.measurementFiles(self.dir):
+            days.setdefault(os.path.dirname(path),[]).append(path)
+        controllers=self.com.controllers
+        formatted=output=="csv"
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as ex:
+            jobs=[ex.submit(aggregateShard,paths,controllers,self.aggDel,formatted) for paths in days.values()]
+            chunks=[]
+            for day,job in zip(days.keys(),jobs):
+                chunks.append(job.result())
+                print("aggregated "+day)
+        key=operator.itemgetter(0)
+        columns=[heapq.merge(*[chunk[c] for chunk in chunks],key=key) for c in range(len(controllers))]
+        if output=="archive":
+            for c in range(len(controllers)):
+                w=self.archiveWriter(controllers[c].name,False)
+                for (t,data) in columns[c]:
+                    w.write(t,data)
+            self.closeStorage()
+            return
+        outdel=self.aggDel
+        outfile=open(self.aggregateFileName(),'w')
+        self.writeAggregateHeader(outfile)
+        for fields in zip(*columns):
+            outfile.write(outdel.join([f[1] for f in fields])+"\n")
+        outfile.close()
+    def aggregateAligned(self,bufferBytes=1<<20):
+        #Writes an aggregate file whose rows line measurements from different
+        #controllers up by time rather than by measurement cycle. Each row
+        #starts from the earliest measurement not yet written, and every
+        #other controller joins in with its next one if that was taken no
+        #more than self.align seconds later. A controller with nothing in
+        #range gets its name followed by self.gap in every field, so gaps
+        #show instead of rows sliding out of step. Controllers without a
+        #dataWidth are left out. The file is read with a RecordParser and
+        #written a column at a time through a buffer of bufferBytes. Times are
+        #written as they were saved.
+        rp=RecordParser(self.com.controllers,fill=False,text=True)
+        for path in SOGSStorage.measurementFiles(self.dir):
+            print("opening "+path)
+            rp.read(path)
+        outdel=self.aggDel
+        gap=self.gap
+        times=[]
+        cells=[]
+        blanks=[]
+        for mc in range(len(rp.controllers)):
+            c=rp.controllers[mc]
+            b=rp.batches[mc]
+            order=b.sort()
+            times.append(b.times)
+            stamps=rp.stamps[mc] if order==None else [rp.stamps[mc][i] for i in order]
+            #all of a controller's measurements are formatted in one go, the
+            #floats as parseDataToString's str would.
+            data=[outdel.join(map(repr,r)) for r in zip(*b.columns)]
+            prefix=c.name+outdel
+            cells.append([prefix+stamps[i].replace("T",outdel,1)+outdel+data[i] for i in range(len(b))])
+            blanks.append(prefix+outdel.join([gap]*(b.width+2)))
+        rows=alignTimes(times,int(self.align*1e9))
+        outfile=open(self.aggregateFileName(),'w',buffering=bufferBytes)
+        self.writeAggregateHeader(outfile,rp.controllers)
+        chunk=65536
+        for start in range(0,len(rows[0]) if len(rows)>0 else 0,chunk):
+            cols=[]
+            for s in range(len(rows)):
+                f=cells[s]
+                b=blanks[s]
+                cols.append([b if i<0 else f[i] for i in rows[s][start:start+chunk]])
+            outfile.writelines([outdel.join(r)+"\n" for r in zip(*cols)])
+        outfile.close()
+    def aggregateIncremental(self):
+        #Adds files that have appeared since the last run to the aggregate
+        #file, which always goes in aggFile.csv. The files already taken in are
+        #listed with their modification time and size in aggFile.manifest.
+        #New files are parsed into sorted runs of at most runLength rows, each
+        #spilled to a temporary file, and the runs are merged with the old
+        #aggregate in time order, so memory doesn't grow with the history.
+        #Segments that have grown are read on from where they were left. If a
+        #listed file has otherwise changed or vanished, everything is rebuilt.
+        outname=self.aggFile+".csv"
+        manifestName=self.aggFile+".manifest"
+        manifest=readManifest(manifestName)
+        seen={}
+        new=[] #(path, offset to read from)
+        rebuild=not os.path.exists(outname)
+        for path in SOGSStorage.measurementFiles(self.dir):
+            st=os.stat(path)
+            seen[path]=(st.st_mtime_ns,st.st_size)
+            if path not in manifest:
+                new.append((path,0))
+            elif manifest[path]!=seen[path]:
+                if path[-4:]==".seg" and seen[path][1]>manifest[path][1]:
+                    new.append((path,manifest[path][1]))
+                else:
+                    print("Changed since last aggregation: "+path)
+                    rebuild=True
+        if len(seen)<len(manifest)+len([n for n in new if n[1]==0]):
+            print("Files have gone missing since last aggregation")
+            rebuild=True
+        if rebuild==True:
+            print("Rebuilding "+outname)
+            new=[(path,0) for path in seen.keys()]
+        elif len(new)==0:
+            print(outname+" is up to date")
+            return
+        runs=[]
+        rows=[]
+        for (path,offset) in new:
+            print("opening "+path)
+            for out in self.readMeasurementRows(path,offset):
+                rows.append(self.aggregateLine(out))
+                if len(rows)>=self.runLength:
+                    runs.append(spillRun(rows,self.aggregateKey))
+                    rows=[]
+        rows.sort(key=self.aggregateKey)
+        runs.append(rows)
+        if rebuild==False:
+            oldfile=open(outname,'r')
+            runs.append(self.aggregateRows(oldfile))
+        outfile=open(outname+".tmp",'w')
+        self.writeAggregateHeader(outfile)
+        for line in heapq.merge(*runs,key=self.aggregateKey):
+            outfile.write(line)
+        outfile.close()
+        for r in runs:
+            if hasattr(r,"close"):
+                r.close()
+        if rebuild==False:
+            oldfile.close()
+        os.replace(outname+".tmp",outname)
+        writeManifest(manifestName,seen)
+        print("Aggregated "+str(len(new))+" new files into "+outname)
+    def readMeasurementRows(self,path,offset=0):
+        #yields a list with a Measurement for each controller for every
+        #measurement cycle in a file or segment, null data filling in for any
+        #controller that is missing. See SOGSStorage.readRecords for offset.
+        index={}
+        for c in range(len(self.com.controllers)):#Identify the controller being used
+            index[self.com.controllers[c].name]=c
+        for (outdate,outtime,mtags) in SOGSStorage.readRecords(path,offset):
+            out=[]#an array of measurements read from file
+            for c in self.com.controllers:
+                #fill the measurement array with null data
+                out.append(Measurement(c.nullData(),c.name,outdate+"T"+outtime))
+            for tags in mtags:
+                mc=index.get(tags[1],-1)
+                if mc!=-1: #Make a measurement from the file's data and add it to the out array.
+                    c=self.com.controllers[mc]
+                    out[mc]=Measurement(c.parseTagsToData(tags[4:]),c.name,tags[2]+"T"+tags[3])
+                else:
+                    #your stuff wasn't recognized.
+                    pass
+            yield out
+    def writeAggregateHeader(self,outfile,controllers=None):
+        outdel=self.aggDel
+        if controllers==None:
+            controllers=self.com.controllers
         outfile.write('#SOGS aggregate measurements CSV\n')
         outfile.write('#Aggregated on '+datetime.datetime.now().date().isoformat()+"_"+datetime.datetime.now().time().isoformat()+"\n")
         outline=""
         #now the aggregate file processing begins.
-        for c in range(len(self.com.controllers)):
-            outline+='MC'+outdel+"Date"+outdel+"Time"+outdel+self.com.controllers[c].dataID(outdel)+outdel
+        for c in range(len(controllers)):
+            outline+='MC'+outdel+"Date"+outdel+"Time"+outdel+controllers[c].dataID(outdel)+outdel
         outline=outline[:-len(outdel)]+"\n"
         outfile.write(outline)
-        for c in range(len(outmeasurements[0])):#iterate for as many measurements as it can find.
-            outline=""
-            for tmc in range(len(outmeasurements)):
-                meas=outmeasurements[tmc][c]
-                outline+=meas.MC+outdel+meas.dtToD()+outdel+meas.dtToT()+outdel+self.com.scanControllers(meas.MC).parseDataToString(meas.data,outdel)+outdel
-            outline=outline[:-len(outdel)]+"\n"
-            outfile.write(outline)
-        outfile.close()
+    def aggregateLine(self,row):
+        #returns the aggregate file line for a list of Measurements, one per controller.
+        outdel=self.aggDel
+        outline=""
+        for meas in row:
+            outline+=meas.MC+outdel+meas.dtToD()+outdel+meas.dtToT()+outdel+self.com.scanControllers(meas.MC).parseDataToString(meas.data,outdel)+outdel
+        return outline[:-len(outdel)]+"\n"
+    def aggregateKey(self,line):
+        #the time an aggregate file line is sorted by: that of its first measurement.
+        tags=line.split(self.aggDel,3)
+        return tags[1]+"T"+tags[2]
+    def aggregateRows(self,f):
+        #yields the data lines of an open aggregate file, skipping the header.
+        for line in f:
+            if line[0:1]!="#" and line[0:2]!="MC":
+                yield line
 
-def chopString(_line,delin,comment):
-    #strips comments, returns a string array of delineator seperated values.
-    out=[]
-    snag=0
-    line=_line
-    if comment!="":
-        if line.find(comment)>-1:
-            line=line[:line.find(comment)]
-    if line!="":
-        while snag==0:
-            if line.find(delin)>-1:
-                out.append(line[:line.find(delin)])
-                line=line[line.find(delin)+1:]
+def aggregateShard(paths,controllers,outdel,formatted=True):
+    #reads a list of measurement files, as one of aggregateParallel's worker
+    #processes. Returns a list with a column for each controller, of
+    #(time,field) for each measurement cycle in time order. field is the
+    #measurement as it appears on an aggregate file line, or its data if
+    #formatted is False. A controller missing from a cycle gets null data at
+    #the cycle's time, as in LairUI.readMeasurementRows.
+    index={}
+    for c in range(len(controllers)):
+        index[controllers[c].name]=c
+    columns=[[] for c in controllers]
+    for path in paths:
+        for (outdate,outtime,mtags) in SOGSStorage.readRecords(path):
+            out=[None]*len(controllers)
+            for tags in mtags:
+                mc=index.get(tags[1],-1)
+                if mc!=-1:
+                    out[mc]=tags
+            for mc in range(len(controllers)):
+                c=controllers[mc]
+                tags=out[mc]
+                if tags==None:
+                    d,t,data=outdate,outtime,c.nullData()
+                else:
+                    d,t,data=tags[2],tags[3],c.parseTagsToData(tags[4:])
+                if formatted:
+                    columns[mc].append((d+"T"+t,c.name+outdel+d+outdel+t+outdel+c.parseDataToString(data,outdel)))
+                else:
+                    columns[mc].append((d+"T"+t,data))
+    for col in columns:
+        col.sort(key=operator.itemgetter(0))
+    return columns
+
+def timesToNs(times):
+    #a list of "dateTtime" strings as an array('q') of nanoseconds since 1970,
+    #as SOGSStorage.datetimeToNs gives, converted all at once with numpy. Runs
+    #of the same time, as in a measurement cycle, are converted once without.
+    if np is not None:
+        try:
+            return array.array("q",np.array(times,dtype="datetime64[ns]").astype(np.int64).tobytes())
+        except ValueError:
+            pass #something numpy can't read; datetime may
+    out=array.array("q")
+    last=None
+    ns=0
+    for t in times:
+        if t!=last:
+            last=t
+            ns=SOGSStorage.datetimeToNs(t)
+        out.append(ns)
+    return out
+
+def alignTimes(times,tolerance):
+    #Lines up several sorted lists of times into rows, for aggregateAligned.
+    #Returns a list for each of times, giving for every row the index of the
+    #time it has there or -1 for none. A row starts at the earliest time not
+    #yet used and takes the next time of each list that is within tolerance
+    #of it, so every time is used exactly once.
+    n=len(times)
+    heads=[0]*n
+    lens=[len(t) for t in times]
+    out=[[] for t in times]
+    while True:
+        start=None
+        for s in range(n):
+            if heads[s]<lens[s] and (start==None or times[s][heads[s]]<start):
+                start=times[s][heads[s]]
+        if start==None:
+            return out
+        end=start+tolerance
+        for s in range(n):
+            h=heads[s]
+            if h<lens[s] and times[s][h]<=end:
+                out[s].append(h)
+                heads[s]=h+1
             else:
-                out.append(line)
-                snag=1
+                out[s].append(-1)
+
+def readManifest(path):
+    #returns {file path: (mtime in ns, size)} from an aggregation manifest,
+    #or an empty dict if there isn't one yet.
+    out={}
+    if not os.path.exists(path):
+        return out
+    f=open(path,"r")
+    for line in f:
+        tags=line.rstrip("\n").split("\t")
+        if len(tags)==3 and tags[0][0:1]!="#":
+            out[tags[0]]=(int(tags[1]),int(tags[2]))
+    f.close()
     return out
 
-class Measurement:
-    #stores a measurement of a single type.
-    def __init__(self,data=False,MC="",dt=datetime.datetime.now()):
-        if str(type(MC))=="<class 'str'>":
-            self.dt=dt
-            self.MC=MC#the name of the measure controller
-            self.data=data
+def writeManifest(path,manifest):
+    #writes the manifest to a temporary file first so a crash can't leave half of one.
+    f=open(path+".tmp","w")
+    f.write("#SOGS aggregation manifest: path, mtime (ns), size\n")
+    for k in sorted(manifest.keys()):
+        f.write(k+"\t"+str(manifest[k][0])+"\t"+str(manifest[k][1])+"\n")
+    f.close()
+    os.replace(path+".tmp",path)
+
+def spillRun(lines,key):
+    #sorts a list of lines into a temporary file and returns it rewound.
+    lines.sort(key=key)
+    f=tempfile.TemporaryFile("w+")
+    f.writelines(lines)
+    f.seek(0)
+    return f
+
+def chopString(_line,delin,comment):
+    #strips comments, returns a string array of delineator seperated values.
+    return SOGSStorage.splitLine(_line,delin,comment)
+
+class RecordParser:
+    #Parses measurement files straight into a MeasurementBatch for each
+    #controller, for when only the numbers are wanted and not a Measurement
+    #for each of them. Each m line is split once, by SOGSStorage.readRecords,
+    #and its fields go into the batch's columns as floats. Controllers without
+    #a dataWidth are left out. As in LairUI.readMeasurementRows, a controller
+    #missing from a measurement cycle gets a row of null data at the cycle's
+    #time, unless fill is False. With text, each row's date and time are also
+    #kept as they were saved, as "dateTtime" strings in stamps, for output
+    #that has to match the files.
+    #>>> rp=RecordParser(lc.controllers)
+    #>>> for path in SOGSStorage.measurementFiles("SOGSMeasurements"):
+    #...     rp.read(path)
+    #>>> b=rp.batch("gas")
+    def __init__(self,controllers,fill=True,text=False):
+        self.controllers=[c for c in controllers if c.dataWidth()>0]
+        self.index={}
+        for c in range(len(self.controllers)):
+            self.index[self.controllers[c].name]=c
+        self.widths=[c.dataWidth() for c in self.controllers]
+        self.nulls=[[float(v) for v in c.nullData()] for c in self.controllers]
+        self.fill=fill
+        self.batches=[MeasurementBatch(c.name,c.dataWidth()) for c in self.controllers]
+        self.stamps=[[] for c in self.controllers] if text else None
+        self.malformed=0
+    def read(self,path,offset=0):
+        #parses a file or segment, see SOGSStorage.readRecords for offset.
+        #Returns the number of measurement cycles read.
+        #Each controller's values go straight onto one flat array('d'), row
+        #after row, and its times onto a list as they were saved. Every 4096
+        #cycles flush deals the values out to the columns with strided
+        #slices and converts the times all at once, which is much quicker
+        #than doing either a row at a time.
+        index=self.index
+        widths=self.widths
+        nulls=self.nulls
+        flats=[array.array("d") for w in widths]
+        texts=[[] for w in widths]
+        n=0
+        for (outdate,outtime,mtags) in SOGSStorage.readRecords(path,offset):
+            n+=1
+            seen=[False]*len(widths)
+            for tags in mtags:
+                mc=index.get(tags[1],-1)
+                if mc==-1:
+                    continue
+                v=tags[4:]
+                try:
+                    if len(v)!=widths[mc]:
+                        raise ValueError
+                    #fromlist adds nothing if the list can't be made.
+                    flats[mc].fromlist(list(map(float,v)))
+                except ValueError:
+                    #a short, long or garbled line gets null data instead.
+                    flats[mc].fromlist(nulls[mc])
+                    self.malformed+=1
+                texts[mc].append(tags[2]+"T"+tags[3])
+                seen[mc]=True
+            if self.fill:
+                for mc in range(len(widths)):
+                    if seen[mc]==False:
+                        flats[mc].fromlist(nulls[mc])
+                        texts[mc].append(outdate+"T"+outtime)
+            if n%4096==0:
+                self.flush(flats,texts)
+        self.flush(flats,texts)
+        return n
+    def flush(self,flats,texts):
+        #moves the rows gathered in flats and texts into the batches,
+        #emptying them.
+        for mc in range(len(flats)):
+            flat=flats[mc]
+            if len(texts[mc])==0:
+                continue
+            b=self.batches[mc]
+            w=self.widths[mc]
+            for (k,col) in enumerate(b.columns):
+                col.extend(flat[k::w])
+            b.times.extend(timesToNs(texts[mc]))
+            if self.stamps!=None:
+                self.stamps[mc].extend(texts[mc])
+            del flat[:]
+            del texts[mc][:]
+    def batch(self,name):
+        #the MeasurementBatch for a controller, in the order read.
+        return self.batches[self.index[name]]
+
+class MeasurementBatch:
+    #A controller's measurements kept as columns rather than as a Measurement
+    #apiece: times, an array('q') of nanoseconds since 1970 by the local wall
+    #clock, as the saved files go (see SOGSStorage.datetimeToNs), and
+    #columns, an array('d') for each of width channels. That is 8 bytes a
+    #number, where a list of Measurements takes some 60 a number and 100
+    #more a row. Board and UTC times aren't kept. Indexing gives a Measurement and
+    #slicing a new batch, so code written for lists of Measurements mostly
+    #works unchanged.
+    #>>> b=MeasurementBatch("gas",8)
+    #>>> b.append(lc_measurement) #or b.add(time,data)
+    #>>> b.sort()
+    #>>> b.between(start,stop).column(3)
+    def __init__(self,name,width):
+        self.name=name
+        self.width=width
+        self.times=array.array("q")
+        self.columns=[array.array("d") for i in range(width)]
+    def __len__(self):
+        return len(self.times)
+    def add(self,dt,data):
+        #dt as for Measurement, data a list of width numbers.
+        if len(data)!=self.width:
+            raise ValueError(self.name+" measurements have "+str(self.width)+" values, not "+str(len(data)))
+        self.times.append(dt if isinstance(dt,int) else SOGSStorage.datetimeToNs(dt))
+        for (col,x) in zip(self.columns,data):
+            col.append(x)
+    def append(self,m):
+        self.add(m.dt,m.data)
+    def extend(self,other):
+        #appends another batch's rows, or any iterable of Measurements.
+        if isinstance(other,MeasurementBatch):
+            self.times.extend(other.times)
+            for (col,o) in zip(self.columns,other.columns):
+                col.extend(o)
         else:
-            raise "You need to load a measure controller's name string rather than "+str(MC)
+            for m in other:
+                self.append(m)
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            out=MeasurementBatch(self.name,self.width)
+            out.times=self.times[i]
+            out.columns=[col[i] for col in self.columns]
+            return out
+        return Measurement([col[i] for col in self.columns],self.name,self.times[i])
+    def __iter__(self):
+        for i in range(0,len(self.times)):
+            yield self[i]
+    def row(self,i):
+        return [col[i] for col in self.columns]
+    def column(self,i):
+        #channel i's array('d'); numpy.asarray gives it as an array without copying.
+        return self.columns[i]
+    def array(self):
+        #the data as an (N,width) numpy array, copied.
+        return np.column_stack([np.frombuffer(col,dtype=float) for col in self.columns]) if len(self)>0 else np.empty((0,self.width))
+    def sort(self):
+        #puts the rows in time order, keeping the order of rows with the same
+        #time. Returns the old index of each row, for putting anything kept
+        #alongside in the same order, or None if they were in order already.
+        n=len(self.times)
+        if np is None:
+            order=sorted(range(n),key=self.times.__getitem__)
+            if order==list(range(n)):
+                return None
+            self.times=array.array("q",[self.times[i] for i in order])
+            self.columns=[array.array("d",[col[i] for i in order]) for col in self.columns]
+            return order
+        t=np.frombuffer(self.times,dtype=np.int64)
+        if n<2 or bool((t[1:]>=t[:-1]).all()):
+            return None
+        order=np.argsort(t,kind="stable")
+        self.times=array.array("q",t[order].tobytes())
+        self.columns=[array.array("d",np.frombuffer(col,dtype=float)[order].tobytes()) for col in self.columns]
+        return order.tolist()
+    def between(self,start=None,stop=None):
+        #the rows of a sorted batch taken between start and stop inclusive,
+        #as a new batch. Either may be anything Measurement takes as a time,
+        #or None for no limit.
+        lo=0 if start==None else bisect.bisect_left(self.times,start if isinstance(start,int) else SOGSStorage.datetimeToNs(start))
+        hi=len(self.times) if stop==None else bisect.bisect_right(self.times,stop if isinstance(stop,int) else SOGSStorage.datetimeToNs(stop))
+        return self[lo:hi]
+    def nbytes(self):
+        #bytes taken by the numbers themselves.
+        return self.times.itemsize*len(self.times)*(1+self.width)
+
+class Measurement:
+    #stores a measurement of a single type. dt is when it was taken by the
+    #local wall clock, as it is saved: a naive datetime, a "dateTtime" string
+    #or nanoseconds since 1970 as from SOGSStorage.datetimeToNs, and now if
+    #not given. utc is the same moment as time.time_ns() and board by the
+    #board's clock, both in nanoseconds if known. See MeasurementBatch for
+    #keeping a lot of them.
+    __slots__=("dt","MC","data","board","utc")
+    def __init__(self,data=False,MC="",dt=None,board=None,utc=None):
+        if not isinstance(MC,str):
+            raise TypeError("You need to load a measure controller's name string rather than "+str(MC))
+        self.dt=datetime.datetime.now() if dt==None else dt
+        self.MC=MC#the name of the measure controller
+        self.data=data
+        self.board=board
+        self.utc=utc
     def datetime(self):
         return self.dt
+    def ns(self):
+        #dt in nanoseconds since 1970, by the local wall clock.
+        if isinstance(self.dt,int):
+            return self.dt
+        return SOGSStorage.datetimeToNs(self.dt)
     def dtToT(self):#convert datetime string/object to time string
-        if str(type(self.dt))=="<class 'str'>":
+        if isinstance(self.dt,str):
             return self.dt[self.dt.find("T")+1:]
+        elif isinstance(self.dt,int):
+            return SOGSStorage.nsToDatetime(self.dt).time().isoformat()
         else:
             return self.dt.time().isoformat()
     def dtToD(self):#convert datetime string/object to date string
-        if str(type(self.dt))=="<class 'str'>":
+        if isinstance(self.dt,str):
             return self.dt[:self.dt.find("T")]
+        elif isinstance(self.dt,int):
+            return SOGSStorage.nsToDatetime(self.dt).date().isoformat()
         else:
             return self.dt.date().isoformat()
 
@@ -786,6 +2077,28 @@ class GraphGUI:
         self.bars.prep(50,50,970,570,[0,1,2,3,4,5])
         self.bars.set_yunits("V")
         self.bars.set_xlabels(["BCR","Pa","LDR","CH","NH3","NO2","CO","O3"])
+        self.bars.start(30)
+        #strip charts of the last chartLength measurements
+        self.chartLength=3600
+        self.chartWindow=tk.Toplevel(self.master)
+        self.chartCanvas=tk.Canvas(self.chartWindow,width=1024,height=700)
+        self.chartCanvas.pack()
+        self.gasChart=stripChart(self.chartCanvas,8,self.chartLength)
+        self.gasChart.prep(60,30,900,320,[0,1,2,3,4,5])
+        self.gasChart.set_yunits("V")
+        self.gasChart.set_labels(["BCR","Pa","LDR","CH","NH3","NO2","CO","O3"])
+        self.gasChart.start(30)
+        self.thbChart=stripChart(self.chartCanvas,3,self.chartLength)
+        self.thbChart.prep(60,380,900,670,[0,20,40,60,80,100])
+        self.thbChart.set_labels(["Temperature(C)","Humidity(%RH)","Bus(V)"])
+        self.thbChart.start(30)
+    def plot(self,name,data):
+        #hands a measurement to the graphs that show it. Safe from any thread.
+        if name=="gas":
+            self.bars.post(data)
+            self.gasChart.post(data)
+        elif name=="THB":
+            self.thbChart.post([data[0]-273.15,data[1],data[2]])
     def log(self,s,sw=0):
         #sw=0 for in, 1 for out
         if self.logType==1 and sw!=2:
@@ -0,0 +1,462 @@
+#Benchmarks for the SOGS python libraries. These don't need a board; a pty
+#pair stands in for the serial port, with SOGSEmulator on the far end where
+#a board has to answer. Linux/mac only, because of the pty.
+#Run with
+#python3 SOGSBench.py [results.json] [--compare old.json] [--quick]
+#The results are written as JSON, to the file if one is given and otherwise
+#to the terminal. With --compare, each figure is printed next to the same
+#one from an earlier run, so a regression stands out. --quick leaves out the
+#year long query benchmark, which takes minutes to set up the first time.
+
+import os
+import sys
+import io
+import json
+import select
+import shutil
+import platform
+import contextlib
+import pty
+import threading
+import time
+import serial
+from LairCom0_4 import LairCom
+from LairCom0_4 import MCGas
+from LairCom0_4 import alphahexToUnsigned
+from LairCom0_4 import makeFrame
+from LairCom0_4 import packSamples
+from LairCom0_4 import LairUI
+from LairCom0_4 import Measurement
+from LairCom0_4 import RecordParser
+from LairCom0_4 import MeasurementBatch
+from SOGSEmulator import PtyBoard
+import random
+import datetime
+import tempfile
+import SOGSStorage
+import tracemalloc
+import gc
+
+def openPtyPair():
+    #returns (master fd, pyserial object on the slave end).
+    #pyserial puts the slave into raw mode, so carriage returns survive.
+    master,slave=pty.openpty()
+    ch=serial.Serial(os.ttyname(slave),9600,timeout=0)
+    os.close(slave)
+    return master,ch
+
+def fakeFrames(n,header="M0",binary=False):
+    #n measurement packets as the board would send them, all in one bytes object.
+    if binary:
+        return makeFrame(header,packSamples([0x012,0x345,0x078,0x1ab,0x0cd,0x3ef,0x001,0x234]))*n
+    payload="abcdefghijklmnopabcdefgh"
+    return ((header+payload+"\r")*n).encode()
+
+def legacySerialGet(lc):
+    #the old one-byte-at-a-time reader, kept here as the baseline.
+    snag=0
+    while(snag==0):
+        if lc.ch.inWaiting()>0:
+            s_buffer=str(lc.ch.read(1))
+            if s_buffer[2:4]=="\\r":
+                lc.received.append(lc.legacyBuffer)
+                lc.messageBuffer.append((lc.legacyBuffer,1))
+                lc.legacyBuffer=""
+            else:
+                lc.legacyBuffer=lc.legacyBuffer+s_buffer[2:3]
+        else:
+            snag=1
+
+def benchSerialGet(frames=20000,legacy=False,binary=False):
+    #pushes frames through a pty as fast as the pty will take them and times
+    #how long LairCom takes to packetize them. Returns a dict of results.
+    master,ch=openPtyPair()
+    lc=LairCom()
+    lc.ch=ch
+    lc.mode=2
+    lc.binary=binary
+    lc.legacyBuffer=""
+    data=fakeFrames(frames,binary=binary)
+    writer=threading.Thread(target=os.write,args=(master,data))
+    got=0
+    wall=time.perf_counter()
+    cpu=time.thread_time()
+    writer.start()
+    while got<frames:
+        if legacy:
+            legacySerialGet(lc)
+        else:
+            lc.serialGet()
+        got+=len(lc.received)+len(lc.queues["M0"])
+        lc.received.clear()
+        lc.queues["M0"].clear()
+        lc.messageBuffer.clear()
+    cpu=time.thread_time()-cpu
+    wall=time.perf_counter()-wall
+    writer.join()
+    ch.close()
+    os.close(master)
+    return {"name":"serialGet"+("Legacy" if legacy else "")+("Binary" if binary else ""),"frames":frames,
+            "bytes":len(data),"seconds":wall,"cpuSeconds":cpu,
+            "framesPerSecond":frames/wall,"cpuPerFrameUs":cpu/frames*1e6}
+
+def benchGetBacklog(frames=2000):
+    #queues a burst of interleaved M0/M1 packets and times draining them
+    #through get(), which is what happens after the program stalls.
+    lc=LairCom()
+    for i in range(frames//2):
+        lc.queues["M0"].append("M0abcdefghijklmnopabcdefgh")
+        lc.queues["M1"].append("M1abcdefghijklmnopabcdefgh")
+    wall=time.perf_counter()
+    got=0
+    while lc.get("gas")!=False:
+        got+=1
+    while lc.get("THB")!=False:
+        got+=1
+    wall=time.perf_counter()-wall
+    return {"name":"getBacklog","frames":got,"seconds":wall,"framesPerSecond":got/wall}
+
+def benchParse(packets=100000):
+    #times decoding logged M0 payloads the old way, through the lookup table
+    #one packet at a time, and as one numpy batch.
+    rnd=random.Random(1)
+    pk=["".join([chr(97+rnd.randrange(16)) for i in range(24)]) for j in range(packets)]
+    mc=MCGas()
+    out=[]
+    for name in ["arithmetic","table","batch"]:
+        wall=time.perf_counter()
+        if name=="arithmetic":
+            for p in pk:
+                [alphahexToUnsigned(p[i*3:(i*3+3)])/204.8 for i in range(0,8)]
+        elif name=="table":
+            for p in pk:
+                mc.parsePacketToData(p)
+        else:
+            mc.parsePacketsToArray(pk)
+        wall=time.perf_counter()-wall
+        out.append({"name":"parse_"+name,"packets":packets,"seconds":wall,"packetsPerSecond":packets/wall})
+    return out
+
+def makeSyntheticYear(saveDir,days=365,start=datetime.datetime(2014,1,1)):
+    #writes days of 1 Hz gas measurements into segments under saveDir,
+    #unless it has been done already. A full year is a few gigabytes.
+    marker=saveDir+"/complete"+str(days)
+    if os.path.exists(marker):
+        return
+    w=SOGSStorage.SegmentWriter(saveDir,flushRecords=4096)
+    values="/1.25/4.921875/4.921875/0.0/0.078125/0.859375/4.375/1.015625"
+    step=datetime.timedelta(seconds=1)
+    dt=start
+    for i in range(days*86400):
+        w.write(dt,["m/gas/"+dt.date().isoformat()+"/"+dt.time().isoformat()+values])
+        dt+=step
+    w.close()
+    open(marker,"w").close()
+
+def benchQuery(days=365,saveDir=None):
+    #times fetching an hour of gas data from the middle of days of 1 Hz data.
+    if saveDir==None:
+        saveDir=tempfile.gettempdir()+"/SOGSBenchYear"
+    makeSyntheticYear(saveDir,days)
+    start=datetime.datetime(2014,1,1)+datetime.timedelta(days=days//2,hours=12)
+    stop=start+datetime.timedelta(hours=1)
+    wall=time.perf_counter()
+    got=0
+    for r in SOGSStorage.query(saveDir,"gas",start,stop):
+        got+=1
+    wall=time.perf_counter()-wall
+    return {"name":"queryHour","days":days,"measurements":got,"seconds":wall}
+
+def percentile(values,p):
+    #the p'th percentile of values, nearest rank.
+    if len(values)==0:
+        return None
+    v=sorted(values)
+    return v[min(len(v)-1,int(p/100*len(v)))]
+
+def connect(lc,timeout=10):
+    #ticks lc until it has shaken hands. Returns False if it never does.
+    end=time.monotonic()+timeout
+    while lc.mode!=2:
+        if time.monotonic()>end:
+            return False
+        lc.tick()
+        time.sleep(0.01)
+    return True
+
+def benchRequests(requests=2000,window=4,latency=0,baud=None,noise=0,binary=False,name="gas"):
+    #measures through LairCom against an emulated board, every request
+    #submitted at once so the window stays full. Latency is from a request
+    #going out to its reply being parsed. CPU time is LairCom's alone, the
+    #emulator has a thread of its own.
+    pb=PtyBoard(latency=latency,baud=baud,noise=noise,seed=1)
+    lc=LairCom(pb.port)
+    lc.useBinary=binary
+    lc.window=window
+    lc.requestTimeout=max(1.0,latency*window*4)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok=connect(lc)
+    if ok==False:
+        pb.close()
+        return {"name":"requests","error":"no handshake"}
+    rs=[lc.submit(name) for i in range(requests)]
+    wall=time.perf_counter()
+    cpu=time.thread_time()
+    while len(lc.inflight)>0 or len(lc.backlog)>0:
+        select.select([lc.ch],[],[],0.01)
+        lc.tick()
+    cpu=time.thread_time()-cpu
+    wall=time.perf_counter()-wall
+    lc.ch.close()
+    pb.close()
+    lat=[r.latency()*1000 for r in rs if r.state==2]
+    return {"name":"requests"+("Binary" if binary else ""),"requests":requests,"window":window,
+            "latency":latency,"baud":baud,"noise":noise,"answered":len(lat),
+            "timedOut":len([r for r in rs if r.state==3]),"seconds":wall,"framesPerSecond":len(lat)/wall,
+            "latencyMsP50":percentile(lat,50),"latencyMsP90":percentile(lat,90),
+            "latencyMsP99":percentile(lat,99),"latencyMsMax":max(lat) if lat else None,
+            "cpuPerFrameUs":cpu/max(1,len(lat))*1e6}
+
+def benchLairUI(cycles=200,storage="segments"):
+    #runs LairUI's loop against an emulated board, as fast as it will go,
+    #saving into a temporary directory, and times the measurement cycles.
+    pb=PtyBoard(seed=1)
+    saveDir=tempfile.mkdtemp()
+    with contextlib.redirect_stdout(io.StringIO()):
+        lu=LairUI(mode="null",ui="none",delay=0,saveDir=saveDir,aggFile="",storage=storage,port=pb.port)
+        lu.updatems=0
+        lu.gui.logType=0
+        saves=[0]
+        save=lu.saveMeasurements
+        def counted():
+            saves[0]+=1
+            save()
+        lu.saveMeasurements=counted
+        while lu.com.mode!=2:
+            lu.normalMain()
+        wall=time.perf_counter()
+        cpu=time.thread_time()
+        while saves[0]<cycles:
+            lu.normalMain()
+        cpu=time.thread_time()-cpu
+        wall=time.perf_counter()-wall
+        lu.closeStorage()
+    lu.com.ch.close()
+    pb.close()
+    shutil.rmtree(saveDir)
+    return {"name":"lairUI_"+storage,"cycles":cycles,"seconds":wall,"cyclesPerSecond":cycles/wall,
+            "cpuPerCycleUs":cpu/cycles*1e6}
+
+def benchIdle(seconds=10,delay=2,headless=True):
+    #runs LairUI without a ui against an emulated board, measuring every
+    #delay seconds, and reports the CPU time the loop takes. headless=False
+    #polls every 30 ms, as the loop used to.
+    pb=PtyBoard(seed=1)
+    saveDir=tempfile.mkdtemp()
+    with contextlib.redirect_stdout(io.StringIO()):
+        lu=LairUI(mode="null",ui="none",delay=delay,saveDir=saveDir,aggFile="",storage="segments",port=pb.port)
+        lu.gui.logType=0
+        saves=lu.metrics.counters
+        cpu=time.thread_time()
+        wall=time.perf_counter()
+        if headless:
+            lu.headlessMain(seconds)
+        else:
+            while time.perf_counter()-wall<seconds:
+                time.sleep(0.03)
+                lu.normalMain()
+        cpu=time.thread_time()-cpu
+        wall=time.perf_counter()-wall
+        lu.closeStorage()
+    lu.com.ch.close()
+    pb.close()
+    shutil.rmtree(saveDir)
+    return {"name":"idle"+("Headless" if headless else "Polled"),"seconds":wall,"delay":delay,
+            "saves":saves.get("saves",0),"cpuSeconds":cpu,"cpuPercent":cpu/wall*100}
+
+def benchSave(measurements=5000,storage="files",saveDir=None):
+    #times LairUI.saveMeasurements for a gas and THB measurement at a time.
+    #Leaves the files in saveDir for benchAggregate.
+    if saveDir==None:
+        saveDir=tempfile.mkdtemp()
+    with contextlib.redirect_stdout(io.StringIO()):
+        lu=LairUI(mode="null",ui="none",saveDir=saveDir,aggFile=saveDir+"/agg",addAggDate=False,storage=storage)
+    start=datetime.datetime(2014,1,1)
+    wall=time.perf_counter()
+    for i in range(measurements):
+        dt=start+datetime.timedelta(seconds=i)
+        lu.measList=[Measurement([1.25,4.92,4.92,0.0,0.078,0.859,4.375,1.0156],"gas",dt),
+                     Measurement([295.1,41.5,2.61],"THB",dt)]
+        lu.saveMeasurements()
+    lu.closeStorage()
+    wall=time.perf_counter()-wall
+    size=sum([os.path.getsize(p) for p in SOGSStorage.measurementFiles(saveDir)])
+    return {"name":"save_"+storage,"measurements":measurements,"seconds":wall,
+            "measurementsPerSecond":measurements/wall,"bytes":size},lu
+
+def benchAggregate(measurements=5000,storage="files"):
+    #saves measurements with benchSave and times aggregating them.
+    saved,lu=benchSave(measurements,storage)
+    wall=time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        lu.aggregate()
+    wall=time.perf_counter()-wall
+    shutil.rmtree(lu.dir)
+    return [saved,{"name":"aggregate_"+storage,"measurements":measurements,"seconds":wall,
+                   "rowsPerSecond":measurements/wall}]
+
+def makeSyntheticDays(saveDir,days=8,perDay=20000,start=datetime.datetime(2014,1,1)):
+    #writes perDay gas and THB measurement cycles for each of days into
+    #segments under saveDir.
+    w=SOGSStorage.SegmentWriter(saveDir,flushRecords=4096)
+    step=datetime.timedelta(seconds=86400/perDay)
+    for d in range(days):
+        dt=start+datetime.timedelta(days=d)
+        for i in range(perDay):
+            day=dt.date().isoformat()
+            t=dt.time().isoformat()
+            w.write(dt,["m/gas/"+day+"/"+t+"/1.25/4.921875/4.921875/0.0/0.078125/0.859375/"+str(i%997/200)+"/1.015625",
+                        "m/THB/"+day+"/"+t+"/295.1/41.5/"+str(i%89/20)])
+            dt+=step
+    w.close()
+
+def benchAggregateScaling(days=8,perDay=20000,workers=[1,2,4,8]):
+    #times a full aggregation of days of data in-process (workers 1) and
+    #shared among processes, one day directory per job.
+    saveDir=tempfile.mkdtemp()
+    makeSyntheticDays(saveDir,days,perDay)
+    out=[]
+    for n in workers:
+        with contextlib.redirect_stdout(io.StringIO()):
+            lu=LairUI(mode="null",ui="none",saveDir=saveDir,aggFile=saveDir+"/agg"+str(n),addAggDate=False,workers=n)
+            wall=time.perf_counter()
+            lu.aggregate()
+            wall=time.perf_counter()-wall
+        out.append({"name":"aggregateWorkers","workers":n,"cores":os.cpu_count(),"measurements":days*perDay,
+                    "seconds":wall,"rowsPerSecond":days*perDay/wall})
+    shutil.rmtree(saveDir)
+    return out
+
+def benchRecords(measurements=50000):
+    #times reading saved gas and THB measurements into Measurements, as
+    #aggregate does, and into columns with a RecordParser.
+    saveDir=tempfile.mkdtemp()
+    makeSyntheticDays(saveDir,1,measurements)
+    lu=LairUI(mode="null",ui="none",saveDir=saveDir)
+    paths=list(SOGSStorage.measurementFiles(saveDir))
+    out=[]
+    for name in ["measurements","columns"]:
+        wall=time.perf_counter()
+        if name=="measurements":
+            for path in paths:
+                for row in lu.readMeasurementRows(path):
+                    pass
+        else:
+            rp=RecordParser(lu.com.controllers)
+            for path in paths:
+                rp.read(path)
+        wall=time.perf_counter()-wall
+        out.append({"name":"records_"+name,"measurements":measurements,"seconds":wall,"rowsPerSecond":measurements/wall})
+    shutil.rmtree(saveDir)
+    return out
+
+def benchExport(measurements=200000,align=0.5):
+    #times writing an aggregate file of gas and THB measurements lined up
+    #by time, and, for comparison, one lined up by measurement cycle.
+    saveDir=tempfile.mkdtemp()
+    makeSyntheticDays(saveDir,1,measurements)
+    out=[]
+    for name in ["aligned","cycles"]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            lu=LairUI(mode="null",ui="none",saveDir=saveDir,aggFile=saveDir+"/agg",addAggDate=False,align=align if name=="aligned" else None)
+            wall=time.perf_counter()
+            lu.aggregate()
+            wall=time.perf_counter()-wall
+        out.append({"name":"export_"+name,"measurements":measurements,"seconds":wall,"rowsPerSecond":measurements/wall})
+    shutil.rmtree(saveDir)
+    return out
+
+def benchMemory(samples=10000000,width=8,probe=200000):
+    #measures the memory held by samples gas measurements as a
+    #MeasurementBatch, and as a list of Measurements. Such a list of
+    #samples would not fit in memory, so the list is measured at probe
+    #samples and scaled up. Also times sorting the batch, which is in
+    #probe long runs.
+    rnd=random.Random(1)
+    t0=SOGSStorage.datetimeToNs("2014-01-01T00:00:00")
+    out=[]
+    gc.collect()
+    tracemalloc.start()
+    base=tracemalloc.get_traced_memory()[0]
+    ms=[Measurement([rnd.random() for j in range(width)],"gas",t0+i*1000000000) for i in range(probe)]
+    used=tracemalloc.get_traced_memory()[0]-base
+    del ms
+    out.append({"name":"memory_measurements","samples":samples,"probe":probe,"bytesPerSample":used/probe,
+                "megabytes":used/probe*samples/1e6})
+    gc.collect()
+    base=tracemalloc.get_traced_memory()[0]
+    chunk=MeasurementBatch("gas",width)
+    for i in range(min(probe,samples)):
+        chunk.add(t0+i*1000000000,[rnd.random() for j in range(width)])
+    b=MeasurementBatch("gas",width)
+    while len(b)<samples:
+        b.extend(chunk[0:samples-len(b)])
+    used=tracemalloc.get_traced_memory()[0]-base
+    tracemalloc.stop()
+    sort=time.perf_counter()
+    b.sort()
+    sort=time.perf_counter()-sort
+    out.append({"name":"memory_batch","samples":len(b),"bytesPerSample":used/len(b),"megabytes":used/1e6,
+                "sortSeconds":sort})
+    del b,chunk
+    return out
+
+def runAll(quick=False):
+    out=[benchSerialGet(legacy=True),benchSerialGet(),benchSerialGet(binary=True),benchGetBacklog()]
+    out+=benchParse()+benchRecords()
+    out+=[benchRequests(),benchRequests(binary=True),benchRequests(requests=200,window=1),
+          benchRequests(requests=200,baud=9600,latency=0.005),benchRequests(requests=500,noise=0.001)]
+    out+=[benchLairUI(),benchLairUI(storage="files"),benchIdle(headless=False),benchIdle()]
+    out+=benchAggregate()+benchAggregate(storage="segments")
+    out+=benchAggregateScaling(perDay=2000 if quick else 20000)
+    out+=benchExport(20000 if quick else 200000)
+    out+=benchMemory(1000000 if quick else 10000000)
+    if quick==False:
+        out.append(benchQuery())
+    return out
+
+def resultKey(r):
+    #tells apart results of the same benchmark run with different settings.
+    return r["name"]+"".join(["/"+str(r.get(k,"")) for k in ["window","baud","noise","workers"]])
+
+def compare(results,old):
+    #prints each figure beside the one with the same name in old.
+    previous={}
+    for r in old["results"]:
+        previous[resultKey(r)]=r
+    for r in results:
+        o=previous.get(resultKey(r),{})
+        for k,v in r.items():
+            if isinstance(v,float) and isinstance(o.get(k),float) and o[k]!=0:
+                print("%-24s %-22s %12.4g %12.4g %+7.1f%%"%(r["name"],k,o[k],v,(v/o[k]-1)*100))
+
+if __name__=="__main__":
+    args=sys.argv[1:]
+    old=None
+    if "--compare" in args:
+        i=args.index("--compare")
+        old=json.load(open(args[i+1]))
+        del args[i:i+2]
+    quick="--quick" in args
+    if quick:
+        args.remove("--quick")
+    doc={"date":datetime.datetime.now().isoformat(),"python":platform.python_version(),
+         "machine":platform.machine(),"results":runAll(quick)}
+    text=json.dumps(doc,indent=1)
+    if len(args)>0:
+        with open(args[0],"w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if old!=None:
+        compare(doc["results"],old)
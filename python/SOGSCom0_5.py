@@ -7,6 +7,9 @@
 #0_3 Accessable version
 #0_4 Modified for multiple measurements per file
 #0_5 Changed name to SOGSCom, added multiple sensor control
+#   The hub runs on an asyncio event loop: each conduit has a reader task,
+#   and measure() returns a future that resolves when the reply arrives.
+#   Burst sampling on the board, see Hub.burst and Hub.dump.
 
 import tkinter as tk
 import os
@@ -15,32 +18,45 @@ from psigraph import barGraph
 import datetime
 import time
 import math
+import asyncio
+import collections
+import SOGSStorage
+from LairCom0_4 import numberToAlphahex
+from LairCom0_4 import alphahexToUnsigned
+from LairCom0_4 import alphahexBlockToCounts
 
 
 
 
 class Board:
-    def __init__(self,nameID):
+    def __init__(self,nameID,saveDir="SOGSMeasurements"):
         #boards are referred to by name.
         self.instruments=[]
         self.slots=[False,False,False,False]
         #self.controller=Controller()
         self.nameID=nameID
-    def loadInstrument(self,instrument,nameID,slot=-1):
-        try:
-            self.setSlot(slot,instrument)
-        except:
-            print("The slot "+slot+" requested by "+instrument.nameID+" is already in use by instrument "+slots[slot].nameID)
-            raise Exception
+        self.saveDir=saveDir #where measurements from this board are saved
+        self.conduit=None
+        self.version="" #sent by the board in its handshake
+        self.waiting={} #header -> deque of futures waiting for a packet with that header
+        self.lateReplies=0 #replies that came after their request had given up, thrown away
+        self.burstBank=None #the bank of the last burst the hub started, "0" or "1"
+    def loadInstrument(self,instrument,slot=-1):
+        if slot!=-1:
+            try:
+                self.setSlot(slot,instrument)
+            except:
+                print("The slot "+str(slot)+" requested by "+instrument.nameID+" is already in use by instrument "+self.slots[slot].nameID)
+                raise Exception
         self.instruments.append(instrument)
     def clearInstruments(self):
         pass
     def removeInstrument(self,nameID):
         pass
     def setSlot(self,slot,instrument):
-        if slots[slot]!=False:
-            raise slots[slot]
-        slots[slot]=instrument
+        if self.slots[slot]!=False:
+            raise Exception
+        self.slots[slot]=instrument
         instrument.slot=slot
     def powerAux1(self,on=True):
         pass
@@ -56,8 +72,16 @@ class Board:
         pass
     def useEEPROM(self,on=True):
         pass
-    def getMeasurements(self,instrumentName,startTime,stopTime=datetime.datetime.now()):
-        pass
+    def getMeasurements(self,instrumentName,startTime=None,stopTime=None):
+        #a generator of the saved measurements from the named instrument taken
+        #between startTime and stopTime, oldest first. None for either means
+        #there is no limit at that end. Only the files and parts of segments
+        #that cover the time range are read, see SOGSStorage.query.
+        for (t,tags) in SOGSStorage.query(self.saveDir,instrumentName,startTime,stopTime):
+            data=[]
+            for v in tags:
+                data.append(float(v))
+            yield Measurement(instrumentName,data,datetime.datetime.fromisoformat(t))
     def clockSet(self,time):
         pass
     def clockGet(self):
@@ -81,25 +105,63 @@ class Conduit:
     #conduits are transparent; their functions are only called by board and
     #hub objects. The user can just ignore them, beyond selecting the correct
     #one for their purposes.
-    def __init__(self,conduitID=""):
-        self.bufferPacketIn=[]
+    #Each open conduit has a reader task on the hub's event loop that splits
+    #incoming bytes into packets on chr(13) and puts them on packetsIn. That
+    #queue holds at most maxPackets; when it is full the reader stops reading
+    #until the hub catches up, so a fast board can't run the hub out of memory.
+    #Subclasses that read a port themselves override readBytes. Otherwise
+    #the bytes are handed over with bytesReceived, as a radio library's
+    #callback would.
+    def __init__(self,conduitID="",maxPackets=256):
+        self.bufferPacketIn=collections.deque(maxlen=maxPackets) #packets nobody was waiting for
         self.bufferPacketOut=[]
         self.state=0 #By default the state variable is: 0 for no connection,
                 #                       1 for connection established,
                 #                       2 for handshake received.
         self.conduitID=conduitID #this string might contain radio ID or COM port number.
+        self.maxPackets=maxPackets
+        self.packetsIn=None #asyncio.Queue, made when the conduit is opened
+        self.bytesIn=None #likewise, for bytesReceived
+        self.loop=None #the event loop the conduit was opened on
+    async def open(self):
+        #opens the connection. Subclasses should call this once they have.
+        self.loop=asyncio.get_running_loop()
+        self.packetsIn=asyncio.Queue(self.maxPackets)
+        self.bytesIn=asyncio.Queue()
+        self.state=1
+    def bytesReceived(self,data):
+        #hands bytes from the board to readBytes. Safe to call from any thread.
+        self.loop.call_soon_threadsafe(self.bytesIn.put_nowait,bytes(data))
+    async def readBytes(self):
+        #waits for and returns the next bytes to arrive from the board.
+        return await self.bytesIn.get()
+    def close(self):
+        self.state=0
     def packetTransmit(self,packet):
         #call to transmit a string packet.
         pass
     def packetRetrieve(self,instrument=False):
         #Retrieves the oldest packet in bufferPacketIn. If an instrument is specified,
         #the oldest packet belonging to that instrument will be retrieved instead.
-        pass
+        for p in self.bufferPacketIn:
+            if instrument==False or p[0:2]==instrument.header:
+                self.bufferPacketIn.remove(p)
+                return p
+        return ""
+    async def reader(self):
+        #the reader task.
+        buffer=bytearray()
+        while True:
+            buffer+=await self.readBytes()
+            start=0
+            end=buffer.find(b"\r")
+            while end>-1:
+                await self.packetsIn.put(buffer[start:end].decode("ascii","replace"))
+                start=end+1
+                end=buffer.find(b"\r",start)
+            del buffer[:start]
     def tick(self):
-        #called every frame to handle incoming data, appends new data from the
-        #board onto the bufferPacket array. This buffer contains strings.
-        #Packet interpretation is left to the hub object. This function should also
-        #handle connection and disconnection.
+        #No longer needed: the reader task handles incoming data as it arrives.
         pass
 
 class ConduitRPiSerialArduino(Conduit):
@@ -121,44 +183,99 @@ class ConduitXBeeNetwork(Conduit):
 class ConduitUSBSerial(Conduit):
     #If this program is running on any PC or RPi that is connected to the board
     #via a USB/UART adapter on an arduino, use this conduit.
-    pass
+    #The conduitID is the serial port name.
+    def __init__(self,conduitID="",maxPackets=256,baud=9600):
+        Conduit.__init__(self,conduitID,maxPackets)
+        self.baud=baud
+        self.ch=None
+        self.readable=None
+        self.polled=False
+    async def open(self):
+        self.ch=serial.Serial(self.conduitID,self.baud,timeout=0)
+        await Conduit.open(self)
+        self.readable=asyncio.Event()
+        try:
+            #wake the reader when the port has data, rather than polling it.
+            asyncio.get_running_loop().add_reader(self.ch.fileno(),self.readable.set)
+        except (NotImplementedError,AttributeError):
+            #windows can't watch serial ports from the event loop.
+            self.polled=True
+    async def readBytes(self):
+        while True:
+            #clear before looking, so data arriving in between still wakes us.
+            self.readable.clear()
+            waiting=self.ch.in_waiting
+            if waiting>0:
+                return self.ch.read(waiting)
+            if self.polled:
+                await asyncio.sleep(0.01)
+            else:
+                await self.readable.wait()
+    def close(self):
+        if self.ch!=None:
+            if self.polled==False:
+                #the loop from open, as close may be called from outside it.
+                self.loop.remove_reader(self.ch.fileno())
+            self.ch.close()
+        Conduit.close(self)
+    def packetTransmit(self,packet):
+        self.ch.write((packet+str(chr(13))).encode())
 
 class Instrument:
-    def __init__(self,nameID):
-        #instruments are referred to by name, and slot.
-        pass
+    def __init__(self,nameID,header=""):
+        #instruments are referred to by name, and slot. header is the packet
+        #header the board uses to request and return their measurements.
+        self.nameID=nameID
+        self.header=header
+        self.slot=-1
 class InstrumentPea(Instrument):
     def __init__(self,nameID):
-        pass
+        Instrument.__init__(self,nameID)
 class InstrumentAlphasense(Instrument):
     def __init__(self,nameID):
-        pass
+        Instrument.__init__(self,nameID,"M0")
 class InstrumentKLASP(Instrument):
     def __init__(self,nameID):
-        pass
+        Instrument.__init__(self,nameID)
 class InstrumentHTP(Instrument):
     def __init__(self,nameID):
-        pass
+        Instrument.__init__(self,nameID,"HT")
 class InstrumentBatterySolar(Instrument):
     def __init__(self,nameID):
-        pass
+        Instrument.__init__(self,nameID,"M1")
 
 class Measurement:
-    def __init__(self,instrument):
+    def __init__(self,instrument,data=None,localTime=None,sensorTime=None):
         #instrument should be a new Instrument object. It only represents the
-        #class of object.
+        #class of object. Measurements read back from storage carry the
+        #instrument's name instead.
         self.instrument=instrument
-        self.sensorTime=datetime()
-        self.localTime=datetime()
+        self.data=data
+        if localTime==None:
+            localTime=datetime.datetime.now()
+        self.sensorTime=sensorTime
+        self.localTime=localTime
 
 class Hub:
     #This is the main object around which all others are based. The hub
     #represents the controlling computer. Board can be added to it through
     #conduits, and instruments are then added onto the boards.
-    def __init__(self):
+    #The hub runs on an asyncio event loop, for example
+    #>>> hub=Hub()
+    #>>> hub.boardCreate("b1",ConduitUSBSerial("/dev/ttyUSB0"))
+    #>>> async def main():
+    #...     await hub.start()
+    #...     v=await hub.measure("b1","gas")
+    #>>> asyncio.run(main())
+    #Every conduit gets its own reader task, so one process can look after
+    #many boards without polling any of them.
+    def __init__(self,handshakeTimeout=5,requestTimeout=1.0):
         self.boards=[]
-    def boardCreate(self,boardID,conduit):
-        board=board(boardID)
+        self.tasks=[]
+        self.handshakeTimeout=handshakeTimeout
+        self.requestTimeout=requestTimeout #seconds before a request raises asyncio.TimeoutError
+    def boardCreate(self,boardID,conduit,saveDir="SOGSMeasurements"):
+        board=Board(boardID,saveDir)
         board.conduit=conduit
         self.boards.append(board)
     def loadInstrument(self,boardID,instrument):
@@ -168,22 +285,150 @@ class Hub:
         #make sure instruments is an array.
         board=scanList(self.boards,boardID)
         board.instruments=instruments
+    async def start(self):
+        #opens every board's conduit, starts its tasks and waits for the
+        #handshakes. Boards that don't answer in time stay at state 1.
+        for board in self.boards:
+            await self.boardOpen(board)
+        await asyncio.gather(*[self.handshake(board) for board in self.boards])
+    async def run(self):
+        #starts the hub and keeps it going until cancelled.
+        await self.start()
+        await asyncio.gather(*self.tasks)
+    def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        self.tasks=[]
+        for board in self.boards:
+            board.conduit.close()
+    async def boardOpen(self,board):
+        await board.conduit.open()
+        reader=asyncio.ensure_future(board.conduit.reader())
+        reader.add_done_callback(lambda t:self.readerEnded(board,t))
+        self.tasks.append(reader)
+        self.tasks.append(asyncio.ensure_future(self.dispatch(board)))
+    def readerEnded(self,board,task):
+        #the reader only stops if it is cancelled or the conduit fails, as
+        #when a USB board is pulled out. Nothing outstanding will be answered
+        #then, so every request waiting on the board fails straight away.
+        if task.cancelled():
+            return
+        err=task.exception()
+        print("Lost board "+board.nameID+": "+repr(err))
+        board.conduit.state=0
+        for waiting in board.waiting.values():
+            for f in waiting:
+                if not f.done():
+                    f.set_exception(ConnectionError("lost board "+board.nameID+": "+repr(err)))
+            waiting.clear()
+    async def handshake(self,board):
+        try:
+            packet=await self.request(board,"VV",timeout=self.handshakeTimeout)
+        except asyncio.TimeoutError:
+            print("No handshake from board "+board.nameID)
+            return
+        board.version=packet[2:].split(";")[0] #capabilities follow a ;
+        board.conduit.state=2
+        print("Handshake received from board "+board.nameID+" "+board.version)
+    async def dispatch(self,board):
+        #hands each packet from a board to the oldest request waiting for
+        #its header. If that request has given up, the packet is its late
+        #reply and is thrown away, rather than handed to the next request.
+        while True:
+            packet=await board.conduit.packetsIn.get()
+            waiting=board.waiting.get(packet[0:2])
+            if waiting:
+                f=waiting.popleft()
+                if f.done():
+                    board.lateReplies+=1
+                else:
+                    f.set_result(packet)
+            else:
+                board.conduit.bufferPacketIn.append(packet)
+    def request(self,board,header,command=None,timeout=None):
+        #sends header, or command if there is one, to the board and returns a
+        #future for the reply packet with that header. It raises
+        #asyncio.TimeoutError after timeout seconds, requestTimeout by
+        #default, or ConnectionError if the board is lost.
+        #As in LairCom.expireRequests, a request that has timed out, or been
+        #cancelled, stays in board.waiting for as long again to catch its late
+        #reply, and then goes for good. So a reply that never comes costs the
+        #requests for that header sent in that time, not every later one.
+        loop=asyncio.get_running_loop()
+        f=loop.create_future()
+        if board.conduit.state==0:
+            f.set_exception(ConnectionError("board "+board.nameID+" is not connected"))
+            return f
+        if timeout==None:
+            timeout=self.requestTimeout
+        waiting=board.waiting.setdefault(header,collections.deque())
+        waiting.append(f)
+        loop.call_later(timeout,self.expire,f)
+        loop.call_later(2*timeout,self.forget,waiting,f)
+        board.conduit.packetTransmit(header if command==None else command)
+        return f
+    def expire(self,f):
+        if not f.done():
+            f.set_exception(asyncio.TimeoutError())
+    def forget(self,waiting,f):
+        try:
+            waiting.remove(f)
+        except ValueError:
+            pass
     def boardStart(self,nameID,interval,startTime,stopTime):
         pass
     def boardStop(self,nameID):
         pass
     def measure(self,boardID,instrumentID):
         #requests the board take a single measurement from the specified instrument.
-        pass
-    def get(self,boardID,instrumentID,erase=False):
-        #downloads all measurements from a specific instrument from the board.
-        #returns a measurement array.
-        pass
-    def getAll(self,boardID,erase=False):
+        #returns an awaitable that gives the reply packet once it arrives, see
+        #request.
+        board=scanList(self.boards,boardID)
+        instrument=scanList(board.instruments,instrumentID)
+        return self.request(board,instrument.header)
+    async def burst(self,boardID,instrumentID,count,interval):
+        #has the board take count measurements from the instrument, interval
+        #seconds apart, by itself. They are kept on the board until dump is
+        #called. Only instruments on the M0 and M1 banks can do this.
+        #Returns the number of measurements the board will take.
+        board=scanList(self.boards,boardID)
+        instrument=scanList(board.instruments,instrumentID)
+        bank=instrument.header[1]
+        command="N"+bank+numberToAlphahex(min(count,4095),3)+numberToAlphahex(min(int(round(interval*1000)),65535),4)
+        packet=await self.request(board,"N"+bank,command)
+        board.burstBank=bank
+        return alphahexToUnsigned(packet[2:5])
+    async def dump(self,boardID,instrumentID):
+        #fetches and clears the measurements a burst has taken so far.
+        #Returns (first,counts), where first is the number of the first
+        #measurement in the burst and counts has the ADC counts for each, see
+        #LairCom0_4.alphahexBlockToCounts.
+        #The board only keeps one burst, and answers any D command with the
+        #bank of that burst, emptying it. So asking for the other bank's is
+        #refused rather than sent. A burst the hub didn't start is assumed to
+        #be on the instrument's bank.
+        board=scanList(self.boards,boardID)
+        bank=scanList(board.instruments,instrumentID).header[1]
+        if board.burstBank!=None and board.burstBank!=bank:
+            raise ValueError("the burst on board "+board.nameID+" is of bank "+board.burstBank+", not "+bank)
+        packet=await self.request(board,"D"+bank)
+        return alphahexToUnsigned(packet[2:6]),alphahexBlockToCounts(packet[6:])
+    async def get(self,boardID,instrumentID,erase=False,startTime=None,stopTime=None):
+        #downloads all measurements from a specific instrument from the board,
+        #optionally only those between startTime and stopTime.
+        #returns a measurement array. The files are read on another thread so
+        #the conduits keep being served meanwhile.
+        board=scanList(self.boards,boardID)
+        return await asyncio.get_running_loop().run_in_executor(None,lambda:list(board.getMeasurements(instrumentID,startTime,stopTime)))
+    async def getAll(self,boardID,erase=False):
         #downloads all measurements from all instruments from the board.
         #returns a measurement array.
-        pass
+        out=[]
+        for instrument in scanList(self.boards,boardID).instruments:
+            out+=await self.get(boardID,instrument.nameID,erase)
+        return out
     def tick(self):
+        #No longer needed: the event loop drives the conduits.
         pass
 
 def scanListForIndex(l,nameID):
@@ -192,7 +437,7 @@ def scanListForIndex(l,nameID):
     for cl in l:
         if nameID==cl.nameID:
             break
-        c++
+        c+=1
     return c
 
 def scanList(l,nameID):
@@ -0,0 +1,272 @@
+#Written for python 3
+#A stand in for a board running arduino/sogs0_4/sogs0_4.ino, for trying out
+#and testing the python side without one. An Emulator looks enough like a
+#pyserial port for LairCom to use it:
+#>>> import LairCom0_4,SOGSEmulator
+#>>> lc=LairCom0_4.LairCom()
+#>>> lc.ch=SOGSEmulator.Emulator()
+#>>> lc.mode=1
+#after which tick() shakes hands with it as it would with a board.
+#For anything that opens a port itself, PtyBoard puts an Emulator on the
+#far end of a pseudo terminal (linux/mac only):
+#>>> pb=SOGSEmulator.PtyBoard(latency=0.01,baud=9600)
+#>>> lu=LairUI(port=pb.port)
+#or from the command line
+#python3 SOGSEmulator.py [baud] [latency] [noise]
+#prints the port name and serves it until interrupted.
+#It follows the firmware's protocol, bugs and all: VV, BB, M0, M1, N0, N1,
+#D0, D1, HT, tG and tS. Analog readings come from analog(bank,pin,t), which
+#by default gives slow sine waves, a different one for each pin.
+
+import math
+import time
+import os
+import sys
+import random
+import threading
+import select
+import datetime
+import struct
+import binascii
+from LairCom0_4 import slip
+from LairCom0_4 import packSamples
+from LairCom0_4 import numberToAlphahex
+from LairCom0_4 import alphahexToUnsigned
+
+#middle of the readings for each pin of bank 1, where the humidity sensor
+#and bus voltage are. MCTHB can't make sense of just any numbers.
+bank1Levels=[512,430,430,860,860,512,512,512]
+
+def defaultAnalog(bank,pin,t):
+    #a 10 bit reading for pin of bank at time t in seconds.
+    if bank==1:
+        return int(bank1Levels[pin]+20*math.sin(t/(10+pin)+pin))&1023
+    return int(512+400*math.sin(t/(10+pin)+pin))&1023
+
+def u12ToAlphahex(i):
+    #as the firmware's u12ToAlphahex.
+    return numberToAlphahex(i&4095,3)
+
+def firmwareByteToAlphahex(b):
+    #as the firmware's byteToAlphahex, which doesn't shift the high nibble
+    #down. The result is latin-1, like the bytes the board sends.
+    return chr(((b&0xf0)+97)&255)+chr((b&0x0f)+97)
+
+class Emulator:
+    progID="LAir 0.1"
+    progCaps="bin,rtc"
+    burstMax=48
+    def __init__(self,analog=defaultAnalog,clock=time.monotonic,caps=None,rtcDrift=0):
+        self.analog=analog
+        self.clock=clock #seconds, as millis() is to the board
+        self.caps=self.progCaps if caps==None else caps #"" for old firmware
+        self.input=bytearray() #bytes written to the board, not yet a command
+        self.output=bytearray() #bytes the board has sent, not yet read
+        self.is_open=True
+        self.timeout=0
+        self.binMode=False
+        self.bank=0 #which bank the analog switch is on
+        self.rtcOffset=datetime.timedelta(0) #what tS sets, relative to the computer's clock
+        self.rtcDrift=rtcDrift #how much fast the board's clock runs, in parts per million
+        self.rtcStart=datetime.datetime.now()
+        self.commands=0
+        self.burstStart("0",0,0)
+    #pyserial's interface, as much of it as LairCom uses.
+    @property
+    def in_waiting(self):
+        self.run()
+        return len(self.output)
+    def inWaiting(self):
+        return self.in_waiting
+    def read(self,n=1):
+        self.run()
+        out=bytes(self.output[0:n])
+        del self.output[0:n]
+        return out
+    def write(self,data):
+        self.run()
+        self.input+=data
+        end=self.input.find(b"\r")
+        while end>-1:
+            s=self.input[0:end].decode("latin-1")
+            del self.input[0:end+1]
+            self.processSerial(s)
+            end=self.input.find(b"\r")
+        return len(data)
+    def close(self):
+        self.is_open=False
+    def fileno(self):
+        raise OSError("an Emulator has no file descriptor")
+    #the firmware.
+    def run(self):
+        #what loop() would have done since the last call: burst readings.
+        now=self.clock()
+        while self.burstLeft>0 and now-self.burstLast>=self.burstInterval:
+            self.burstLast+=self.burstInterval
+            self.burstRun(self.burstLast)
+    def putSerial(self,s):
+        self.output+=s.encode("latin-1")+b"\r"
+    def processSerial(self,s):
+        self.commands+=1
+        if len(s)<=1:
+            return
+        t=s[0:2]
+        if t=="VV":
+            self.putSerial("VV"+self.progID+(";"+self.caps if self.caps!="" else ""))
+        elif t=="BB" and "bin" in self.caps.split(","):
+            self.binMode=s[2:3]=="1"
+            self.putSerial("BB1" if self.binMode else "BB0")
+        elif t=="HT":
+            self.putSerial("HT"+self.readCC2D25())
+        elif t=="tS":
+            self.setTime(s[3:])
+            self.putSerial("OK")
+        elif t=="tG":
+            self.putSerial("tG"+self.getTime())
+        elif t=="M0" or t=="M1":
+            self.bank=int(t[1])
+            counts=self.measure(self.clock())
+            if self.binMode:
+                self.putFrame(t,packSamples(counts))
+            else:
+                self.putSerial(t+"".join([u12ToAlphahex(n) for n in counts]))
+        elif (t=="N0" or t=="N1") and len(s)>=9:
+            self.burstStart(t[1],alphahexToUnsigned(s[2:5]),alphahexToUnsigned(s[5:9]))
+            self.putSerial(t+u12ToAlphahex(self.burstLeft))
+        elif t[0]=="D":
+            self.putDump()
+    def measure(self,t):
+        return [self.analog(self.bank,pin,t) for pin in range(0,8)]
+    def putFrame(self,header,payload):
+        raw=header.encode("ascii")+struct.pack("<H",len(payload))+payload
+        self.output+=slip(raw+struct.pack("<H",binascii.crc_hqx(raw,0xffff)))
+    def burstStart(self,bank,count,interval):
+        self.burstBank=bank
+        self.burstLeft=count
+        self.burstInterval=interval/1000
+        self.burstRing=[]
+        self.burstFirst=0
+        self.burstLast=self.clock()-self.burstInterval #the first reading is taken straight away
+    def burstRun(self,t):
+        self.bank=int(self.burstBank)
+        if len(self.burstRing)==self.burstMax:
+            del self.burstRing[0]
+            self.burstFirst+=1
+        self.burstRing.append(self.measure(t))
+        self.burstLeft-=1
+    def putDump(self):
+        if self.binMode:
+            self.putFrame("D"+self.burstBank,struct.pack("<H",self.burstFirst&65535)+b"".join([packSamples(r) for r in self.burstRing]))
+        else:
+            self.putSerial("D"+self.burstBank+numberToAlphahex(self.burstFirst&65535,4)+"".join([u12ToAlphahex(n) for r in self.burstRing for n in r]))
+        self.burstFirst+=len(self.burstRing)
+        self.burstRing=[]
+    def readCC2D25(self):
+        #humidity and temperature counts, 14 bits each, as the firmware
+        #mangles them.
+        h=int(16383*0.45)
+        tc=int(16383*(22+40)/165)
+        c0,c1,c2,c3=h>>8,h&255,(tc>>6)<<2,(tc&63)<<2
+        return firmwareByteToAlphahex(c0&0x3f)+firmwareByteToAlphahex(c1)+firmwareByteToAlphahex((c2&0xfc)//4)+firmwareByteToAlphahex(c3//4+(c2&0x03)*64)
+    def rtc(self):
+        now=datetime.datetime.now()
+        return now+self.rtcOffset+(now-self.rtcStart)*self.rtcDrift/1e6
+    def getTime(self):
+        #the M41T83's BCD registers, year first, as the firmware sends them:
+        #in alphahex if it lists rtc, otherwise each written out in decimal.
+        t=self.rtc()
+        b=[t.year%100,t.month,t.day,t.hour,t.minute,t.second,t.microsecond//10000]
+        if "rtc" in self.caps.split(","):
+            return "".join([numberToAlphahex((v//10)*16+v%10,2) for v in b])
+        return "".join([str((v//10)*16+v%10) for v in b])
+    def setTime(self,s):
+        #the firmware writes each character less 20 to the clock registers
+        #as BCD, year first.
+        def bcd(c):
+            v=(ord(c)-20)&255
+            return (v>>4)*10+(v&15)
+        try:
+            t=datetime.datetime(2000+bcd(s[0]),bcd(s[1]),bcd(s[2]),bcd(s[3]),bcd(s[4]),bcd(s[5]))
+            self.rtcOffset=t-datetime.datetime.now()
+        except (IndexError,ValueError):
+            pass
+
+class PtyBoard:
+    #Serves an Emulator on a pseudo terminal from a thread of its own.
+    #port is the name to open, as if it were the board's serial port.
+    #latency is the seconds the board takes to start answering a command,
+    #baud limits how fast its replies go out (None for as fast as possible)
+    #and noise is the chance of each byte sent being corrupted.
+    def __init__(self,emulator=None,latency=0,baud=None,noise=0,seed=None):
+        import pty
+        import tty
+        self.emulator=Emulator() if emulator==None else emulator
+        self.latency=latency
+        self.baud=baud
+        self.noise=noise
+        self.random=random.Random(seed)
+        self.master,self.slave=pty.openpty()
+        #raw, so carriage returns get through untouched. The slave end is
+        #held open so the pty lasts while the port is closed and reopened.
+        tty.setraw(self.slave)
+        self.port=os.ttyname(self.slave)
+        self.bytesIn=0
+        self.bytesOut=0
+        self.running=True
+        self.thread=threading.Thread(target=self.serve,daemon=True)
+        self.thread.start()
+    def serve(self):
+        while self.running:
+            try:
+                r=select.select([self.master],[],[],0.05)[0]
+                if len(r)==0:
+                    continue
+                data=os.read(self.master,4096)
+            except OSError:
+                return
+            self.bytesIn+=len(data)
+            self.emulator.write(data)
+            out=self.emulator.read(self.emulator.in_waiting)
+            if len(out)>0:
+                if self.latency>0:
+                    time.sleep(self.latency)
+                self.send(out)
+    def send(self,out):
+        if self.noise>0:
+            out=bytearray(out)
+            for i in range(0,len(out)):
+                if self.random.random()<self.noise:
+                    out[i]=self.random.randrange(256)
+        if self.baud==None:
+            self.put(out)
+            return
+        #ten bits a byte on the wire; sent in slices so replies trickle in.
+        chunk=max(1,self.baud//1000)
+        start=time.monotonic()
+        for i in range(0,len(out),chunk):
+            due=start+(i+chunk)*10/self.baud
+            self.put(out[i:i+chunk])
+            wait=due-time.monotonic()
+            if wait>0:
+                time.sleep(wait)
+    def put(self,data):
+        try:
+            os.write(self.master,data)
+            self.bytesOut+=len(data)
+        except OSError:
+            self.running=False
+    def close(self):
+        self.running=False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__=="__main__":
+    args=sys.argv[1:]+[None,"0","0"][len(sys.argv)-1:]
+    pb=PtyBoard(baud=None if args[0] in [None,"0"] else int(args[0]),latency=float(args[1]),noise=float(args[2]))
+    print(pb.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pb.close()
@@ -0,0 +1,131 @@
+#Written for python 3
+#Counters and histograms for keeping an eye on a running SOGS program.
+#LairCom and LairUI keep theirs in a Metrics object,
+#>>> lc.stats()
+#returns a snapshot as a dict, and
+#>>> lc.metrics.serve(9100)
+#serves them at http://127.0.0.1:9100/metrics in the Prometheus text format.
+#Counting is a dict update and observing a histogram a bisect, so they can go
+#on the hot path without slowing it down.
+
+import bisect
+import threading
+import http.server
+
+#bucket upper bounds in seconds, from 100 us to a minute.
+defaultBounds=[0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60]
+
+class Histogram:
+    #counts observations into buckets with fixed upper bounds, as Prometheus
+    #does. The last bucket holds everything above the highest bound.
+    def __init__(self,bounds=defaultBounds):
+        self.bounds=bounds
+        self.counts=[0]*(len(bounds)+1)
+        self.sum=0.0
+        self.count=0
+        self.max=0.0
+    def observe(self,v):
+        self.counts[bisect.bisect_left(self.bounds,v)]+=1
+        self.sum+=v
+        self.count+=1
+        if v>self.max:
+            self.max=v
+    def quantile(self,q):
+        #the upper bound of the bucket holding the q'th quantile, or the
+        #largest observation if it is past the last bound.
+        if self.count==0:
+            return None
+        rank=q*self.count
+        seen=0
+        for i in range(0,len(self.bounds)):
+            seen+=self.counts[i]
+            if seen>=rank:
+                return min(self.bounds[i],self.max)
+        return self.max
+    def snapshot(self):
+        return {"count":self.count,"sum":self.sum,"mean":self.sum/self.count if self.count>0 else None,
+                "max":self.max,"p50":self.quantile(0.5),"p90":self.quantile(0.9),"p99":self.quantile(0.99)}
+
+class Metrics:
+    #A set of named counters, histograms and gauges. Histograms can be split
+    #by labels, for instance per controller; a gauge is a function called
+    #whenever the metrics are read.
+    def __init__(self,prefix="sogs"):
+        self.prefix=prefix
+        self.counters={}
+        self.histograms={} #(name,labels) -> Histogram, labels a tuple of (key,value)
+        self.gauges={}
+        self.server=None
+    def count(self,name,n=1):
+        self.counters[name]=self.counters.get(name,0)+n
+    def histogram(self,name,labels=()):
+        h=self.histograms.get((name,labels))
+        if h==None:
+            h=self.histograms[(name,labels)]=Histogram()
+        return h
+    def observe(self,name,v,labels=()):
+        self.histogram(name,labels).observe(v)
+    def gauge(self,name,f):
+        self.gauges[name]=f
+    def stats(self):
+        #everything as a dict. Histograms are summarised, see Histogram.snapshot.
+        out={"counters":dict(self.counters),"gauges":{},"histograms":{}}
+        for name,f in self.gauges.items():
+            out["gauges"][name]=f()
+        for (name,labels),h in list(self.histograms.items()):
+            key=name+"".join(["{"+k+"="+v+"}" for (k,v) in labels])
+            out["histograms"][key]=h.snapshot()
+        return out
+    def prometheus(self):
+        #everything in the Prometheus text exposition format.
+        lines=[]
+        for name,v in sorted(self.counters.items()):
+            n=self.prefix+"_"+name+"_total"
+            lines.append("# TYPE "+n+" counter")
+            lines.append(n+" "+str(v))
+        for name,f in sorted(self.gauges.items()):
+            n=self.prefix+"_"+name
+            lines.append("# TYPE "+n+" gauge")
+            lines.append(n+" "+str(float(f())))
+        typed=set()
+        for (name,labels),h in sorted(list(self.histograms.items())):
+            n=self.prefix+"_"+name
+            if n not in typed:
+                lines.append("# TYPE "+n+" histogram")
+                typed.add(n)
+            l="".join([k+"=\""+v+"\"," for (k,v) in labels])
+            seen=0
+            for i in range(0,len(h.bounds)):
+                seen+=h.counts[i]
+                lines.append(n+"_bucket{"+l+"le=\""+repr(float(h.bounds[i]))+"\"} "+str(seen))
+            lines.append(n+"_bucket{"+l+"le=\"+Inf\"} "+str(h.count))
+            l="{"+l[:-1]+"}" if l!="" else ""
+            lines.append(n+"_sum"+l+" "+repr(h.sum))
+            lines.append(n+"_count"+l+" "+str(h.count))
+        return "\n".join(lines)+"\n"
+    def serve(self,port,host="127.0.0.1"):
+        #serves prometheus() at /metrics from a thread of its own, until
+        #close() is called. Returns the server.
+        metrics=self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0]!="/metrics":
+                    self.send_error(404)
+                    return
+                body=metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type","text/plain; version=0.0.4")
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self,*args):
+                pass
+        self.server=http.server.ThreadingHTTPServer((host,port),Handler)
+        self.server.daemon_threads=True
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        return self.server
+    def close(self):
+        if self.server!=None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server=None
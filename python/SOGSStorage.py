@@ -0,0 +1,412 @@
+#Written for python 3
+#Storage backends for SOGS measurements. This module only deals with files;
+#turning their contents into Measurement objects is left to LairCom.
+#
+#Two layouts are understood, both under a save directory split by day:
+#   saveDir/2014-01-31/14-51-00_877269.txt
+#       the original layout, one file per measurement cycle.
+#   saveDir/2014-01-31/14-51-00_877269.seg
+#       a segment: one file holding many measurement cycles, appended to
+#       until it is rotated. Every cycle starts with its own epoch line.
+#Both use the same tagged line format:
+#   comment#
+#   delineator/
+#   #a comment
+#   kind/SOGSdata
+#   epoch/2014-01-31/14:51:00.877269
+#   m/gas/2014-01-31/14:51:00.811318/1.25/4.921875/...
+#   rtc/gas/1391179860811318000/1391179860716318000
+#The rtc line, where the board's clock is known, has the time of the
+#measurement before it in nanoseconds since 1970: by the computer's clock in
+#UTC, as time.time_ns() gives, and by the board's clock (see
+#LairCom0_4.rtcToNs). The m and epoch lines go by local time.
+#Measurements can also be kept in binary archives, described further down.
+
+import os
+import datetime
+import time
+import struct
+import bisect
+try:
+    import numpy as np
+except ImportError:
+    np=None #only needed to read binary archives
+
+def splitLine(line,delin,comment):
+    #strips comments, returns a string array of delineator seperated values.
+    #Does the same as LairCom's chopString.
+    if comment!="":
+        line=line.split(comment,1)[0]
+    if line=="":
+        return []
+    return line.split(delin)
+
+def dayDirectory(saveDir,dt):
+    #returns the day directory a measurement taken at dt belongs in, making it if needed.
+    d=saveDir+"/"+dt.date().isoformat()
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    return d
+
+def timeFileName(dt):
+    #the file name stem used by both layouts, e.g. 14-51-00_877269
+    s=dt.time().isoformat().replace(":","-")
+    return s.replace(".","_")
+
+class SegmentWriter:
+    #Appends measurement cycles to a rolling per-day segment file instead of
+    #creating a new file for each one. The file is kept open. Records are
+    #buffered in memory and written in one go when either flushRecords are
+    #waiting or flushSeconds have passed since the last flush, so the file
+    #only ever ends on a whole record. A new segment is started on a new day,
+    #once the current one reaches rotateBytes, or after rotateSeconds.
+    #Every indexEvery-th record is also noted in a sparse index beside the
+    #segment, see readSegmentIndex.
+    def __init__(self,saveDir,flushSeconds=10,flushRecords=60,rotateBytes=64*1024*1024,rotateSeconds=86400,indexEvery=256):
+        self.saveDir=saveDir
+        self.flushSeconds=flushSeconds
+        self.flushRecords=flushRecords
+        self.rotateBytes=rotateBytes
+        self.rotateSeconds=rotateSeconds
+        self.delin="/"
+        self.comment="#"
+        self.file=None
+        self.path=""
+        self.day=None
+        self.size=0 #bytes in the current segment, including the buffer
+        self.opened=0 #time.monotonic() when the current segment was started
+        self.pending=[] #records waiting to be written
+        self.lastFlush=time.monotonic()
+        self.indexEvery=indexEvery
+        self.indexFile=None
+        self.indexPending=[] #index lines waiting to be written
+        self.records=0 #records in the current segment
+        self.last=None #time of the newest record in the current segment
+    def write(self,dt,lines):
+        #adds a measurement cycle taken at dt. lines is a list of m lines,
+        #without newlines.
+        now=time.monotonic()
+        if self.file==None or dt.date()!=self.day or self.size>=self.rotateBytes or now-self.opened>=self.rotateSeconds:
+            self.rotate(dt)
+        if self.records%self.indexEvery==0:
+            self.indexPending.append(str(datetimeToNs(dt))+" "+str(self.size)+"\n")
+        self.records+=1
+        self.last=dt
+        d=self.delin
+        record="epoch"+d+dt.date().isoformat()+d+dt.time().isoformat()+"\n"
+        for line in lines:
+            record+=line+"\n"
+        self.pending.append(record)
+        self.size+=len(record)
+        if len(self.pending)>=self.flushRecords or now-self.lastFlush>=self.flushSeconds:
+            self.flush()
+    def flush(self):
+        if len(self.pending)>0:
+            self.file.write("".join(self.pending).encode())
+            self.pending=[]
+        if len(self.indexPending)>0:
+            #after the records, so the index never points past the data.
+            self.indexFile.write("".join(self.indexPending))
+            self.indexFile.flush()
+            self.indexPending=[]
+        self.lastFlush=time.monotonic()
+    def rotate(self,dt):
+        #closes the current segment and starts a new one.
+        self.close()
+        self.path=dayDirectory(self.saveDir,dt)+"/"+timeFileName(dt)+".seg"
+        #unbuffered, as the records are gathered up in self.pending already.
+        self.file=open(self.path,"ab",buffering=0)
+        self.indexFile=open(self.path+".idx","a")
+        self.records=0
+        self.day=dt.date()
+        self.opened=time.monotonic()
+        header="comment"+self.comment+"\n"
+        header+="delineator"+self.delin+"\n"
+        header+=self.comment+"This is a segment file for SOGS started at date/time\n"
+        header+="kind"+self.delin+"SOGSdata\n"
+        self.file.write(header.encode())
+        self.size=len(header)
+    def close(self):
+        if self.file!=None:
+            self.flush()
+            self.file.close()
+            self.file=None
+            if self.last!=None:
+                self.indexFile.write("max "+str(datetimeToNs(self.last))+"\n")
+            self.indexFile.close()
+            self.indexFile=None
+
+def measurementFiles(saveDir):
+    #yields the path of every measurement file or segment under saveDir, in order.
+    for (path,dirs,files) in os.walk(saveDir):
+        dirs.sort()
+        files.sort()
+        for f in files:
+            if f[-4:]==".txt" or f[-4:]==".seg":
+                yield path+"/"+f
+            elif f[-8:]==".seg.idx":
+                pass
+            else:
+                print("Skipped non-text file"+path+"/"+f)
+
+def readRecords(path,offset=0):
+    #yields (date, time, mtags) for every measurement cycle in a file of either
+    #layout, where mtags is a list of the tag lists of its m lines. If offset
+    #is given, reading carries on from there after the file header; it must
+    #be the start of a record, such as the size of a segment when it was last
+    #read.
+    try:
+        f=open(path,"r")
+    except OSError:
+        print("Could not open "+path)
+        return
+    try:
+        for r in _readRecords(f,path,offset):
+            yield r
+    finally:
+        #also closes the file when the caller stops reading early.
+        f.close()
+
+def _readRecords(f,path,offset):
+    comment=""
+    delin=""
+    kind=""
+    record=None
+    held=[] #records read before the file said what kind it is
+    try:
+        while True:
+            line=f.readline()
+            if line[-1:]=="\n":
+                line=line[:-1] #strip off the newline character if there is one.
+            if line=="":
+                break #exit file on empty line
+            if comment=="" or delin=="":
+                if line[:-1]=="comment":
+                    comment=line[-1:]
+                if line[:-1]=="delineator":
+                    delin=line[-1:]
+                if offset>0 and comment!="" and delin!="":
+                    f.seek(offset)
+                    kind="SOGSdata" #only segments are resumed, and they say so up front.
+                continue
+            #splitLine, inlined as this runs for every line.
+            if comment in line:
+                line=line[:line.index(comment)]
+                if line=="":
+                    continue
+            tags=line.split(delin)
+            if tags[0]=="epoch":
+                if record!=None:
+                    if kind=="SOGSdata":
+                        yield record
+                    elif kind=="":
+                        held.append(record)
+                record=(str(tags[1]),str(tags[2]),[])
+            elif tags[0]=="kind":
+                kind=str(tags[1])
+                if kind=="SOGSdata":
+                    for r in held:
+                        yield r
+                held=[]
+            elif tags[0]=="m" and record!=None:
+                record[2].append(tags)
+    except UnicodeDecodeError:
+        print("Unparseable character in file: "+path)
+        return
+    if comment=="" or delin=="" or kind!="SOGSdata":
+        print("Unrecognized file: "+path)
+        return
+    if record!=None:
+        yield record
+
+def readSegmentIndex(path):
+    #Returns (entries, max) for a segment. entries is a list of (time in ns,
+    #byte offset) for every indexEvery-th record, and max is the time of the
+    #last record in ns, or None if the segment may still be growing. Segments
+    #without an index file are scanned for one.
+    entries=[]
+    last=None
+    if os.path.exists(path+".idx"):
+        f=open(path+".idx","r")
+        for line in f:
+            tags=line.split()
+            if len(tags)==2:
+                if tags[0]=="max":
+                    last=int(tags[1])
+                else:
+                    entries.append((int(tags[0]),int(tags[1])))
+        f.close()
+        return (entries,last)
+    f=open(path,"rb")
+    offset=0
+    for line in f:
+        if line[0:6]==b"epoch/":
+            tags=line.decode().rstrip("\n").split("/")
+            entries.append((datetimeToNs(tags[1]+"T"+tags[2]),offset))
+        offset+=len(line)
+    f.close()
+    return (entries,None)
+
+def fileNameTime(name):
+    #turns a file name like 14-51-00_877269.seg back into 14:51:00.877269
+    return name[:-4].replace("-",":").replace("_",".")
+
+def query(saveDir,name,start=None,stop=None,slack=60):
+    #Yields ("dateTtime", data tags) for every m line of controller name taken
+    #between the datetimes start and stop, inclusive; None for either end
+    #means unbounded. Day directories and legacy files outside the range are
+    #skipped by name. Segments are skipped using their index, and the rest
+    #are read from the nearest indexed record before start until the first
+    #record after stop. slack is how many seconds a cycle's epoch line may
+    #come after the measurements in it, which is what the index holds.
+    if start==None:
+        lo=""
+        loSlack=""
+    else:
+        lo=start.isoformat()
+        loSlack=(start-datetime.timedelta(seconds=slack)).isoformat()
+    if stop==None:
+        hi="9"
+        hiSlack="9"
+    else:
+        hi=stop.isoformat()
+        hiSlack=(stop+datetime.timedelta(seconds=slack)).isoformat()
+    loNs=None
+    if start!=None:
+        loNs=datetimeToNs(start)-slack*1000000000
+    for day in sorted(os.listdir(saveDir)):
+        if len(day)!=10 or day<loSlack[:10] or day>hiSlack[:10]:
+            continue
+        files=sorted(os.listdir(saveDir+"/"+day))
+        for f in files:
+            if f[-4:]!=".txt" and f[-4:]!=".seg":
+                continue
+            t=day+"T"+fileNameTime(f)
+            if t>hiSlack:
+                break #the files are named by when they were started.
+            path=saveDir+"/"+day+"/"+f
+            offset=0
+            if f[-4:]==".txt":
+                if t<loSlack:
+                    continue
+            else:
+                (entries,last)=readSegmentIndex(path)
+                if last!=None and loNs!=None and last<loNs:
+                    continue
+                if loNs!=None:
+                    i=bisect.bisect_right(entries,(loNs,-1))-1
+                    if i>=0:
+                        offset=entries[i][1]
+            for (rdate,rtime,mtags) in readRecords(path,offset):
+                if rdate+"T"+rtime>hiSlack:
+                    break
+                for tags in mtags:
+                    if tags[1]==name:
+                        mt=tags[2]+"T"+tags[3]
+                        if mt>=lo and mt<=hi:
+                            yield (mt,tags[4:])
+
+def archiveRange(archive,start=None,stop=None):
+    #returns the part of an archive from openArchive that lies between the
+    #datetimes start and stop, inclusive. The archive must be in time order.
+    lo=0
+    hi=len(archive)
+    if start!=None:
+        lo=np.searchsorted(archive["t"],datetimeToNs(start),side="left")
+    if stop!=None:
+        hi=np.searchsorted(archive["t"],datetimeToNs(stop),side="right")
+    return archive[lo:hi]
+
+#Binary archives. One file per measure controller holds fixed width records:
+#an int64 time in nanoseconds followed by one float per data column, all
+#little endian. The file starts with a small header:
+#   8 bytes     magic, SOGSARC1
+#   4 bytes     uint32, length of the whole header including padding
+#   the rest    tag lines, padded with newlines to a multiple of 8 bytes:
+#               name/gas
+#               dtype/f4
+#               columns/Battery/Pressure/LDR/...
+#The records can then be read with numpy.memmap, see openArchive.
+archiveMagic=b"SOGSARC1"
+archiveTimeEpoch=datetime.datetime(1970,1,1)
+
+def datetimeToNs(dt):
+    #nanoseconds since 1970 for a datetime or a "dateTtime" string. Naive
+    #datetimes are taken as they are; no time zone conversion is done.
+    if isinstance(dt,str):
+        dt=datetime.datetime.fromisoformat(dt)
+    return (dt-archiveTimeEpoch)//datetime.timedelta(microseconds=1)*1000
+
+def nsToDatetime(ns):
+    return archiveTimeEpoch+datetime.timedelta(microseconds=int(ns)//1000)
+
+def readArchiveHeader(f):
+    #returns (name, dtype, columns, header length) from an open archive file.
+    if f.read(8)!=archiveMagic:
+        raise ValueError("not a SOGS archive")
+    length=struct.unpack("<I",f.read(4))[0]
+    name=""
+    dtype="f4"
+    columns=[]
+    for line in f.read(length-12).decode().split("\n"):
+        tags=line.split("/")
+        if tags[0]=="name":
+            name=tags[1]
+        elif tags[0]=="dtype":
+            dtype=tags[1]
+        elif tags[0]=="columns":
+            columns=tags[1:]
+    return (name,dtype,columns,length)
+
+class ArchiveWriter:
+    #Appends measurements from one measure controller to a binary archive.
+    #An existing archive is appended to if its columns match, or replaced
+    #if append is False.
+    def __init__(self,path,name,columns,dtype="f4",append=True):
+        if dtype not in ("f4","f8"):
+            raise ValueError("archive dtype must be f4 or f8")
+        self.path=path
+        self.columns=columns
+        if append==True and os.path.exists(path) and os.path.getsize(path)>0:
+            f=open(path,"rb")
+            (oldname,dtype,oldcolumns,length)=readArchiveHeader(f)
+            f.close()
+            if oldcolumns!=columns:
+                raise ValueError(path+" holds columns "+"/".join(oldcolumns)+", not "+"/".join(columns))
+            self.file=open(path,"ab")
+        else:
+            header=("name/"+name+"\ndtype/"+dtype+"\ncolumns/"+"/".join(columns)+"\n").encode()
+            length=12+len(header)
+            header+=b"\n"*((-length)%8)
+            self.file=open(path,"wb")
+            self.file.write(archiveMagic+struct.pack("<I",12+len(header))+header)
+        self.dtype=dtype
+        self.record=struct.Struct("<q"+str(len(columns))+("f" if dtype=="f4" else "d"))
+    def write(self,dt,values):
+        #dt may be a datetime, a "dateTtime" string or nanoseconds already.
+        if not isinstance(dt,int):
+            dt=datetimeToNs(dt)
+        self.file.write(self.record.pack(dt,*values))
+    def flush(self):
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
+def archiveDtype(columns,dtype="f4"):
+    #the numpy record type of an archive with these columns.
+    return np.dtype([("t","<i8")]+[(c,"<"+dtype) for c in columns])
+
+def openArchive(path,mode="r"):
+    #returns a numpy.memmap of the records in an archive, with a field "t" for
+    #the time in nanoseconds and one field per column. A record cut short by
+    #a crash at the end of the file is left out.
+    if np is None:
+        raise ImportError("reading archives needs numpy")
+    f=open(path,"rb")
+    (name,dtype,columns,length)=readArchiveHeader(f)
+    f.close()
+    rt=archiveDtype(columns,dtype)
+    n=(os.path.getsize(path)-length)//rt.itemsize
+    if n==0:
+        return np.zeros(0,dtype=rt)
+    return np.memmap(path,dtype=rt,mode=mode,offset=length,shape=(n,))
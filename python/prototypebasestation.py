@@ -7,15 +7,22 @@ Dependencies:
 
 """
 
-from xbee import ZigBee
-from apscheduler.scheduler import Scheduler
+try:
+    from xbee import ZigBee
+except ImportError:
+    ZigBee = None
+try:
+    from apscheduler.scheduler import Scheduler
+except ImportError:
+    Scheduler = None
 import serial
+import threading
+import warnings
 
 # Implementation of logging library required
 #import logging
 #import datetime
 import time
-from time import gmtime, strftime
 
 # Used to store received messages
 import queue
@@ -29,107 +36,346 @@ BROADCAST = b'\x00\x00\x00\x00\x00\x00\xFF\xFF'
 # This is the 'I don't know' 16 bit address
 UNKNOWN = b'\xFF\xFE'
 
-# Store all network keys in list, retreive using index
-# network_long = ['\x00\x00\x00\x00\x00\x00\xff\xff']  # etc
-# network_short = ['\x00\x00']  # etc
 
-'''Function Definitions'''
+'''Class Definitions'''
 
 
-def message_received(data):
+class BaseStation:
+    """
+    Receives frames from the XBee network and hands them to a handler chosen
+    by the frame id.
+
+    The XBee library calls message_received from its own thread; run() blocks
+    on the queue and handles everything that has arrived each time it wakes,
+    up to batch frames at once.
+
+    Inputs:     port - serial port of the base XBee, or None for no port
+                baud_rate - serial baud rate
+                xbee_class - ZigBee, or anything with the same constructor,
+                             send() and halt(), e.g. FakeZigBee
+                batch - most frames handled per wake-up
+                query_seconds - interval at which each known node is
+                                queried, 0 for none
+                discover_seconds - interval of the query broadcast that
+                                   finds new nodes, 0 for none
+    """
+
+    def __init__(self, port=PORT, baud_rate=BAUD_RATE, xbee_class=ZigBee,
+                 batch=64, query_seconds=15, discover_seconds=300):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.xbee_class = xbee_class
+        self.batch = batch
+        self.query_seconds = query_seconds
+        self.discover_seconds = discover_seconds
+        # Node table, 64bit address -> {'addr': 16bit address, 'seen': last
+        #  time a frame came from it, 'rssi': signal strength if the frame
+        #  had one, 'job': its scheduled query}
+        self.nodes = {}
+        # Unicasts awaiting tx_status, frame id -> (64bit address, payload)
+        self.pending = {}
+        self.frame_id = 0
+        self.lock = threading.Lock()
+        # Queue of (arrival time, frame) in which to store packets when
+        #  received. None wakes run() up to stop.
+        self.packets = queue.Queue()
+        self.handlers = {'tx_status': self.handle_tx_status,
+                         'rx': self.handle_rx}
+        self.ser = None
+        self.xbee = None
+        self.scheduler = None
+        self.running = False
+        self.reset_stats()
+
+    def start(self):
+        """
+        Opens the serial port, creates the XBee API object (which spawns a
+        new thread) and starts the scheduled tasks. Without apscheduler
+        there are no scheduled tasks, which is warned about.
+        """
+        if self.xbee_class is None:
+            raise RuntimeError('The xbee library is not installed; give '
+                               'xbee_class=FakeZigBee to run without a radio')
+        if self.port is not None:
+            self.ser = serial.Serial(self.port, self.baud_rate)
+        self.xbee = self.xbee_class(self.ser, callback=self.message_received,
+                                    escaped=True)
+        if Scheduler is not None:
+            self.scheduler = Scheduler()
+            self.scheduler.start()
+            if self.discover_seconds:
+                self.scheduler.add_interval_job(
+                    self.sendQueryPacket, seconds=self.discover_seconds)
+            for address_long in self.nodes:
+                self.schedule_node(address_long)
+        elif self.query_seconds or self.discover_seconds:
+            warnings.warn('apscheduler is not installed, so nodes will not '
+                          'be queried or discovered')
+        self.running = True
+        self.started = time.monotonic()
+
+    def stop(self):
+        """
+        Stops run() and shuts down the XBee thread and the serial port
+        """
+        self.running = False
+        self.packets.put(None)
+        if self.scheduler is not None:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+        # halt() must be called before closing the serial port in order to
+        #  ensure proper thread shutdown
+        if self.xbee is not None:
+            self.xbee.halt()
+            self.xbee = None
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def message_received(self, data):
         """
         Call back Function. When a message is received over the network this
         function will get the data and put it in the Queue
         """
-        # Stores the data in the Queue
-        #  print(strftime("%Y-%m-%d %H:%M:%S", gmtime()))
-        packets.put(data, block=False)
-        print('Received Packet at: ' + strftime("%Y-%m-%d %H:%M:%S", gmtime()))
+        self.packets.put((time.monotonic(), data), block=False)
+        self.received += 1
+
+    def run(self, timeout=None):
+        """
+        Handles received packets until stop() is called. Blocks while there
+        is nothing to do. With a timeout, returns after that many seconds
+        without a packet.
+        """
+        while self.running:
+            try:
+                item = self.packets.get(timeout=timeout)
+            except queue.Empty:
+                return
+            n = 0
+            while item is not None:
+                self.handle(item)
+                n += 1
+                if n >= self.batch:
+                    break
+                try:
+                    item = self.packets.get_nowait()
+                except queue.Empty:
+                    break
+            if n > 0:
+                self.batches += 1
+                self.max_batch = max(self.max_batch, n)
+
+    def poll(self):
+        """
+        Handles whatever has been received without blocking, for callers
+        with their own loop. Returns the number of packets handled.
+        """
+        n = 0
+        while True:
+            try:
+                item = self.packets.get_nowait()
+            except queue.Empty:
+                return n
+            if item is not None:
+                self.handle(item)
+                n += 1
+
+    def handle(self, item):
+        arrived, data = item
+        self.handlePacket(data)
+        latency = time.monotonic() - arrived
+        self.handled += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def handlePacket(self, data):
+        """
+        Handles a received packet. First determines the packet type and then
+        passes it to the handler for that type
+        """
+        handler = self.handlers.get(data['id'])
+        if handler is None:
+            self.unhandled += 1
+            print('Unimplemented XBee frame type ' + data['id'])
+        else:
+            handler(data)
+
+    def handle_tx_status(self, data):
+        with self.lock:
+            sent = self.pending.pop(data.get('frame_id'), None)
+        if ord(data['deliver_status']) != 0:
+            self.transmit_errors += 1
+            print('Transmit error = ' + data['deliver_status'].hex())
+            if sent is not None:
+                # The cached route is no good. Forget it and flood the
+                #  payload; the node's next rx frame teaches us its address.
+                address_long, payload = sent
+                if address_long in self.nodes:
+                    self.nodes[address_long]['addr'] = UNKNOWN
+                self.broadcasts += 1
+                self.sendPacket(BROADCAST, UNKNOWN, payload)
+        elif sent is not None and 'dest_addr' in data:
+            # The XBee reports the 16bit address it actually delivered to
+            if sent[0] in self.nodes:
+                self.nodes[sent[0]]['addr'] = data['dest_addr']
+
+    def handle_rx(self, data):
+        self.learn(data)
+        print(data['rf_data'])
+
+    def learn(self, data):
+        """
+        Adds or refreshes the sender of a received frame in the node table
+        """
+        address_long = data.get('source_addr_long')
+        if address_long is None:
+            return
+        node = self.add_node(address_long, data.get('source_addr', UNKNOWN))
+        node['seen'] = time.time()
+        if 'rssi' in data:
+            node['rssi'] = data['rssi']
+
+    def add_node(self, address_long, address_short=UNKNOWN):
+        """
+        Puts a node in the node table, or updates its 16bit address if it is
+        already there, and schedules its query. Returns the table entry.
+        """
+        node = self.nodes.get(address_long)
+        if node is None:
+            node = {'addr': address_short, 'seen': None, 'rssi': None,
+                    'job': None}
+            self.nodes[address_long] = node
+            if self.scheduler is not None:
+                self.schedule_node(address_long)
+        else:
+            node['addr'] = address_short
+        return node
+
+    def remove_node(self, address_long):
+        node = self.nodes.pop(address_long, None)
+        if node is not None and node['job'] is not None:
+            self.scheduler.unschedule_job(node['job'])
 
+    def schedule_node(self, address_long):
+        if self.query_seconds:
+            self.nodes[address_long]['job'] = self.scheduler.add_interval_job(
+                self.sendQueryPacket, seconds=self.query_seconds,
+                args=[address_long])
 
-def sendPacket(address_long, address_short, payload):
+    def sendPacket(self, address_long, address_short, payload):
         """
         Sends a Packet of data to an XBee.
 
-        Inputs:     wddress_long - 64bit destination XBee Address
+        Inputs:     address_long - 64bit destination XBee Address
                     address_short - 16bit destination XBee Address
                     payload - Information to be sent to payload
         """
-        print(len(address_long))
-        print(len(address_short))
-        xbee.send('tx',
-                  dest_addr_long=address_long,
-                  dest_addr=address_short,
-                  data=payload
-                  )
+        self.xbee.send('tx',
+                       dest_addr_long=address_long,
+                       dest_addr=address_short,
+                       data=payload
+                       )
 
-        
-def sendQueryPacket():
+    def sendNodePacket(self, address_long, payload):
         """
-        Sends a test packet to all XBees on network
+        Sends a Packet of data to a node by its 64bit address, using the
+        16bit address from the node table if one is known. A failed delivery
+        is retried as a broadcast once its tx_status comes back.
         """
-        print('Sending Test Packet')
-        sendPacket(BROADCAST, UNKNOWN, b'q')
+        node = self.nodes.get(address_long)
+        address_short = UNKNOWN if node is None else node['addr']
+        with self.lock:
+            # Frame id 0 asks for no tx_status, so ids run from 1 to 255
+            self.frame_id = self.frame_id % 255 + 1
+            frame_id = bytes([self.frame_id])
+            self.pending[frame_id] = (address_long, payload)
+        self.unicasts += 1
+        self.xbee.send('tx',
+                       frame_id=frame_id,
+                       dest_addr_long=address_long,
+                       dest_addr=address_short,
+                       data=payload
+                       )
 
-
-def handlePacket(data):
+    def sendQueryPacket(self, address_long=None):
         """
-        Handles a received packet. First determines the packet type and then
-        performs
-        analysis
-        """
-        # Determine if received packet is a tx_status packet
-        if data['id'] == 'tx_status':
-            if ord(data['deliver_status']) != 0:
-                print('Transmit error = ')
-                print(data['deliver_status'].encode('hex'))
-
-        # Determine if received packet is a data packet
-        elif data['id'] == 'rx':
-            print(data['rf_data'])
-            # len(rxList)  # Do things
-            # Detemine if received packet is an undetermined XBee frame
+        Sends a query packet to one node, or to all XBees on network if no
+        address is given
+        """
+        if address_long is None:
+            print('Sending Test Packet')
+            self.broadcasts += 1
+            self.sendPacket(BROADCAST, UNKNOWN, b'q')
         else:
-            print('Unimplemented XBee frame type' + data['id'])
+            self.sendNodePacket(address_long, b'q')
 
+    def reset_stats(self):
+        self.started = time.monotonic()
+        self.received = 0
+        self.handled = 0
+        self.unhandled = 0
+        self.transmit_errors = 0
+        self.unicasts = 0
+        self.broadcasts = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
 
-def printpacket(packet):
-    '''  This is a random function
-    '''
-    print(packet)
+    def stats(self):
+        """
+        Returns the counters as a dict. Latency is the time from the XBee
+        thread receiving a frame to its handler returning, in seconds.
+        """
+        elapsed = time.monotonic() - self.started
+        return {'received': self.received,
+                'handled': self.handled,
+                'unhandled': self.unhandled,
+                'transmit_errors': self.transmit_errors,
+                'unicasts': self.unicasts,
+                'broadcasts': self.broadcasts,
+                'nodes': len(self.nodes),
+                'queued': self.packets.qsize(),
+                'batches': self.batches,
+                'max_batch': self.max_batch,
+                'packets_per_second': self.handled / elapsed if elapsed > 0 else 0.0,
+                'latency_mean': self.latency_total / self.handled if self.handled else 0.0,
+                'latency_max': self.latency_max}
 
 
-# Queue in which to store packets when received
-packets = queue.Queue()
+class FakeZigBee:
+    """
+    Stands in for ZigBee without a radio. Frames given to inject() reach the
+    callback as if they had come from the network, and sent frames are kept
+    in sent.
+    """
 
-# Open XBee Serial Port
-ser = serial.Serial(PORT, BAUD_RATE)
+    def __init__(self, ser=None, callback=None, escaped=True):
+        self.callback = callback
+        self.sent = []
 
-#------------------Scheduled Tasks -----
-sendsched = Scheduler()
-sendsched.start()
+    def inject(self, data):
+        self.callback(data)
 
-# Create XBee library API object, which spawns a new thread
-xbee = ZigBee(ser, callback=message_received, escaped=True)
+    def send(self, cmd, **kwargs):
+        self.sent.append((cmd, kwargs))
 
-# Can schedule tasks such as sending test packet
-sendsched.add_interval_job(sendQueryPacket, seconds=15)
+    def halt(self):
+        pass
 
 
-# Main thread handles received packets
-while True:
-        try:
-            time.sleep(0.1)
-            # Received packets are put into queue by message_received
-            if packets.qsize() > 0:
-                # Retrieve Packet
-                newPacket = packets.get_nowait()
-                # Dismantle Packet
-                handlePacket(newPacket)
-        except KeyboardInterrupt:
-            break
+def printpacket(packet):
+    '''  This is a random function
+    '''
+    print(packet)
+
 
-# halt() must be called before closing the serial port in order to ensure
-#  proper thread shutdown
-xbee.halt()
-ser.close()
+if __name__ == '__main__':
+    station = BaseStation()
+    station.start()
+    # Main thread handles received packets
+    try:
+        station.run()
+    except KeyboardInterrupt:
+        pass
+    station.stop()
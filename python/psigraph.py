@@ -1,7 +1,11 @@
 #python graphing module that I had to write,
 #because pyplot does not import for me no matter what I do.
+#Graphs can be fed from any thread with post(), which only stores the values;
+#the tk thread draws the latest of them at most once a frame, see start().
 
 import tkinter as tk
+import array
+import collections
 
 class barGraph:
     def __init__(self,c,barsN):
@@ -10,6 +14,11 @@ class barGraph:
         #graphics are preceded with g_
         self.c=c
         self.barsN=barsN #number of bars
+        self.latest=None #values posted and not drawn yet, see post()
+        self.frameMs=33 #time between frames in milliseconds
+        self.running=False
+        self.frames=0 #frames drawn
+        self.skipped=0 #bars left alone because they hadn't moved
     def define(self,x1,y1,x2,y2,yvals):
         #this precalculates values and is called from the prep function.
         #you can also call it here.
@@ -25,6 +34,7 @@ class barGraph:
         self.yvals=yvals
         self.xinc=(x2-x1)/self.barsN
         self.yinc=(y2-y1)/(self.yhigh-self.ylow)
+        self.drawn=[None]*self.barsN #the pixel row each bar's top was last drawn at
         self.yunits=""
         self.xlabels=range(0,self.barsN)
     def set_yunits(self,yunits):
@@ -40,10 +50,37 @@ class barGraph:
         for i in range(0,self.barsN):
             self.c.itemconfig(self.g_bars[i],fill=self.xcolors[i])
     def set_values(self,v):
-        #make sure v is bars elements long.
+        #make sure v is bars elements long. Draws straight away, so only call
+        #it from the tk thread; bars that wouldn't move a pixel are skipped.
         self.xvals=v
         for i in range(0,self.barsN):
-            self.c.coords(self.g_bars[i],self.x1+self.xinc*i+self.xinc*0.1,self.y2-self.yinc*(self.xvals[i]),self.x1+self.xinc*i+self.xinc*0.9,self.y2)
+            top=round(self.y2-self.yinc*(self.xvals[i]))
+            if top==self.drawn[i]:
+                self.skipped+=1
+                continue
+            self.drawn[i]=top
+            self.c.coords(self.g_bars[i],self.x1+self.xinc*i+self.xinc*0.1,top,self.x1+self.xinc*i+self.xinc*0.9,self.y2)
+    def post(self,v):
+        #hands the graph new values from any thread without waiting. Only the
+        #latest values posted before a frame get drawn; replacing the
+        #reference is atomic, so no lock is needed.
+        self.latest=v
+    def start(self,fps=30):
+        #starts drawing posted values fps times a second. Call from the tk thread.
+        self.frameMs=max(1,int(1000/fps))
+        if self.running==False:
+            self.running=True
+            self.c.after(self.frameMs,self.frame)
+    def stop(self):
+        self.running=False
+    def frame(self):
+        v=self.latest
+        if v!=None:
+            self.latest=None
+            self.set_values(v)
+            self.frames+=1
+        if self.running:
+            self.c.after(self.frameMs,self.frame)
     def prep(self,x1,y1,x2,y2,yvals):
         #call this only once. It set up graphics.
         #ylow and yhigh are the extents of the y axis.
@@ -68,3 +105,167 @@ class barGraph:
         self.set_xcolors(["red"]*self.barsN)
 
 
+
+class stripChart:
+    #A scrolling line graph of the last length samples of channelsN channels.
+    #The samples are kept in a fixed size ring per channel, and each frame
+    #draws one line per channel with at most two points per pixel column:
+    #when there are more samples than columns, each column shows the lowest
+    #and highest of its samples. Those are kept up to date as samples come
+    #in, in rings of buckets of bucketN samples, so drawing takes as long for
+    #a day of history as for a minute.
+    #Set up like barGraph, then post() a list of channelsN values at a time.
+    def __init__(self,c,channelsN,length=3600):
+        self.c=c
+        self.channelsN=channelsN
+        self.length=length #samples kept per channel
+        self.rings=[array.array("d",[0.0])*length for i in range(channelsN)]
+        self.head=0 #where the next sample goes in the rings
+        self.count=0 #samples in the rings, up to length
+        self.total=0 #samples ever added
+        self.bucketN=0 #samples per bucket, 0 while there are few enough to draw each one
+        self.pending=collections.deque(maxlen=length) #posted and not in the rings yet; more would only be overwritten
+        self.frameMs=33 #time between frames in milliseconds
+        self.running=False
+        self.frames=0 #frames drawn
+    def define(self,x1,y1,x2,y2,yvals):
+        #as barGraph.define.
+        self.x1=x1
+        self.x2=x2
+        self.y1=y1
+        self.y2=y2
+        self.ylow=yvals[0]
+        self.yhigh=yvals[-1]
+        self.yvals=yvals
+        self.yinc=(y2-y1)/(self.yhigh-self.ylow)
+        self.columns=max(1,int(x2-x1)) #pixel columns
+        if self.length>self.columns*2:
+            self.bucketN=-(-self.length//self.columns)
+            self.bucketsN=self.length//self.bucketN+2 #enough for a part filled bucket at each end
+            self.mins=[array.array("d",[0.0])*self.bucketsN for i in range(self.channelsN)]
+            self.maxs=[array.array("d",[0.0])*self.bucketsN for i in range(self.channelsN)]
+        self.yunits=""
+        self.labels=[str(i) for i in range(0,self.channelsN)]
+    def set_yunits(self,yunits):
+        self.yunits=yunits
+        for i in range(0,len(self.yvals)):
+            self.c.itemconfig(self.g_yvals[i],text=str(self.yvals[i])+self.yunits)
+    def set_labels(self,labels):
+        self.labels=labels
+        for i in range(0,self.channelsN):
+            self.c.itemconfig(self.g_labels[i],text=self.labels[i])
+    def set_colors(self,colors):
+        self.colors=colors
+        for i in range(0,self.channelsN):
+            self.c.itemconfig(self.g_lines[i],fill=self.colors[i])
+            self.c.itemconfig(self.g_labels[i],fill=self.colors[i])
+    def add(self,v):
+        #puts a sample of every channel into the rings. Only the tk thread
+        #should call this; other threads post().
+        head=self.head
+        if self.bucketN==0:
+            for i in range(0,self.channelsN):
+                self.rings[i][head]=v[i]
+        else:
+            b=(self.total//self.bucketN)%self.bucketsN
+            fresh=self.total%self.bucketN==0
+            for i in range(0,self.channelsN):
+                x=v[i]
+                self.rings[i][head]=x
+                if fresh or x<self.mins[i][b]:
+                    self.mins[i][b]=x
+                if fresh or x>self.maxs[i][b]:
+                    self.maxs[i][b]=x
+        self.head=(head+1)%self.length
+        self.total+=1
+        if self.count<self.length:
+            self.count+=1
+    def post(self,v):
+        #queues a sample from any thread without waiting; it goes into the
+        #rings on the next frame. deque appends are atomic, so no lock is needed.
+        #If frames stall, the oldest posted samples are dropped, as the rings
+        #would have dropped them.
+        self.pending.append(v)
+    def samples(self,i):
+        #channel i's samples, oldest first.
+        r=self.rings[i]
+        if self.count<self.length:
+            return r[0:self.count]
+        return r[self.head:]+r[0:self.head]
+    def points(self,i):
+        #the flattened x,y coordinates of channel i's line. The newest sample
+        #is at the right edge and the chart fills leftwards.
+        n=self.count
+        xstep=(self.x2-self.x1)/max(1,self.length-1)
+        y2=self.y2
+        ylow=self.ylow
+        yinc=self.yinc
+        out=[]
+        if self.bucketN==0:
+            s=self.samples(i)
+            for j in range(0,n):
+                out.append(self.x2-(n-1-j)*xstep)
+                out.append(y2-(s[j]-ylow)*yinc)
+        else:
+            #a bucket is drawn where its newest sample goes. The oldest one
+            #may hold a few samples that have left the ring.
+            k=self.bucketN
+            mins=self.mins[i]
+            maxs=self.maxs[i]
+            newest=self.total-1
+            for b in range((self.total-n)//k,newest//k+1):
+                x=self.x2-(newest-min(b*k+k-1,newest))*xstep
+                out+=[x,y2-(mins[b%self.bucketsN]-ylow)*yinc,x,y2-(maxs[b%self.bucketsN]-ylow)*yinc]
+        for j in range(1,len(out),2):
+            out[j]=min(y2,max(self.y1,out[j]))
+        return out
+    def redraw(self):
+        for i in range(0,self.channelsN):
+            pts=self.points(i)
+            if len(pts)<4:
+                pts=pts+pts if len(pts)==2 else [self.x2,self.y2,self.x2,self.y2]
+            self.c.coords(self.g_lines[i],*pts)
+    def start(self,fps=30):
+        #as barGraph.start.
+        self.frameMs=max(1,int(1000/fps))
+        if self.running==False:
+            self.running=True
+            self.c.after(self.frameMs,self.frame)
+    def stop(self):
+        self.running=False
+    def frame(self):
+        changed=False
+        while True:
+            try:
+                v=self.pending.popleft()
+            except IndexError:
+                break
+            self.add(v)
+            changed=True
+        if changed:
+            self.redraw()
+            self.frames+=1
+        if self.running:
+            self.c.after(self.frameMs,self.frame)
+    def prep(self,x1,y1,x2,y2,yvals):
+        #as barGraph.prep; call this only once. The channel labels go down
+        #the right hand side.
+        self.define(x1,y1,x2,y2,yvals)
+        self.g_backdrop=self.c.create_rectangle(x1,y1,x2,y2,fill="white")
+        self.g_axisy=self.c.create_line(x1,y1,x1,y2,fill="black")
+        self.g_axisx=self.c.create_line(x1,y2,x2,y2,fill="black")
+        self.g_yvals=[]
+        self.g_ymarks=[]
+        for i in range(len(self.yvals)):
+            self.g_yvals.append(self.c.create_text(x1-20,y2-(y2-y1)/(len(self.yvals)-1)*i,justify=tk.RIGHT,text=str(self.yvals[i])+self.yunits))
+        if len(self.yvals)>2:
+            for i in range(1,len(self.yvals)-1):
+                self.g_ymarks.append(self.c.create_line(x1,y2-(y2-y1)/(len(self.yvals)-1)*i,x2,y2-(y2-y1)/(len(self.yvals)-1)*i,fill="grey"))
+        self.g_lines=[]
+        self.g_labels=[]
+        for i in range(0,self.channelsN):
+            self.g_lines.append(self.c.create_line(x2,y2,x2,y2,fill="black"))
+            self.g_labels.append(self.c.create_text(x2+10,y1+(y2-y1)/max(1,self.channelsN)*(i+0.5),anchor=tk.W,text=self.labels[i]))
+        self.set_colors((chartColors*(self.channelsN//len(chartColors)+1))[0:self.channelsN])
+
+chartColors=["red","blue","green","orange","purple","brown","magenta","cyan"]
@@ -0,0 +1,244 @@
+#Written for python 3
+#Tests for LairCom0_4, run from this directory with
+#python3 -m pytest -q
+
+import os
+import time
+import shutil
+import random
+import pytest
+import SOGSEmulator
+import psigraph
+import LairCom0_4 as lc
+from LairCom0_4 import LairUI
+
+class FakePort:
+    #stands in for a serial port. What is fed to it is read back, and what
+    #is written to it is kept in written.
+    def __init__(self):
+        self.incoming=bytearray()
+        self.written=[]
+    @property
+    def in_waiting(self):
+        return len(self.incoming)
+    def read(self,n):
+        out=bytes(self.incoming[0:n])
+        del self.incoming[0:n]
+        return out
+    def write(self,b):
+        self.written.append(b)
+    def close(self):
+        pass
+    def feed(self,b):
+        self.incoming+=b
+
+def connect():
+    #a LairCom that has shaken hands with a FakePort.
+    com=lc.LairCom()
+    com.ch=FakePort()
+    com.mode=2
+    return com
+
+def gasPacket(counts):
+    return ("M0"+"".join([lc.numberToAlphahex(n,3) for n in counts])+"\r").encode()
+
+def runUntil(lu,f,seconds=10):
+    #runs headlessMain a little at a time until f() is true or seconds pass.
+    end=time.monotonic()+seconds
+    while not f() and time.monotonic()<end:
+        lu.headlessMain(0.1)
+    return f()
+
+@pytest.mark.skipif(os.name!="posix",reason="PtyBoard needs a pseudo terminal")
+def test_hotplug(tmp_path):
+    #a board found through portGlobs is plugged in, pulled out and plugged
+    #back in under another name, with headlessMain running throughout.
+    lu=LairUI(mode="null",ui="none",saveDir="",delay=0.2)
+    lu.com.portGlobs=[str(tmp_path/"board*")]
+    lu.com.handshakeTimeout=0.5 #for any real ports that don't answer
+    boards=[]
+    try:
+        boards.append(SOGSEmulator.PtyBoard())
+        os.symlink(boards[0].port,tmp_path/"board0")
+        assert runUntil(lu,lambda:lu.com.mode==2)
+        assert lu.com.port==str(tmp_path/"board0")
+        boards[0].close()
+        os.remove(tmp_path/"board0")
+        assert runUntil(lu,lambda:lu.com.port!=str(tmp_path/"board0") or lu.com.mode==0)
+        assert lu.com.stats()["counters"]["disconnects"]>=1
+        lu.headlessMain(0.5)
+        lu.com.rtt={}
+        boards.append(SOGSEmulator.PtyBoard())
+        os.symlink(boards[1].port,tmp_path/"board1")
+        assert runUntil(lu,lambda:lu.com.mode==2 and lu.com.port==str(tmp_path/"board1"))
+        assert lu.com.stats()["counters"]["reconnects"]==1
+        #and measurements come from the new board.
+        assert runUntil(lu,lambda:lu.com.rtt!={})
+    finally:
+        lu.com.serialClose()
+        for b in boards[1:]:
+            b.close()
+
+def readAggregate(path):
+    #an aggregate file without its header comments, which hold the date.
+    f=open(path)
+    lines=[l for l in f if l[0:1]!="#"]
+    f.close()
+    return lines
+
+def test_aggregateModesAgree(tmp_path):
+    #full, parallel and incremental aggregation write the same file, also
+    #for times saved without all six decimals and cycles missing a controller.
+    saveDir=tmp_path/"SOGSMeasurements"
+    shutil.copytree(os.path.join(os.path.dirname(__file__),"SOGSMeasurements"),saveDir)
+    os.makedirs(saveDir/"2014-02-01")
+    f=open(saveDir/"2014-02-01"/"10-00-00_500000.txt","w")
+    f.write("comment#\ndelineator/\nepoch/2014-02-01/10:00:00.5\nkind/SOGSdata\n")
+    f.write("m/gas/2014-02-01/10:00:00.5/1.5/2/3/4/5/6/7/8\n")
+    f.close()
+    outputs=[]
+    for (name,options) in [("full",{}),("parallel",{"workers":2}),("incremental",{"incremental":True})]:
+        LairUI(mode="aggregate",ui="none",saveDir=str(saveDir),aggFile=str(tmp_path/name),addAggDate=False,**options)
+        outputs.append(readAggregate(tmp_path/(name+".csv")))
+    assert len(outputs[0])>30
+    assert any(["10:00:00.5,\t" in l for l in outputs[0]])
+    assert outputs[0]==outputs[1]
+    assert outputs[0]==outputs[2]
+    #aligned rows are a different layout, but keep the times as saved too.
+    LairUI(mode="aggregate",ui="none",saveDir=str(saveDir),aggFile=str(tmp_path/"aligned"),addAggDate=False,align=0.5)
+    assert any(["gas,\t2014-02-01,\t10:00:00.5,\t1.5," in l for l in readAggregate(tmp_path/"aligned.csv")])
+    with pytest.raises(ValueError):
+        LairUI(mode="aggregate",ui="none",saveDir=str(saveDir),aggFile=str(tmp_path/"both"),workers=2,align=0.5)
+
+def test_textAndBinaryAgree():
+    #the same samples sent as text, as binary frames and in a burst dump
+    #decode to the same voltages, one packet at a time and in batches.
+    rnd=random.Random(3)
+    samples=[[rnd.randrange(1024) for i in range(0,8)] for j in range(0,50)]+[[0]*8,[1023]*8,[15]*8]
+    packets=["".join([lc.numberToAlphahex(n,3) for n in s]) for s in samples]
+    payloads=[lc.packSamples(s) for s in samples]
+    mc=lc.MCGas()
+    for (p,f,s) in zip(packets,payloads,samples):
+        assert lc.alphahexToCounts(p)==s
+        assert mc.parsePacketToData(p)==mc.parseFrameToData(f)
+    assert [list(r) for r in lc.alphahexPacketsToCounts(packets)]==samples
+    assert [list(r) for r in lc.alphahexBlockToCounts("".join(packets))]==samples
+    assert (mc.parsePacketsToArray(packets)==mc.parseFramesToArray(payloads)).all()
+    thb=lc.MCTHB()
+    assert thb.parsePacketToData(packets[0])==thb.parseFrameToData(payloads[0])
+
+def test_wakeClosed():
+    #the socketpair waking headlessMain only exists while it runs.
+    lu=LairUI(mode="null",ui="none",saveDir="",delay=0.2)
+    lu.com.portGlobs=[]
+    assert lu.wake==None
+    lu.headlessMain(0.05)
+    assert lu.wake==None
+    lu.startAcquisition()
+    wake=lu.wake
+    lu.stopAcquisition()
+    assert lu.wake==None and wake[0].fileno()==-1 and wake[1].fileno()==-1
+
+def test_requestWindow():
+    #two requests go out at a time, a reply finishes the oldest and lets
+    #the next out, and a reply after its request has timed out is thrown
+    #away instead of being taken for a newer request's.
+    com=connect()
+    com.window=2
+    rs=[com.submit("gas",timeout=0.1) for i in range(0,3)]
+    assert len(com.ch.written)==2 and len(com.backlog)==1
+    com.ch.feed(gasPacket([204]*8))
+    com.main()
+    assert rs[0].state==2 and rs[0].result==[204/204.8]*8
+    assert len(com.ch.written)==3
+    time.sleep(0.15)
+    com.main()
+    assert [r.state for r in rs]==[2,3,3]
+    com.ch.feed(gasPacket([1]*8))
+    com.main()
+    assert com.stats()["counters"]["late_replies"]==1
+    assert com.stats()["counters"]["request_timeouts"]==2
+    assert len(com.queues["M0"])==0
+    time.sleep(0.1)
+    com.main()
+    assert len(com.inflight)==0
+    r=com.submit("gas",timeout=0.1)
+    com.ch.feed(gasPacket([2]*8))
+    com.main()
+    assert r.state==2 and r.result==[2/204.8]*8
+
+def test_mixedRead():
+    #text packets and binary frames arrive together in one read, with
+    #carriage returns and END bytes inside the frames' data, and the last
+    #frame split over two reads.
+    com=connect()
+    com.binary=True
+    samples=[[13]*8,[192,219,0,1023,13,512,3,4],[5,6,7,8,9,10,11,12]]
+    frames=[lc.makeFrame("M0",lc.packSamples(s)) for s in samples]
+    assert b"\r" in frames[0] and b"\xdb" in frames[1]
+    com.ch.feed(gasPacket(samples[0])+frames[0]+b"VVx\r"+frames[1]+gasPacket(samples[1])+frames[2][0:5])
+    com.serialGet()
+    assert len(com.queues["M0"])==4 and com.getReceived()=="VVx"
+    com.ch.feed(frames[2][5:])
+    com.serialGet()
+    got=[com.get("gas") for i in range(0,5)]
+    mc=lc.MCGas()
+    assert got==[mc.parseCountsToData(s) for s in [samples[0],samples[0],samples[1],samples[1],samples[2]]]
+    assert len(com.buffer)==0
+    assert "frames_malformed" not in com.stats()["counters"]
+
+def test_alignTimes():
+    #each row takes at most one time from each list, within tolerance of
+    #the earliest time left, so every time is used exactly once.
+    rows=lc.alignTimes([[0,10,20,30],[1,19,31,40],[]],2)
+    assert rows==[[0,1,2,3,-1],[0,-1,1,2,3],[-1]*5]
+    assert lc.alignTimes([[0,1],[0]],5)==[[0,1],[0,-1]]
+    assert lc.alignTimes([[],[]],1)==[[],[]]
+
+def test_stripChartRing():
+    #with room to draw every sample, the ring keeps the newest length of
+    #them and the line ends at the right edge. No canvas is needed for this.
+    chart=psigraph.stripChart(None,1,5)
+    chart.define(0,0,100,100,[0,10])
+    assert chart.bucketN==0
+    for i in range(0,7):
+        chart.add([i])
+    assert list(chart.samples(0))==[2,3,4,5,6]
+    assert chart.points(0)==[0,80,25,70,50,60,75,50,100,40]
+
+def test_stripChartBuckets():
+    #with more samples than pixel columns, each bucket is drawn as the
+    #lowest and highest of its samples.
+    chart=psigraph.stripChart(None,2,100)
+    chart.define(0,0,10,100,[0,100])
+    assert chart.bucketN==10
+    values=[(i*37)%101 for i in range(0,150)]
+    for v in values:
+        chart.add([v,100-v])
+    assert list(chart.samples(0))==values[50:]
+    pts=chart.points(0)
+    assert len(pts)==10*4
+    for b in range(0,10):
+        bucket=values[50+b*10:60+b*10]
+        assert pts[b*4:b*4+4]==[pts[b*4],100-min(bucket),pts[b*4],100-max(bucket)]
+    assert pts[-4]==10
+    #the other channel runs the other way, so its lows are the first's highs.
+    assert chart.points(1)[1::4]==[max(values[b:b+10]) for b in range(50,150,10)]
+
+def test_clockSyncFit():
+    #a board clock 3 s ahead and gaining 50 ppm, read to the hundredth once
+    #a minute, with every fourth round trip slow and its reading 0.5 s out.
+    clock=lc.ClockSync()
+    assert clock.offset(0)==None and clock.driftPpm()==None
+    t0=10**12
+    def board(mono):
+        return mono+3*10**9+(mono-t0)*50//10**6
+    for k in range(0,32):
+        mono=t0+k*60*10**9
+        if k%4==3:
+            clock.add(mono,board(mono)//10**7*10**7+5*10**8,60*10**6)
+        else:
+            clock.add(mono,board(mono)//10**7*10**7,2*10**6)
+    assert abs(clock.driftPpm()-50)<3
+    for mono in [t0,t0+30*60*10**9,t0+40*60*10**9]:
+        assert abs(clock.boardTime(mono)-board(mono))<2*10**6
@@ -0,0 +1,132 @@
+#Written for python 3
+#Tests for SOGSCom0_5, run from this directory with
+#python3 -m pytest -q
+
+import os
+import asyncio
+import pytest
+import SOGSEmulator
+import SOGSCom0_5 as sc
+
+class ConduitEmulator(sc.Conduit):
+    #an Emulator in place of a board, which loses the replies to the
+    #commands numbered in drop, counting from 1, and sends those in late
+    #after late seconds.
+    def __init__(self,drop=(),late=(),lateSeconds=0.3):
+        sc.Conduit.__init__(self)
+        self.emulator=SOGSEmulator.Emulator()
+        self.drop=drop
+        self.late=late
+        self.lateSeconds=lateSeconds
+        self.sent=0
+    def packetTransmit(self,packet):
+        self.emulator.write((packet+"\r").encode())
+        out=self.reply(packet,self.emulator.read(self.emulator.in_waiting))
+        self.sent+=1
+        if self.sent in self.late:
+            self.loop.call_later(self.lateSeconds,self.bytesReceived,out)
+        elif self.sent not in self.drop:
+            self.bytesReceived(out)
+    def reply(self,packet,out):
+        return out
+    async def readBytes(self):
+        data=await sc.Conduit.readBytes(self)
+        if data==b"":
+            raise OSError("unplugged")
+        return data
+    def unplug(self):
+        self.bytesReceived(b"")
+
+class ConduitNumbered(ConduitEmulator):
+    #answers each command with its header and its number, so a reply can be
+    #told from the one before.
+    def reply(self,packet,out):
+        return out if packet=="VV" else (packet[0:2]+str(self.sent+1)+"\r").encode()
+
+def makeHub(conduit,requestTimeout=1.0):
+    hub=sc.Hub(handshakeTimeout=1,requestTimeout=requestTimeout)
+    hub.boardCreate("b1",conduit)
+    hub.loadInstrument("b1",sc.InstrumentAlphasense("gas"))
+    return hub
+
+def test_lostReply():
+    #the reply to the second measurement (the third command, after VV) is
+    #lost. Only that request should time out, once its late reply is no
+    #longer waited for.
+    hub=makeHub(ConduitEmulator(drop=(3,)),0.2)
+    async def main():
+        await hub.start()
+        timeouts=0
+        for i in range(0,5):
+            try:
+                packet=await hub.measure("b1","gas")
+                assert packet[0:2]=="M0"
+            except asyncio.TimeoutError:
+                timeouts+=1
+                await asyncio.sleep(0.2)
+        hub.stop()
+        return timeouts
+    assert asyncio.run(main())==1
+
+def test_lateReply():
+    #the reply to the first measurement comes after it has timed out. It is
+    #thrown away, and the next measurement gets its own reply.
+    hub=makeHub(ConduitNumbered(late=(2,),lateSeconds=0.3),0.2)
+    async def main():
+        await hub.start()
+        with pytest.raises(asyncio.TimeoutError):
+            await hub.measure("b1","gas")
+        await asyncio.sleep(0.15)
+        packet=await hub.measure("b1","gas")
+        hub.stop()
+        return packet
+    assert asyncio.run(main())=="M03"
+    assert hub.boards[0].lateReplies==1
+
+def test_readerEnded():
+    #a board that goes away fails what is waiting on it at once, and
+    #anything asked of it afterwards.
+    conduit=ConduitEmulator(drop=(2,))
+    hub=makeHub(conduit,5)
+    async def main():
+        await hub.start()
+        f=hub.measure("b1","gas")
+        conduit.unplug()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(f,1)
+        with pytest.raises(ConnectionError):
+            await hub.measure("b1","gas")
+        hub.stop()
+    asyncio.run(main())
+
+@pytest.mark.skipif(os.name!="posix",reason="PtyBoard needs a pseudo terminal")
+def test_stopOutsideLoop():
+    pb=SOGSEmulator.PtyBoard()
+    try:
+        hub=makeHub(sc.ConduitUSBSerial(pb.port))
+        async def main():
+            await hub.start()
+            return await asyncio.wait_for(hub.measure("b1","gas"),1)
+        assert asyncio.run(main())[0:2]=="M0"
+        hub.stop()
+        assert hub.boards[0].conduit.state==0
+    finally:
+        pb.close()
+
+def test_burstDump():
+    #a dump comes back for the bank of the burst, and one for the other
+    #bank is refused as the board would send the burst's records anyway.
+    hub=makeHub(ConduitEmulator())
+    hub.loadInstrument("b1",sc.InstrumentBatterySolar("battery"))
+    async def main():
+        await hub.start()
+        n=await hub.burst("b1","gas",5,0.01)
+        await asyncio.sleep(0.1)
+        first,counts=await asyncio.wait_for(hub.dump("b1","gas"),1)
+        with pytest.raises(ValueError):
+            await hub.dump("b1","battery")
+        hub.stop()
+        return n,first,[list(r) for r in counts]
+    n,first,counts=asyncio.run(main())
+    assert (n,first,len(counts))==(5,0,5)
+    assert all([len(r)==8 for r in counts])
@@ -0,0 +1,133 @@
+"""
+Tests for prototypebasestation, run from this directory with
+python3 -m pytest -q
+
+The station talks to a FakeZigBee, so neither a radio nor the xbee library
+is needed.
+"""
+
+import threading
+import time
+import pytest
+import prototypebasestation as pb
+
+NODE = b'\x00\x13\xA2\x00\x40\x01\x02\x03'
+NODE_ADDR = b'\x12\x34'
+
+
+def make_station(**options):
+    station = pb.BaseStation(port=None, xbee_class=pb.FakeZigBee,
+                             query_seconds=0, discover_seconds=0, **options)
+    station.start()
+    return station
+
+
+def rx(data=b'hello', address_short=NODE_ADDR):
+    return {'id': 'rx', 'source_addr_long': NODE,
+            'source_addr': address_short, 'rssi': b'\x28', 'rf_data': data}
+
+
+def test_batch_drain_and_stop():
+    # Ten frames waiting are handled four at a time, and stop() wakes run()
+    #  from another thread
+    station = make_station(batch=4)
+    for i in range(10):
+        station.xbee.inject(rx(bytes([i])))
+    runner = threading.Thread(target=station.run)
+    runner.start()
+    end = time.monotonic() + 5
+    while station.handled < 10 and time.monotonic() < end:
+        time.sleep(0.01)
+    station.stop()
+    runner.join(5)
+    assert not runner.is_alive()
+    assert (station.handled, station.batches, station.max_batch) == (10, 3, 4)
+
+
+def test_run_timeout():
+    station = make_station()
+    station.run(timeout=0.05)
+    assert station.handled == 0
+    station.stop()
+
+
+def test_dispatch(capsys):
+    station = make_station()
+    seen = []
+    station.handlers['at_response'] = seen.append
+    station.xbee.inject(rx())
+    station.xbee.inject({'id': 'at_response', 'command': b'DB'})
+    station.xbee.inject({'id': 'node_id_indicator'})
+    assert station.poll() == 3
+    assert seen == [{'id': 'at_response', 'command': b'DB'}]
+    assert station.unhandled == 1
+    out = capsys.readouterr().out
+    assert "b'hello'" in out
+    assert 'Unimplemented XBee frame type node_id_indicator' in out
+    station.stop()
+
+
+def test_stats():
+    station = make_station()
+    for i in range(5):
+        station.xbee.inject(rx())
+    station.xbee.inject({'id': 'unknown'})
+    assert station.stats()['queued'] == 6
+    station.poll()
+    stats = station.stats()
+    assert stats['received'] == 6
+    assert stats['handled'] == 6
+    assert stats['unhandled'] == 1
+    assert stats['nodes'] == 1
+    assert stats['queued'] == 0
+    assert 0 <= stats['latency_mean'] <= stats['latency_max']
+    station.reset_stats()
+    assert station.stats()['handled'] == 0
+    station.stop()
+
+
+def test_node_learning_and_broadcast_fallback():
+    station = make_station()
+    station.xbee.inject(rx())
+    station.poll()
+    assert station.nodes[NODE]['addr'] == NODE_ADDR
+    assert station.nodes[NODE]['rssi'] == b'\x28'
+    # A query goes to the learned 16bit address
+    station.sendQueryPacket(NODE)
+    cmd, sent = station.xbee.sent[-1]
+    assert cmd == 'tx'
+    assert (sent['dest_addr_long'], sent['dest_addr']) == (NODE, NODE_ADDR)
+    # Its delivery fails, so the address is forgotten and the query flooded
+    station.xbee.inject({'id': 'tx_status', 'frame_id': sent['frame_id'],
+                         'deliver_status': b'\x24'})
+    station.poll()
+    assert station.nodes[NODE]['addr'] == pb.UNKNOWN
+    cmd, sent = station.xbee.sent[-1]
+    assert sent['dest_addr_long'] == pb.BROADCAST
+    assert (sent['dest_addr'], sent['data']) == (pb.UNKNOWN, b'q')
+    assert station.transmit_errors == 1
+    assert (station.unicasts, station.broadcasts) == (1, 1)
+    assert station.pending == {}
+    # The node's next frame teaches its new address, and a delivered unicast
+    #  keeps the address the XBee reports
+    station.xbee.inject(rx(address_short=b'\x56\x78'))
+    station.poll()
+    station.sendQueryPacket(NODE)
+    sent = station.xbee.sent[-1][1]
+    assert sent['dest_addr'] == b'\x56\x78'
+    station.xbee.inject({'id': 'tx_status', 'frame_id': sent['frame_id'],
+                         'deliver_status': b'\x00', 'dest_addr': b'\x9a\xbc'})
+    station.poll()
+    assert station.nodes[NODE]['addr'] == b'\x9a\xbc'
+    assert station.transmit_errors == 1
+    station.stop()
+
+
+def test_missing_dependencies(monkeypatch):
+    monkeypatch.setattr(pb, 'Scheduler', None)
+    station = pb.BaseStation(port=None, xbee_class=pb.FakeZigBee)
+    with pytest.warns(UserWarning, match='apscheduler'):
+        station.start()
+    station.stop()
+    with pytest.raises(RuntimeError):
+        pb.BaseStation(port=None, xbee_class=None).start()